@@ -2,27 +2,19 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import requests
-import os
-import zipfile
-import io
-import xml.etree.ElementTree as ET
-from google import genai
-from google.genai import types
-from pydantic import BaseModel
+import functools
 import datetime
 import json
-import re
-import pypdf
-import docx
-from fpdf import FPDF
-from pptx import Presentation
-from pptx.util import Inches, Pt
-from pptx.dml.color import RGBColor
-from pptx.enum.dml import MSO_LINE
-from typing import Optional, List, Union, Any
-
-# Safety Default
-target_standard = locals().get('target_standard') or globals().get('target_standard') or "General Standard"
+from content_engine import (
+    STEM_TOOLS,
+    Reporter, ProgressDisplay, PreviewDisplay, set_reporter, Tracer, set_tracer, configure_gemini,
+    get_response_cache, get_rate_limiter, read_package, build_source_index, recommend_tool,
+    construct_assignment_prompt, construct_quiz_prompt, construct_unit_prompt,
+    generate_lesson_plan_pdf, generate_slide_deck,
+    generate_quiz_data_batched, generate_question_bank, generate_qti_zip,
+    QUESTION_BANK_MAX_QUESTIONS, QTI_MAX_ITEMS_PER_FILE,
+    generate_unit_sequence_json, generate_unit_package,
+)
 
 # --- Configuration ---
 st.set_page_config(page_title="Canvas Content Creator", page_icon="✨", layout="wide", initial_sidebar_state="expanded")
@@ -49,6 +41,7 @@ def reset_app():
     st.session_state['is_generated'] = False
     st.session_state['quiz_zip'] = None
     st.session_state['unit_zip'] = None
+    st.session_state['trace'] = None
 
 # Custom CSS matching AI Teacher Lounge branding
 st.markdown("""
@@ -679,427 +672,121 @@ document.addEventListener('DOMContentLoaded', function() {
 </script>
 """, unsafe_allow_html=True)
 
-# --- Constants ---
-
-STEM_TOOLS = {
-    "PhET: Balancing Chemical Equations": "https://phet.colorado.edu/sims/html/balancing-chemical-equations/latest/balancing-chemical-equations_en.html",
-    "PhET: Circuit Construction Kit": "https://phet.colorado.edu/sims/html/circuit-construction-kit-dc/latest/circuit-construction-kit-dc_en.html",
-    "PhET: Energy Skate Park": "https://phet.colorado.edu/sims/html/energy-skate-park/latest/energy-skate-park_en.html",
-    "PhET: Natural Selection": "https://phet.colorado.edu/sims/html/natural-selection/latest/natural-selection_en.html",
-    "PhET: Projectile Motion": "https://phet.colorado.edu/sims/html/projectile-motion/latest/projectile-motion_en.html",
-    "PhET: Forces and Motion": "https://phet.colorado.edu/sims/html/forces-and-motion-basics/latest/forces-and-motion-basics_en.html",
-    "Desmos: Graphing Calculator": "https://www.desmos.com/calculator",
-    "Desmos: Scientific Calculator": "https://www.desmos.com/scientific",
-    "GeoGebra: Geometry": "https://www.geogebra.org/geometry",
-    "YouTube: Crash Course": "https://www.youtube.com/user/crashcourse",
-    "YouTube: Khan Academy": "https://www.youtube.com/user/khanacademy",
-    "YouTube: National Geographic": "https://www.youtube.com/user/NationalGeographic",
-    "Wikipedia": "https://www.wikipedia.org/",
-    "Google Slides": "https://docs.google.com/presentation/u/0/",
-    "Canva": "https://www.canva.com/",
-    "Desmos: Supply & Demand Shifters": "https://www.desmos.com/calculator/6mmm8psho7",
-    "EconGraphs: Competitive Market": "https://www.econgraphs.org/graphs/micro/equilibrium/supply_and_demand_old",
-    "Marginal Revolution: Elasticity Practice": "https://practice.mru.org/interactive-practice-supply-and-demand/",
-    "Omni Margin Calculator": "https://www.omnicalculator.com/finance/margin",
-    "AutoDraw": "https://www.autodraw.com/",
-    "Sketchpad": "https://sketch.io/sketchpad/",
-    "Color Wheel": "https://color.adobe.com/create/color-wheel",
-    "Google Arts & Culture": "https://artsandculture.google.com/",
-    "Python Online Compiler": "https://trinket.io/embed/python3",
-    "Scratch": "https://scratch.mit.edu/projects/editor/embed"
-}
-
-# --- Helper Functions (QTI) ---
-
-class Question(BaseModel):
-    type: str  # Type is crucial for correct QTI rendering
-    question_text: str
-    options: Optional[List[str]] = None
-    correct_answer_index: Optional[Union[int, List[int]]] = None # Can be list for multiple select, or None for essay
-    correct_answer_text: Optional[str] = None # For short answer/fill in blank
-
-class Quiz(BaseModel):
-    questions: list[Question]
-
-def create_imsmanifest():
-    """Creates the imsmanifest.xml content."""
-    manifest_template = """<?xml version="1.0" encoding="UTF-8"?>
-<manifest identifier="man00001" xmlns="http://www.imsglobal.org/xsd/imscp_v1p1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.imsglobal.org/xsd/imscp_v1p1 http://www.imsglobal.org/xsd/imscp_v1p1.xsd">
-  <metadata>
-    <schema>IMS Content</schema>
-    <schemaversion>1.1.3</schemaversion>
-  </metadata>
-  <organizations/>
-  <resources>
-    <resource identifier="res00001" type="imsqti_xmlv1p2">
-      <file href="quiz.xml"/>
-    </resource>
-  </resources>
-</manifest>"""
-    return manifest_template.encode('utf-8')
-
-def create_quiz_xml(questions, title="Generated Quiz"):
-    """Creates the quiz.xml content (QTI v1.2) supporting multiple question types."""
-    root = ET.Element("questestinterop", {
-        "xmlns": "http://www.imsglobal.org/xsd/ims_qtiasiv1p2",
-        "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
-        "xsi:schemaLocation": "http://www.imsglobal.org/xsd/ims_qtiasiv1p2 http://www.imsglobal.org/xsd/ims_qtiasiv1p2.xsd"
-    })
+# --- Streamlit Reporting ---
 
-    assessment = ET.SubElement(root, "assessment", {
-        "ident": "quiz001",
-        "title": title
-    })
+class StreamlitProgress(ProgressDisplay):
+    """A progress bar with a status line underneath."""
 
-    section = ET.SubElement(assessment, "section", {
-        "ident": "sec001",
-        "title": "Main Section"
-    })
+    def __init__(self):
+        self._bar = st.progress(0)
+        self._status = st.empty()
 
-    for i, q in enumerate(questions):
-        item = ET.SubElement(section, "item", {
-            "ident": f"q{i+1}",
-            "title": f"Question {i+1}"
-        })
-
-        # Question Text
-        presentation = ET.SubElement(item, "presentation")
-        material = ET.SubElement(presentation, "material")
-        mattext = ET.SubElement(material, "mattext", {"texttype": "text/html"})
-        mattext.text = f"__CDATA_START__{q.question_text}__CDATA_END__"
-
-        # QTI Generation based on Type
-        q_type = q.type.lower().strip()
-
-        if "multiple choice" in q_type or "true/false" in q_type or "true" in q_type:
-            # Response Lid (Single Choice)
-            response_lid = ET.SubElement(presentation, "response_lid", {
-                "ident": f"response_{i+1}",
-                "rcardinality": "Single"
-            })
-            render_choice = ET.SubElement(response_lid, "render_choice")
-
-            if q.options:
-                for j, option in enumerate(q.options):
-                    response_label = ET.SubElement(render_choice, "response_label", {"ident": f"opt_{i+1}_{j}"})
-                    material_opt = ET.SubElement(response_label, "material")
-                    mattext_opt = ET.SubElement(material_opt, "mattext", {"texttype": "text/html"})
-                    mattext_opt.text = f"__CDATA_START__{option}__CDATA_END__"
-
-            # Processing (Correct Answer)
-            if q.correct_answer_index is not None and isinstance(q.correct_answer_index, int):
-                resprocessing = ET.SubElement(item, "resprocessing")
-                outcomes = ET.SubElement(resprocessing, "outcomes")
-                ET.SubElement(outcomes, "decvar", {"defaultval": "0", "varname": "SCORE", "vartype": "Integer"})
-
-                respcondition = ET.SubElement(resprocessing, "respcondition", {"continue": "No"})
-                conditionvar = ET.SubElement(respcondition, "conditionvar")
-                correct_ident = f"opt_{i+1}_{q.correct_answer_index}"
-                varequal = ET.SubElement(conditionvar, "varequal", {"respident": f"response_{i+1}"})
-                varequal.text = correct_ident
-
-                setvar = ET.SubElement(respcondition, "setvar", {"action": "Set", "varname": "SCORE"})
-                setvar.text = "1"
-
-        elif "multiple select" in q_type or "select all" in q_type:
-            # Response Lid (Multiple Choice - Multiple Response)
-            response_lid = ET.SubElement(presentation, "response_lid", {
-                "ident": f"response_{i+1}",
-                "rcardinality": "Multiple"
-            })
-            render_choice = ET.SubElement(response_lid, "render_choice")
-
-            if q.options:
-                for j, option in enumerate(q.options):
-                    response_label = ET.SubElement(render_choice, "response_label", {"ident": f"opt_{i+1}_{j}"})
-                    material_opt = ET.SubElement(response_label, "material")
-                    mattext_opt = ET.SubElement(material_opt, "mattext", {"texttype": "text/html"})
-                    mattext_opt.text = f"__CDATA_START__{option}__CDATA_END__"
-            
-            # Processing (Multiple Correct Answers)
-            if q.correct_answer_index and isinstance(q.correct_answer_index, list):
-                resprocessing = ET.SubElement(item, "resprocessing")
-                outcomes = ET.SubElement(resprocessing, "outcomes")
-                ET.SubElement(outcomes, "decvar", {"defaultval": "0", "varname": "SCORE", "vartype": "Integer"})
-
-                respcondition = ET.SubElement(resprocessing, "respcondition", {"continue": "No"})
-                conditionvar = ET.SubElement(respcondition, "conditionvar")
-                
-                # 'and' block ensuring ALL correct options are selected
-                and_elem = ET.SubElement(conditionvar, "and")
-                for correct_idx in q.correct_answer_index:
-                    varequal = ET.SubElement(and_elem, "varequal", {"respident": f"response_{i+1}"})
-                    varequal.text = f"opt_{i+1}_{correct_idx}"
-
-                setvar = ET.SubElement(respcondition, "setvar", {"action": "Set", "varname": "SCORE"})
-                setvar.text = "1"
-
-        elif "short answer" in q_type or "fill" in q_type:
-            # Render FIB (Fill in Blank)
-            response_str = ET.SubElement(presentation, "response_str", {
-                "ident": f"response_{i+1}",
-                "rcardinality": "Single"
-            })
-            render_fib = ET.SubElement(response_str, "render_fib")
-            # Just a visual box
-            ET.SubElement(render_fib, "response_label", {"ident": f"ans_{i+1}"})
-
-            # Processing
-            if q.correct_answer_text:
-                resprocessing = ET.SubElement(item, "resprocessing")
-                outcomes = ET.SubElement(resprocessing, "outcomes")
-                ET.SubElement(outcomes, "decvar", {"defaultval": "0", "varname": "SCORE", "vartype": "Integer"})
-
-                respcondition = ET.SubElement(resprocessing, "respcondition", {"continue": "No"})
-                conditionvar = ET.SubElement(respcondition, "conditionvar")
-                
-                # Case insensitive match usually preferred for short answer
-                varequal = ET.SubElement(conditionvar, "varequal", {"respident": f"response_{i+1}", "case": "No"})
-                varequal.text = q.correct_answer_text
-
-                setvar = ET.SubElement(respcondition, "setvar", {"action": "Set", "varname": "SCORE"})
-                setvar.text = "1"
-
-        elif "essay" in q_type:
-            # Essay (Response String)
-            response_str = ET.SubElement(presentation, "response_str", {
-                "ident": f"response_{i+1}",
-                "rcardinality": "Single"
-            })
-            render_fib = ET.SubElement(response_str, "render_fib")
-            # Essay usually implies manual grading, so no automatic processing needed often,
-            # but QTI requires resprocessing for completeness usually.
-            resprocessing = ET.SubElement(item, "resprocessing")
-            outcomes = ET.SubElement(resprocessing, "outcomes")
-            ET.SubElement(outcomes, "decvar", {"defaultval": "0", "varname": "SCORE", "vartype": "Integer"})
-            # No automatic scoring condition for essay
+    def update(self, fraction, text):
+        self._bar.progress(fraction)
+        self._status.text(text)
 
-        else:
-            # Fallback for unknown types (Treat as Essay/Open Text to be safe)
-            response_str = ET.SubElement(presentation, "response_str", {
-                "ident": f"response_{i+1}",
-                "rcardinality": "Single"
-            })
-            ET.SubElement(response_str, "render_fib")
+    def close(self):
+        self._status.empty()
+        self._bar.empty()
 
+class StreamlitPreview(PreviewDisplay):
+    """A placeholder that shows the tail of a document as it is written."""
 
-    return ET.tostring(root, encoding='utf-8', xml_declaration=True)
+    def __init__(self):
+        self._placeholder = st.empty()
 
-def generate_qti_zip(quiz_data, title="Generated Quiz"):
-    """Generates a QTI 1.2 Zip package."""
-    try:
-        # 1. Create Manifest
-        manifest_data = create_imsmanifest()
-        
-        # 2. Create Quiz XML
-        questions = [Question(**q) for q in quiz_data['questions']]
-        quiz_xml_raw = create_quiz_xml(questions, title=title)
-        
-        # 3. Post-Process for CDATA
-        # Decode bytes to string for replacement
-        xml_str = quiz_xml_raw.decode('utf-8')
-        # Replace placeholders with actual CDATA tags
-        xml_str = xml_str.replace("__CDATA_START__", "<![CDATA[").replace("__CDATA_END__", "]]>")
-        
-        # Re-encode
-        final_quiz_xml = xml_str.encode('utf-8')
-        
-        # 4. Zip It
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-            zf.writestr("imsmanifest.xml", manifest_data)
-            zf.writestr("quiz.xml", final_quiz_xml)
-            
-        return zip_buffer.getvalue()
-    except Exception as e:
-        st.error(f"Error creating QTI Zip: {e}")
-        return None
+    def show(self, title, text):
+        preview = self._placeholder.container()
+        preview.caption(f"✍️ Writing {title}...")
+        preview.code(text, language="html")
 
-def generate_quiz_json(prompt):
-    """Generates the Quiz JSON data from Gemini."""
-    client = get_gemini_client()
-    if not client: return None
-    
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=prompt,
-            config=types.GenerateContentConfig(response_mime_type='application/json')
-        )
-        return clean_json(response.text)
-    except Exception as e:
-        st.error(f"Error generating quiz JSON: {e}")
-        return None
+    def close(self):
+        self._placeholder.empty()
 
-def generate_quiz_data_batched(topic, subtopic, target_count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text="", context_topics=None):
-    """Generates quiz questions in batches to ensure target count is met."""
-    all_questions = []
-    batch_size = 10
-    # Over-provision: (target // 10) + 2 batches
-    num_batches = (target_count // 10) + 2
-    
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    
-    for i in range(num_batches):
-        status_text.text(f"Generating Batch {i+1}/{num_batches}...")
-        
-        # Construct prompt for this batch
-        # Note: We use batch_size here, not target_count
-        prompt = construct_quiz_prompt(topic, subtopic, batch_size, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text, context_topics)
-        
-        # Generate JSON
-        batch_data = generate_quiz_json(prompt)
-        
-        if batch_data and 'questions' in batch_data:
-            all_questions.extend(batch_data['questions'])
-        
-        # Update progress
-        progress_bar.progress((i + 1) / num_batches)
-        
-        # Early break if we have enough
-        if len(all_questions) >= target_count:
-            break
-            
-    status_text.empty()
-    progress_bar.empty()
-    
-    # Trim to exact count
-    all_questions = all_questions[:target_count]
-    
-    return {"questions": all_questions}
+class StreamlitReporter(Reporter):
+    """Draws pipeline errors, progress and previews on the current page.
 
-def generate_unit_sequence_json(prompt):
-    """Generates the Unit Sequence JSON from Gemini."""
-    client = get_gemini_client()
-    if not client: return None
-    
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=prompt,
-            config=types.GenerateContentConfig(response_mime_type='application/json')
-        )
-        return clean_json(response.text)
-    except Exception as e:
-        st.error(f"Error generating unit sequence: {e}")
-        return None
+    The pipeline's calls reach it on the script thread, which waits for each job (see run_async()).
+    """
 
-def generate_unit_package(sequence_data, topic, grade_level, is_sped, is_gifted, is_ml, language, subject, strategy, source_text, due_date, due_time, points, points_per_question, question_types, standard="General Standard"):
-    """Generates all files for a unit and zips them, including Lesson Plans and Slides for each Assignment."""
-    context_buffer = []
-    zip_buffer = io.BytesIO()
-    
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    total_items = len(sequence_data)
-    
-    # Calculate progress steps: each Assignment has 3 sub-steps (HTML, PDF, PPTX), each Quiz has 1
-    total_steps = sum(3 if item.get('type') == 'Assignment' else 1 for item in sequence_data)
-    current_step = 0
-    
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
-        for i, item in enumerate(sequence_data):
-            idx = i + 1
-            item_type = item.get('type')
-            title = item.get('title', f"Item {idx}")
-            focus = item.get('focus_topic', topic)
-            safe_title = title.replace(" ", "_").replace("/", "-")
-            
-            if item_type == "Assignment":
-                # --- Step 1: Generate Assignment HTML ---
-                status_text.text(f"Generating Assignment {idx}/{total_items}: {title} (HTML)...")
-                prompt = construct_assignment_prompt(topic, focus, "None", due_date, due_time, points, grade_level, is_sped, is_gifted, is_ml, language, subject, strategy, source_text)
-                
-                client = get_gemini_client()
-                if client:
-                    try:
-                        response = client.models.generate_content(
-                            model='gemini-2.0-flash',
-                            contents=prompt
-                        )
-                        html_content = response.text
-                        # Clean markdown code blocks if present
-                        if html_content.startswith("```html"):
-                            html_content = html_content[7:]
-                        if html_content.endswith("```"):
-                            html_content = html_content[:-3]
-                            
-                        zf.writestr(f"{idx:02d}_Assignment_{safe_title}.html", html_content)
-                        context_buffer.append(focus)
-                    except Exception as e:
-                        print(f"Error generating assignment {title}: {e}")
-                
-                current_step += 1
-                progress_bar.progress(current_step / total_steps)
-                
-                # --- Step 2: Generate Lesson Plan PDF (with focus-specific content) ---
-                status_text.text(f"Generating Assignment {idx}/{total_items}: {title} (Lesson Plan)...")
-                lesson_plan_pdf, lesson_plan_text = generate_lesson_plan_pdf(
-                    topic=f"{topic}: {focus}",  # Include subtopic for specificity
-                    standard=standard,
-                    grade=grade_level,
-                    strategy=strategy
-                )
-                
-                if lesson_plan_pdf:
-                    zf.writestr(f"{idx:02d}_LessonPlan_{safe_title}.pdf", lesson_plan_pdf)
-                
-                current_step += 1
-                progress_bar.progress(current_step / total_steps)
-                
-                # --- Step 3: Generate Slide Deck (CHAINED from Lesson Plan to prevent overlap) ---
-                status_text.text(f"Generating Assignment {idx}/{total_items}: {title} (Slides)...")
-                # CRITICAL: Pass lesson_plan_text as source_text to ensure slides are
-                # complementary (keywords only) and don't duplicate lesson plan content
-                slide_deck_pptx = generate_slide_deck(
-                    topic=f"{topic}: {focus}",
-                    grade=grade_level,
-                    strategy=strategy,
-                    source_text=lesson_plan_text if lesson_plan_text else ""
-                )
-                
-                if slide_deck_pptx:
-                    zf.writestr(f"{idx:02d}_Slides_{safe_title}.pptx", slide_deck_pptx)
-                
-                current_step += 1
-                progress_bar.progress(current_step / total_steps)
-                        
-            elif item_type == "Quiz":
-                # Generate Quiz Zip
-                status_text.text(f"Generating Quiz {idx}/{total_items}: {title}...")
-                # Use context_buffer for contextual awareness
-                # Default to 10 questions for unit quizzes
-                quiz_data = generate_quiz_data_batched(topic, focus, 10, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text, context_topics=context_buffer)
-                
-                if quiz_data:
-                    qti_zip = generate_qti_zip(quiz_data, title=title)
-                    if qti_zip:
-                        zf.writestr(f"{idx:02d}_Quiz_{safe_title}.zip", qti_zip)
-                
-                # Clear context after quiz
-                context_buffer = []
-                
-                current_step += 1
-                progress_bar.progress(current_step / total_steps)
-            
-    status_text.empty()
-    progress_bar.empty()
-    return zip_buffer.getvalue()
+    def error(self, message):
+        st.error(message)
+
+    def warning(self, message):
+        st.warning(message)
+
+    def progress(self):
+        return StreamlitProgress()
 
-# --- AI Generation Functions ---
+    def preview(self):
+        return StreamlitPreview()
 
-def get_gemini_client():
+def configure_gemini_from_secrets():
+    """Passes GEMINI_API_KEY (and optional GEMINI_POOL_SIZE) from secrets.toml to the pipeline."""
     try:
         api_key = st.secrets.get("GEMINI_API_KEY")
-        if not api_key:
-            st.error("⚠️ GEMINI_API_KEY not configured in secrets")
-            st.stop()
-        return genai.Client(api_key=api_key)
-    except Exception as e:
-        st.error(f"Failed to initialize Gemini client: {e}")
-        st.stop()
-        return None
+        pool_size = st.secrets.get("GEMINI_POOL_SIZE")
+    except Exception:
+        # No secrets.toml; the pipeline falls back to environment variables
+        return
+    configure_gemini(api_key=api_key, pool_size=int(pool_size) if pool_size else None)
+
+# --- Timing Waterfall ---
+
+# Bar colors by the kind of stage a span measures
+SPAN_COLORS = {"Gemini": "#4C78A8", "Render": "#F58518", "Package": "#54A24B", "Parse": "#B279A2", "Pipeline": "#BAB0AC"}
+
+def span_category(name):
+    if name.startswith("gemini."):
+        return "Gemini"
+    if name.startswith("render."):
+        return "Render"
+    if name.startswith("package."):
+        return "Package"
+    if name == "parse":
+        return "Parse"
+    return "Pipeline"
+
+def show_trace_waterfall(tracer):
+    """Draws the run's spans as a waterfall, with per-stage totals and trace downloads."""
+    rows = tracer.timeline()
+    if not rows:
+        return
+    chart_rows = [{
+        # Numbered so repeated labels stay on their own rows; indented by nesting depth
+        "row": f"{i + 1:03d} {'· ' * row['depth']}{row['label']}",
+        "start": row["start"],
+        "end": row["end"],
+        "seconds": row["seconds"],
+        "stage": span_category(row["name"]),
+        "tokens in": row.get("gen_ai.usage.input_tokens", 0),
+        "tokens out": row.get("gen_ai.usage.output_tokens", 0),
+        "bytes": row.get("output_bytes", 0),
+        "status": row["status"],
+    } for i, row in enumerate(rows)]
+    st.vega_lite_chart({
+        "data": {"values": chart_rows},
+        "mark": "bar",
+        "height": max(120, 18 * len(chart_rows)),
+        "encoding": {
+            "x": {"field": "start", "type": "quantitative", "title": "Seconds from start"},
+            "x2": {"field": "end"},
+            "y": {"field": "row", "type": "nominal", "sort": None, "title": None, "axis": {"labelLimit": 400}},
+            "color": {"field": "stage", "type": "nominal", "scale": {"domain": list(SPAN_COLORS), "range": list(SPAN_COLORS.values())}},
+            "tooltip": [{"field": field} for field in ["row", "seconds", "stage", "tokens in", "tokens out", "bytes", "status"]],
+        },
+    })
+
+    st.dataframe(tracer.summary(), hide_index=True)
+    col_jsonl, col_otlp = st.columns(2)
+    with col_jsonl:
+        st.download_button("📥 Spans (JSONL)", data="".join(span.model_dump_json() + "\n" for span in tracer.finished_spans()),
+                           file_name="trace.jsonl", mime="application/jsonl", key="download_trace_jsonl")
+    with col_otlp:
+        st.download_button("📥 Spans (OpenTelemetry JSON)", data=json.dumps(tracer.to_otlp()),
+                           file_name="trace.otlp.json", mime="application/json", key="download_trace_otlp")
+
+# --- API Connection ---
 
 def check_api_connection():
     """Checks connection to Gemini API."""
@@ -1117,646 +804,9 @@ def check_api_connection():
         st.error("GEMINI_API_KEY not found in secrets.toml")
         return None
 
-def clean_json(text):
-    """Cleans JSON text by removing markdown fences and fixing unescaped backslashes."""
-    text = text.strip()
-    if text.startswith("```json"):
-        text = text[7:]
-    if text.endswith("```"):
-        text = text[:-3]
-    
-    # Fix unescaped backslashes (common in LaTeX)
-    # Find backslashes that are NOT followed by valid escape chars (n, r, t, b, f, u, ", \, /)
-    # and double them up.
-    text = re.sub(r'\\(?![nrtbfu"/\\\\])', r'\\\\', text)
-    
-    return json.loads(text)
-
-def recommend_tool(topic, standard):
-    client = get_gemini_client()
-    if not client: return "None"
-
-    tools_keys = list(STEM_TOOLS.keys())
-    prompt = f"""
-    Given the topic "{topic}" and standard "{standard}", which ONE of these tools is the absolute best match?
-    Options: {tools_keys}
-    
-    Return ONLY the exact dictionary key. If nothing fits perfectly, return "None".
-    """
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=prompt
-        )
-        recommended = response.text.strip()
-        if recommended in tools_keys:
-            return recommended
-        return "None"
-    except Exception as e:
-        st.error(f"Error recommending tool: {e}")
-        return "None"
-
-def generate_unit_outline(topic, num_assignments, num_quizzes):
-    # Safety Default
-    target_standard = locals().get('target_standard') or globals().get('target_standard') or "General Standard"
-    
-    client = get_gemini_client()
-    if not client: return []
-
-    prompt = f"""
-    Create a unit outline for the topic: {topic}.
-    Generate exactly {num_assignments} assignment titles and {num_quizzes} quiz titles.
-    Return a JSON object with a list 'items', where each item has 'type' ('Assignment' or 'Quiz') and 'title'.
-    """
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                response_mime_type='application/json'
-            )
-        )
-        return clean_json(response.text)['items']
-    except Exception as e:
-        st.error(f"Error generating outline: {e}")
-        return []
-
-def generate_lesson_plan_pdf(topic, standard, grade, strategy="None / Standard"):
-    """Generates a High-Design 5E Lesson Plan PDF (Strict One-Page). Returns (pdf_bytes, raw_text)."""
-    # Safety Default
-    target_standard = locals().get('target_standard') or globals().get('target_standard') or "General Standard"
-
-    client = get_gemini_client()
-    if not client: return None, ""
-
-    # 1. AI Generation (Structured JSON)
-    prompt = f"""
-    Create a 5E Lesson Plan for Grade {grade} on "{topic}" (Standard: {standard}).
-    Return a JSON object with this EXACT structure:
-    {{
-        "metadata": {{
-            "duration": "e.g., 60 minutes",
-            "materials": ["item 1", "item 2"],
-            "vocabulary": ["term 1", "term 2"],
-            "differentiation": {{
-                "sped": ["mod 1", "mod 2"],
-                "ml": ["support 1", "support 2"]
-            }}
-        }},
-        "sections": [
-            {{"phase": "Engage", "time": "10 mins", "activity": "Brief description..."}},
-            {{"phase": "Explore", "time": "15 mins", "activity": "Brief description..."}},
-            {{"phase": "Explain", "time": "10 mins", "activity": "Brief description..."}},
-            {{"phase": "Elaborate", "time": "15 mins", "activity": "Independent Practice referencing the {topic} Assignment..."}},
-            {{"phase": "Evaluate", "time": "10 mins", "activity": "Assessment referencing the {topic} Quiz..."}}
-        ]
-    }}
-    Keep descriptions concise (bullet points preferred).
-    """
-    
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=prompt,
-            config=types.GenerateContentConfig(response_mime_type='application/json')
-        )
-        data = clean_json(response.text)
-        
-        # 2. PDF Creation (High-Design Dashboard - Strict One Page)
-        pdf = FPDF(orientation='P', unit='mm', format='Letter')
-        pdf.add_page()
-        pdf.set_auto_page_break(auto=False) # Disable auto page break
-        
-        # Colors
-        header_bg = (30, 36, 58) # Dark Blue
-        sidebar_bg = (240, 244, 248) # Light Grey/Blue
-        text_color = (0, 0, 0)
-        header_text_color = (255, 255, 255)
-        
-        # --- Header (Full Width) ---
-        pdf.set_fill_color(*header_bg)
-        pdf.rect(0, 0, 216, 38, 'F') # 1.5 inch approx 38mm
-        
-        pdf.set_text_color(*header_text_color)
-        pdf.set_font("Helvetica", 'B', 16)
-        pdf.set_xy(10, 10)
-        pdf.cell(0, 8, f"Lesson Plan: {topic}", ln=1)
-        
-        # Strategy (Top Right)
-        pdf.set_xy(120, 10)
-        pdf.set_font("Helvetica", 'I', 10)
-        pdf.cell(86, 8, f"Strategy: {strategy}", ln=1, align='R')
-        
-        pdf.set_font("Helvetica", '', 10)
-        pdf.set_text_color(200, 200, 200) # Light Grey
-        pdf.set_xy(10, 20)
-        pdf.cell(0, 5, f"Grade: {grade}", ln=1)
-        
-        # Truncate Standard
-        std_desc = standard
-        if len(std_desc) > 120:
-            std_desc = std_desc[:117] + "..."
-        pdf.multi_cell(0, 5, f"Standard: {std_desc}")
-        
-        # --- Sidebar (Left 2.5 inches -> 63.5mm) ---
-        sidebar_width = 64
-        pdf.set_fill_color(*sidebar_bg)
-        pdf.rect(0, 38, sidebar_width, 241, 'F')
-        
-        # Sidebar Content
-        pdf.set_text_color(*text_color)
-        y_pos = 45
-        x_pos = 5
-        
-        def sidebar_section(title, items):
-            nonlocal y_pos
-            if y_pos > 250: return # Stop if too low
-            
-            # Step A: Set XY
-            pdf.set_xy(x_pos, y_pos)
-            
-            # Step B: Print Title
-            pdf.set_font("Helvetica", 'B', 9)
-            pdf.cell(50, 5, title.upper(), ln=1)
-            
-            # Step C: Print Content
-            pdf.set_font("Helvetica", '', 8)
-            content_str = ""
-            if isinstance(items, list):
-                for item in items:
-                    content_str += f"- {item}\n"
-            elif isinstance(items, str):
-                content_str = items
-            
-            safe_content = content_str.encode('latin-1', 'replace').decode('latin-1')
-            
-            # Save current Y before printing content? No, we print then check Y.
-            # Actually, we need to set XY for content? No, ln=1 moved us down.
-            # But let's be precise as requested: "Step C: Save the current Y. Print the Content"
-            # The multi_cell handles the printing.
-            pdf.set_xy(x_pos, pdf.get_y()) 
-            pdf.multi_cell(55, 4, safe_content)
-            
-            # Step D: Update current_y
-            y_pos = pdf.get_y() + 10
-
-        sidebar_section("Duration", data['metadata'].get('duration', '60 mins'))
-        sidebar_section("Materials", data['metadata'].get('materials', []))
-        sidebar_section("Vocabulary", data['metadata'].get('vocabulary', []))
-        
-        # Differentiation
-        if y_pos < 250:
-            pdf.set_xy(x_pos, y_pos)
-            pdf.set_font("Helvetica", 'B', 9)
-            pdf.cell(50, 5, "DIFFERENTIATION", ln=1)
-            # Update Y for content
-            y_pos = pdf.get_y()
-            
-            diff = data['metadata'].get('differentiation', {})
-            if diff.get('sped'):
-                pdf.set_xy(x_pos, y_pos)
-                pdf.set_font("Helvetica", 'BI', 8)
-                pdf.cell(50, 4, "SPED:", ln=1)
-                
-                pdf.set_font("Helvetica", '', 8)
-                for item in diff['sped'][:3]: # Limit to 3 items
-                    pdf.set_xy(x_pos, pdf.get_y())
-                    safe_item = f"- {item}".encode('latin-1', 'replace').decode('latin-1')
-                    pdf.multi_cell(55, 4, safe_item)
-                
-                y_pos = pdf.get_y() + 2
-                
-            if diff.get('ml') and y_pos < 250:
-                pdf.set_xy(x_pos, y_pos)
-                pdf.set_font("Helvetica", 'BI', 8)
-                pdf.cell(50, 4, "ML Support:", ln=1)
-                
-                pdf.set_font("Helvetica", '', 8)
-                for item in diff['ml'][:3]: # Limit to 3 items
-                    pdf.set_xy(x_pos, pdf.get_y())
-                    safe_item = f"- {item}".encode('latin-1', 'replace').decode('latin-1')
-                    pdf.multi_cell(55, 4, safe_item)
-                
-                y_pos = pdf.get_y() + 10
-        
-        # --- Main Content (Right Side) ---
-        # Draw Border Line
-        pdf.set_draw_color(200, 200, 200)
-        pdf.line(sidebar_width, 38, sidebar_width, 279)
-        
-        y_pos = 45
-        x_pos = sidebar_width + 10 # 74mm
-        content_width = 130
-        
-        for section in data.get('sections', []):
-            if y_pos > 260: break # Stop if page full
-            
-            pdf.set_xy(x_pos, y_pos)
-            pdf.set_font("Helvetica", 'B', 11)
-            pdf.set_text_color(13, 148, 136) # Teal accent
-            phase = section.get('phase', 'Phase')
-            time = section.get('time', '')
-            pdf.cell(content_width, 6, f"{phase} ({time})", ln=1)
-            y_pos += 6
-            
-            pdf.set_xy(x_pos, y_pos)
-            pdf.set_font("Helvetica", '', 10)
-            pdf.set_text_color(0, 0, 0)
-            activity = section.get('activity', '')
-            
-            # Truncate if too long (approx 400 chars)
-            if len(activity) > 400:
-                activity = activity[:397] + "..."
-                
-            safe_activity = activity.encode('latin-1', 'replace').decode('latin-1')
-            pdf.multi_cell(content_width, 5, safe_activity)
-            y_pos = pdf.get_y() + 6
-            
-            y_pos = pdf.get_y() + 6
-            
-        # pdf.output(dest='S') returns bytearray in fpdf2, convert to bytes
-        pdf_output = pdf.output(dest='S')
-        if isinstance(pdf_output, bytearray):
-            pdf_bytes = bytes(pdf_output)
-        elif isinstance(pdf_output, str):
-            pdf_bytes = pdf_output.encode('latin-1')
-        else:
-            pdf_bytes = pdf_output
-        return pdf_bytes, response.text
-        
-    except Exception as e:
-        st.error(f"Error generating lesson plan: {e}")
-        return None, ""
-
-def generate_slide_deck(topic, grade, strategy="None / Standard", source_text=""):
-    """Generates a 7-slide PowerPoint presentation using Gemini and python-pptx."""
-    # Safety Default
-    target_standard = locals().get('target_standard') or globals().get('target_standard') or "General Standard"
-
-    client = get_gemini_client()
-    if not client: return None
-
-    # Strategy Context
-    strategy_instruction = ""
-    if strategy and strategy != "None / Standard":
-        strategy_instruction = f"""
-        CRITICAL: Include a specific slide titled "{strategy} Activity Instructions".
-        On this slide, provide student-facing directions that align exactly with the {strategy} method.
-        (e.g., if "Station Rotation", list what happens at each station; if "Fishbowl", list the rules for the inner/outer circle).
-        In the Speaker Notes for this slide, provide teacher-facing tips on how to facilitate the activity (e.g., "Set a timer for 10 minutes").
-        """
-    else:
-        strategy_instruction = """
-        Include a slide titled "Practice Activity" with clear student instructions for a standard class activity.
-        """
-
-    # Prompt Logic: Chain vs Scratch
-    if source_text:
-        prompt = f"""
-        ### 1. ROLE
-        Act as an Educational Content Creator specializing in visual presentation design.
-        
-        ### 2. TASK
-        Convert the following Lesson Plan into a 7-slide PowerPoint presentation for Grade {grade}.
-        
-        ### 3. SOURCE MATERIAL (LESSON PLAN)
-        \"\"\"{source_text}\"\"\"
-        
-        ### 4. CRITICAL: NO TEXT OVERLAP RULE
-        The Lesson Plan above contains DETAILED procedural descriptions and activity explanations.
-        Your slides must be COMPLEMENTARY, not duplicative:
-        
-        - Lesson Plan = WHAT students DO (detailed activities, procedures, timing)
-        - Slides = VISUAL ANCHORS (key terms, diagrams to reference, keywords ONLY)
-        - Speaker Notes = VERBAL DELIVERY (what the teacher says, questions to ask, transitions)
-        
-        DO NOT copy or paraphrase text from the lesson plan into the slides.
-        Instead, extract only the KEY VOCABULARY and CONCEPT NAMES as bullet points.
-        
-        ### 5. REQUIREMENTS
-        - Create 7 slides based on the lesson plan content.
-        - {strategy_instruction}
-        - Constraint: Use MAXIMUM 5 bullet points per slide.
-        - Constraint: Use MAXIMUM 8 words per bullet point. Be extremely concise.
-        - Constraint: Move ALL explanations and details into the speaker_notes. The slide text must be keywords only.
-        - Constraint: Bullet points should be KEYWORDS/PHRASES, not sentences from the lesson plan.
-        
-        ### 6. OUTPUT FORMAT
-        Return a JSON object with:
-        - 'slides': list of objects, where each slide has:
-            - 'title': string (Clear and Action-Oriented)
-            - 'bullet_points': list of strings (Max 5 points, Max 8 words each. Keywords only.)
-            - 'speaker_notes': string (Detailed, scripted notes. e.g., "Ask the class: Have you ever seen...?")
-            - 'image_ai_prompt': string (detailed Nano Banana prompt)
-        """
-    else:
-        prompt = f"""
-        Create a 7-slide presentation outline for Grade {grade} on "{topic}".
-        {strategy_instruction}
-        
-        Constraint: Use MAXIMUM 5 bullet points per slide.
-        Constraint: Use MAXIMUM 8 words per bullet point. Be extremely concise.
-        Constraint: Move ALL explanations and details into the speaker_notes. The slide text must be keywords only.
-        
-        Return a JSON object with:
-        - 'slides': list of objects, where each slide has:
-            - 'title': string (Clear and Action-Oriented)
-            - 'bullet_points': list of strings (Max 5 points, Max 8 words each. Keywords only.)
-            - 'speaker_notes': string (Detailed, scripted notes. e.g., "Ask the class: Have you ever seen...?")
-            - 'image_ai_prompt': string (detailed Nano Banana prompt)
-        """
-    
-    try:
-        response = client.models.generate_content(
-            model='gemini-2.0-flash',
-            contents=prompt,
-            config=types.GenerateContentConfig(response_mime_type='application/json')
-        )
-        data = clean_json(response.text)
-        
-        # UNIVERSAL HANDLER: Support List or Dict
-        if isinstance(data, list):
-            slides_data = data
-        elif isinstance(data, dict):
-            # Try every possible key the AI might use
-            slides_data = data.get('slides') or data.get('presentation') or data.get('content') or list(data.values())[0]
-        else:
-            slides_data = []
-            
-        # Safety Check: Ensure it's actually a list
-        if not isinstance(slides_data, list):
-            slides_data = []
-        
-        prs = Presentation()
-        
-        # Helper to add a slide
-        def add_slide_content(prs, title_text, bullets_list, notes_text, ai_prompt, is_first=False):
-            slide_layout = prs.slide_layouts[1] # Title and Content
-            slide = prs.slides.add_slide(slide_layout)
-            
-            # Title
-            if slide.shapes.title:
-                slide.shapes.title.text = title_text
-            
-            # Body Content (Standard Placeholder)
-            if len(slide.placeholders) > 1:
-                content = slide.placeholders[1]
-                content.width = Inches(4.5)
-                content.height = Inches(5.5)
-                content.top = Inches(1.5)
-                
-                tf = content.text_frame
-                tf.word_wrap = True
-                tf.clear() # Clear existing
-                
-                for b in bullets_list:
-                    p = tf.add_paragraph()
-                    p.text = b
-                    p.level = 0
-
-            # Speaker Notes
-            if slide.has_notes_slide:
-                notes_slide = slide.notes_slide
-                text_frame = notes_slide.notes_text_frame
-                text_frame.text = notes_text
-
-            # Slide 1: Pro Tip
-            if is_first:
-                left = Inches(0.5)
-                top = Inches(0.2) # Very top
-                width = Inches(9.0)
-                height = Inches(0.5)
-                
-                tip_box = slide.shapes.add_textbox(left, top, width, height)
-                tf = tip_box.text_frame
-                p = tf.add_paragraph()
-                p.text = "💡 PRO TIP: To style this presentation instantly, click the Design tab and select Designer (or a Theme) to match your classroom style."
-                p.font.size = Pt(11)
-                p.font.color.rgb = RGBColor(100, 100, 100) # Grey
-
-            # Footer: Nano Banana Prompt
-            left = Inches(0.5)
-            top = Inches(7.0)
-            width = Inches(9.0)
-            height = Inches(0.5)
-            
-            disc_box = slide.shapes.add_textbox(left, top, width, height)
-            tf = disc_box.text_frame
-            p = tf.add_paragraph()
-            p.text = f"🍌 Nano Banana Image Prompt: {ai_prompt}"
-            p.font.italic = True
-            p.font.size = Pt(9)
-            p.font.color.rgb = RGBColor(150, 150, 150) # Light Grey
-
-        for i, slide_info in enumerate(slides_data):
-            title = slide_info.get('title', 'Untitled Slide')
-            bullets = slide_info.get('bullet_points', [])
-            notes = slide_info.get('speaker_notes', '')
-            prompt = slide_info.get('image_ai_prompt', f"Image of {topic}")
-            
-            # Split if too many bullets
-            if len(bullets) > 6:
-                # Part 1
-                add_slide_content(prs, f"{title} (Part 1)", bullets[:6], notes, prompt, is_first=(i==0))
-                # Part 2
-                add_slide_content(prs, f"{title} (Part 2)", bullets[6:], notes, prompt, is_first=False)
-            else:
-                add_slide_content(prs, title, bullets, notes, prompt, is_first=(i==0))
-            
-        # Save to buffer
-        pptx_buffer = io.BytesIO()
-        prs.save(pptx_buffer)
-        return pptx_buffer.getvalue()
-        
-    except Exception as e:
-        st.error(f"Error generating slides: {e}")
-        return None
-
-def extract_text_from_file(uploaded_file):
-    """Extracts text from PDF, DOCX, or TXT files."""
-    try:
-        text = ""
-        if uploaded_file.type == "application/pdf":
-            reader = pypdf.PdfReader(uploaded_file)
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
-        elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            doc = docx.Document(uploaded_file)
-            for para in doc.paragraphs:
-                text += para.text + "\n"
-        elif uploaded_file.type == "text/plain":
-            text = uploaded_file.getvalue().decode("utf-8")
-        
-        # Truncate if too long
-        if len(text) > 10000:
-            text = text[:10000] + "\n\n[Text truncated for prompt limit...]"
-            
-        return text
-    except Exception as e:
-        st.error(f"Error reading file: {e}")
-        return ""
-
-
-
-def construct_quiz_prompt(topic, subtopic, count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text="", context_topics=None):
-    # Build Context Strings
-    sped_context = "Include specific accommodations for Special Education (SPED) students." if is_sped else ""
-    gifted_context = "Include extension questions and advanced critical thinking challenges for Gifted/Advanced learners." if is_gifted else ""
-    ml_context = f"Include language supports for Multilingual Learners (primary language: {language})." if is_ml else ""
-
-    # Contextual Awareness for Unit Mode
-    context_instruction = ""
-    if context_topics:
-        topics_str = ", ".join(context_topics)
-        context_instruction = f"CRITICAL: Create a distinct Quiz assessing the following topics covered recently: {topics_str}. Do not re-test older topics."
-
-    # Build Task Constraints
-    task_constraints = ""
-    if is_sped:
-        task_constraints += "Modify reading level to be accessible. Chunk text into smaller sections.\n"
-    if is_gifted:
-        task_constraints += "Include bonus/challenge questions that require higher-order thinking.\n"
-    if is_ml:
-        task_constraints += f"Provide key vocabulary definitions translated into {language}.\n"
-    # Source Material Section (Protected)
-    source_material_section = ""
-    if source_text:
-        source_material_section = f"""
-5. SOURCE MATERIAL
-Use the following text as the primary source for content generation: \"\"\" {source_text} \"\"\"
-"""
-
-    prompt = f"""
-1. ROLE
-Act as an expert Curriculum Designer for Grade {grade_level}.
-
-2. CONTEXT
-I am teaching a unit on "{topic}" (Subtopic: {subtopic}). Student Profile: Mixed ability. {sped_context} {gifted_context} {ml_context}
-
-3. TASK
-Create a Quiz that aligns perfectly with the standard above. {context_instruction} {task_constraints} Generate {count} questions.
-
-XML CONFIGURATION: Set the point value for EVERY question to {points_per_question}. QUESTION TYPES: Generate a mix of ONLY the following types: {question_types}. 
-For "Matching" questions, please format them as Multiple Choice questions (e.g., "Which of the following correctly matches [Term] with [Definition]?").
-METADATA: Include the Due Date ({due_date} {due_time}) in the Quiz Description text.
-
-4. FORMAT
-Return the output as a JSON object matching the following schema: 
-{{ 
-    "questions": [ 
-        {{ 
-            "type": "Multiple Choice" | "Short Answer" | "Essay" | "Multiple Select",
-            "question_text": "string", 
-            "options": ["string", "string"] (Use for Multiple Choice/Select), 
-            "correct_answer_index": int (for Multiple Choice) OR [int, int] (for Multiple Select) OR null (for Essay/Short Answer),
-            "correct_answer_text": "string" (for Short Answer/Fill in Blank only)
-        }} 
-    ] 
-}}
-{source_material_section}
-"""
-    return prompt
-
-def construct_assignment_prompt(topic, subtopic, tool, due_date, due_time, points, grade_level, is_sped, is_gifted, is_ml, language, subject, strategy, source_text=""):
-    tools_str = tool if tool and tool != "None" else "None"
-
-    # Build Context Strings
-    sped_context = "Include specific accommodations for Special Education (SPED) students." if is_sped else ""
-    gifted_context = "Include extension activities and advanced challenges for Gifted/Advanced learners." if is_gifted else ""
-    ml_context = f"Include language supports for Multilingual Learners (primary language: {language})." if is_ml else ""
-    # Subject Specific Logic
-    subject_context = ""
-    iframe_height = "450"
-    if "Business" in subject or "Economics" in subject:
-        subject_context = "Focus on market dynamics, finance, and management scenarios."
-        if "Desmos" in tool or "EconGraphs" in tool:
-            subject_context += ' Create scenarios that require students to shift the curves. Ask them to predict the new Equilibrium Price.'
-            iframe_height = "700"
-    elif "Humanities" in subject or "Arts" in subject:
-        subject_context = "Focus on history, literature, visual arts, and cultural analysis."
-    elif "Technology" in subject or "CS" in subject:
-        subject_context = "Focus on coding, digital literacy, and systems thinking."
-    # Pedagogy
-    pedagogy_section = ""
-    if strategy and strategy != "None / Standard":
-        pedagogy_section = f"""
-5. PEDAGOGY & STRATEGY
-Method: {strategy}
-"""
-
-    # Source Material
-    source_material_section = ""
-    if source_text:
-        source_material_section = f"""
-6. SOURCE MATERIAL
-Use the following text as the primary source for content generation: \"\"\" {source_text} \"\"\"
-"""
-
-    prompt = f"""
-1. ROLE
-Act as an expert Curriculum Designer for Grade {grade_level}.
-
-2. CONTEXT
-I am teaching a unit on "{topic}" (Subtopic: {subtopic}). Subject: {subject} Student Profile: Mixed ability. {sped_context} {gifted_context} {ml_context}
-
-3. TASK
-Create an Assignment that aligns perfectly with the standard above. {subject_context} Tools to embed: {tools_str}
-
-In the HTML output, create a highly visible "Metadata Box" at the top using a styled div that displays: Due Date: {due_date} at {due_time} | Points: {points}.
-
-4. FORMAT
-Return the output as raw HTML code ready for Canvas LMS.
-
-Structure: Title, Introduction, Content, Rubric/Answer Key.
-
-Styling: Use inline CSS for a clean, modern look.
-
-Embeds: Include this tool:
-
-{pedagogy_section} {source_material_section}
-"""
-    return prompt
-
-def construct_unit_prompt(topic, num_assignments, num_quizzes, grade_level, is_sped, is_gifted, is_ml, language, subject, strategy, source_text=""):
-    # Build Context Strings
-    sped_context = "Include specific accommodations for Special Education (SPED) students." if is_sped else ""
-    gifted_context = "Include extension activities and advanced challenges for Gifted/Advanced learners." if is_gifted else ""
-    ml_context = f"Include language supports for Multilingual Learners (primary language: {language})." if is_ml else ""
-    
-    # Source Material
-    source_material_section = ""
-    if source_text:
-        source_material_section = f"""
-### 5. SOURCE MATERIAL
-Use the following text as the primary source for content generation:
-\"\"\" {source_text} \"\"\"
-"""
-    # The Prompt (Note the f""" wrapper!)
-    prompt = f"""
-1. ROLE
-Act as an expert Curriculum Designer for Grade {grade_level}.
-
-2. CONTEXT
-I am planning a comprehensive unit on "{topic}". Subject: {subject} Student Profile: Mixed ability. {sped_context} {gifted_context} {ml_context}
-
-3. TASK
-Create a logical unit sequence mixing {num_assignments} Assignments and {num_quizzes} Quizzes. Instructional Strategy: {strategy} Instruction: Place quizzes after relevant assignments to assess learning. Instruction: Create a mixed sequence (e.g., A, A, Q, A, A, Q). Do NOT group all assignments first.
-
-4. OUTPUT FORMAT
-Return the output as a JSON list of objects. Each object must have:
-
-"type": "Assignment" or "Quiz"
-
-"title": string (Creative title)
-
-"focus_topic": string (Specific subtopic covered)
-
-Example: [ {{ "type": "Assignment", "title": "Intro to Cells", "focus_topic": "Cell Theory" }}, {{ "type": "Quiz", "title": "Cell Theory Check", "focus_topic": "Cell Theory" }} ]
-
-{source_material_section} """
-    return prompt
-
-
+# Route this script run's errors and progress to the page
+set_reporter(StreamlitReporter())
+configure_gemini_from_secrets()
 
 # --- UI ---
 
@@ -1793,9 +843,10 @@ with st.sidebar:
     uploaded_file = st.file_uploader("Attach Source Material (PDF, DOCX, TXT)", type=['pdf', 'docx', 'txt'])
     source_text = ""
     if uploaded_file:
-        with st.spinner("Extracting text..."):
-            source_text = extract_text_from_file(uploaded_file)
-            st.success("File processed!")
+        # Reruns reuse the cached index without a spinner; only a new file is parsed and indexed.
+        # Every prompt then gets the passages about its own topic, from anywhere in the file.
+        source_text = build_source_index(uploaded_file, while_parsing=lambda: st.spinner("Extracting text..."))
+        st.success("File processed!")
             
     subject = st.selectbox("Subject Focus", ["Science", "Math", "English", "Business & Economics", "Humanities & Arts", "Technology & CS", "General"])
     topic = st.text_input("Topic", "Photosynthesis")
@@ -1862,6 +913,18 @@ with st.sidebar:
         # Removed 'Matching' from the options list below
         question_types = st.multiselect("Question Types", options=['Multiple Choice', 'True/False', 'Short Answer', 'Essay', 'Multiple Select'], default=['Multiple Choice'])
 
+    st.divider()
+    st.subheader("AI Responses")
+    # Identical requests are answered from the on-disk response cache unless bypassed
+    use_cache = not st.toggle("Bypass Response Cache", help="Always request fresh content instead of reusing identical earlier generations.")
+    response_cache = get_response_cache()
+    if response_cache:
+        cache_stats = response_cache.stats()
+        st.caption(f"Response cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses ({cache_stats['entries']} stored)")
+    limiter_stats = get_rate_limiter().stats()
+    st.caption(f"API quota: {limiter_stats['queued']} calls queued, mean wait {limiter_stats['mean_wait']:.1f}s (max {limiter_stats['max_wait']:.1f}s), {limiter_stats['throttled']} rate-limit responses")
+    show_timings = st.toggle("Show Timing Waterfall", help="Time every Gemini call, renderer and packaging step of the next generation and chart them.")
+
     st.header("Tools")
     
     # Auto-Detection Logic
@@ -1870,7 +933,7 @@ with st.sidebar:
 
     if st.button("Auto-Select Best Tool"):
         with st.spinner("Finding the best tool..."):
-            recommended = recommend_tool(topic, standard)
+            recommended = recommend_tool(topic, standard, use_cache=use_cache)
             # We check if the recommended tool is valid in general, 
             # but we also need to handle if it's not in the CURRENT subject list.
             if recommended in STEM_TOOLS:
@@ -1908,6 +971,10 @@ with st.sidebar:
 
 # Main Area
 
+# Spans from this run's generation, if timings are requested
+tracer = Tracer() if show_timings else None
+set_tracer(tracer)
+
 if content_type == "Assignment":
     st.header("Assignment Builder")
     
@@ -1934,7 +1001,7 @@ if content_type == "Assignment":
         lp_text = ""
         if include_lesson_plan:
             with st.spinner("Generating Lesson Plan PDF..."):
-                st.session_state['lesson_plan_pdf'], lp_text = generate_lesson_plan_pdf(topic, standard, grade_level, instructional_strategy)
+                st.session_state['lesson_plan_pdf'], lp_text = generate_lesson_plan_pdf(topic, standard, grade_level, instructional_strategy, use_cache=use_cache)
         else:
             st.session_state['lesson_plan_pdf'] = None
 
@@ -1942,7 +1009,7 @@ if content_type == "Assignment":
         if include_slides:
             with st.spinner("Generating PowerPoint Slides..."):
                 # Chain: Pass the Lesson Plan text if available
-                st.session_state['slide_deck_pptx'] = generate_slide_deck(topic, grade_level, instructional_strategy, source_text=lp_text)
+                st.session_state['slide_deck_pptx'] = generate_slide_deck(topic, grade_level, instructional_strategy, source_text=lp_text, use_cache=use_cache)
         else:
             st.session_state['slide_deck_pptx'] = None
         
@@ -1950,8 +1017,13 @@ if content_type == "Assignment":
 
 elif content_type == "Quiz":
     st.header("Quiz Builder")
-    st.markdown("**Select a number of questions (Up to 50):**")
-    question_count = st.number_input("Number of Questions", 1, 50, 5)
+    st.markdown(f"**Select a number of questions (Up to {QUESTION_BANK_MAX_QUESTIONS}):**")
+    question_count = st.number_input("Number of Questions", 1, QUESTION_BANK_MAX_QUESTIONS, 5)
+    # Canvas imports a Question Bank separately from quizzes; large sets are split into parts
+    package_labels = {"quiz": "Quiz", "bank": "Question Bank", "both": "Question Bank + Quiz"}
+    package_as = st.radio("Package As", list(package_labels), format_func=package_labels.get, horizontal=True)
+    if question_count > QTI_MAX_ITEMS_PER_FILE:
+        st.caption(f"More than {QTI_MAX_ITEMS_PER_FILE} questions are split into parts of {QTI_MAX_ITEMS_PER_FILE} so Canvas imports them reliably.")
     
     if st.button("Draft My Mega-Prompt"):
         # 1. Construct Prompt
@@ -1959,11 +1031,14 @@ elif content_type == "Quiz":
         st.session_state['generated_prompt'] = prompt_content
         
         # 2. Generate JSON & Zip (Background)
-        # We use the batched function now
-        quiz_data = generate_quiz_data_batched(topic, subtopic, question_count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text)
+        # We use the batched function now; banks spread their batches across cognitive levels
+        if package_as == "quiz":
+            quiz_data = generate_quiz_data_batched(topic, subtopic, question_count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text, use_cache=use_cache)
+        else:
+            quiz_data = generate_question_bank(topic, subtopic, question_count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text, use_cache=use_cache)
         
         if quiz_data:
-            zip_bytes = generate_qti_zip(quiz_data, title=f"{topic} Quiz")
+            zip_bytes = generate_qti_zip(quiz_data, title=f"{topic} Quiz", package_as=package_as)
             st.session_state['quiz_zip'] = zip_bytes
         else:
             st.session_state['quiz_zip'] = None
@@ -1980,7 +1055,7 @@ elif content_type == "Unit":
         # 1. Generate Sequence
         with st.spinner("Planning Unit Sequence..."):
             prompt = construct_unit_prompt(topic, num_assignments, num_quizzes, grade_level, is_sped, is_gifted, is_ml, language, subject, instructional_strategy, source_text)
-            sequence_data = generate_unit_sequence_json(prompt)
+            sequence_data = generate_unit_sequence_json(prompt, use_cache=use_cache)
             
             # Store the prompt for display
             st.session_state['generated_prompt'] = prompt
@@ -1989,9 +1064,9 @@ elif content_type == "Unit":
             # Display the generated sequence
             st.subheader("📋 Generated Unit Sequence")
             for i, item in enumerate(sequence_data):
-                item_type = item.get('type', 'Unknown')
-                title = item.get('title', f'Item {i+1}')
-                focus = item.get('focus_topic', topic)
+                item_type = item.type
+                title = item.title
+                focus = item.focus_topic or topic
                 icon = "📝" if item_type == "Assignment" else "❓"
                 st.markdown(f"{icon} **{i+1}. {item_type}:** {title} *(Focus: {focus})*")
             
@@ -2003,7 +1078,8 @@ elif content_type == "Unit":
                 unit_zip = generate_unit_package(
                     sequence_data, topic, grade_level, is_sped, is_gifted, is_ml, language, 
                     subject, instructional_strategy, source_text, due_date, due_time, 
-                    points, points_per_question, question_types, standard=standard
+                    points, points_per_question, question_types, standard=standard,
+                    use_cache=use_cache
                 )
                 st.session_state['unit_zip'] = unit_zip
         else:
@@ -2016,6 +1092,9 @@ elif content_type == "Unit":
         st.session_state['slide_deck_pptx'] = None
         st.session_state['quiz_zip'] = None
 
+if tracer and tracer.spans:
+    st.session_state['trace'] = tracer
+
 # Display Results (Persistent)
 if st.session_state['is_generated']:
     st.subheader("Generated Prompt")
@@ -2103,7 +1182,7 @@ if st.session_state['is_generated']:
     if st.session_state.get('quiz_zip'):
         st.download_button(
             label="📦 Download Ready-to-Import Quiz (.zip)",
-            data=st.session_state['quiz_zip'],
+            data=functools.partial(read_package, st.session_state['quiz_zip']),
             file_name=f"{topic.replace(' ', '_')}_Quiz.zip",
             mime="application/zip",
             type="primary"
@@ -2112,9 +1191,12 @@ if st.session_state['is_generated']:
     if st.session_state.get('unit_zip'):
         st.download_button(
             label="📦 Download Full Unit Package (.zip)",
-            data=st.session_state['unit_zip'],
+            data=functools.partial(read_package, st.session_state['unit_zip']),
             file_name=f"Unit_{topic.replace(' ', '_')}.zip",
             mime="application/zip",
             type="primary"
         )
 
+    if show_timings and st.session_state.get('trace'):
+        with st.expander("⏱️ Timing Waterfall", expanded=True):
+            show_trace_waterfall(st.session_state['trace'])
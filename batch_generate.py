@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""Headless bulk generation of Canvas units and quizzes.
+
+Reads a manifest of jobs (CSV with a header row, or a JSON list of objects), generates every
+package across a process pool and writes the archives to an output directory, followed by a
+throughput summary. Each row needs at least a `topic`; every other column is optional:
+
+    kind                unit (default) or quiz
+    topic, subtopic, standard, grade, subject, strategy
+    num_assignments     Assignments per unit (default 5)
+    num_quizzes         Quizzes per unit (default 2)
+    question_count      Questions in a standalone quiz (default 10, up to 1000)
+    package_as          quiz (default), bank (Canvas Question Bank) or both
+    question_types      e.g. "Multiple Choice;True/False" (a list in JSON)
+    points, points_per_question, due_date (YYYY-MM-DD), due_time (HH:MM)
+    is_sped, is_gifted, is_ml, language
+    source_file         PDF, DOCX or TXT source material, relative to the manifest
+    name                Output file name (defaults to the topic)
+
+The API key comes from --api-key or the GEMINI_API_KEY environment variable. With --trace, each
+job also writes its timing spans (Gemini calls, renderers, packaging) next to its package, as
+JSON lines or as OTLP/JSON for OpenTelemetry tools.
+
+    python batch_generate.py units.csv --out build/units --processes 4
+"""
+import argparse
+import concurrent.futures
+import csv
+import datetime
+import json
+import os
+import shutil
+import sys
+import time
+from typing import Optional, List, Literal
+
+from pydantic import BaseModel, Field, ValidationError, field_validator
+
+from content_engine import (
+    Reporter, set_reporter, Tracer, set_tracer, configure_gemini, configure_rate_limits, get_rate_limiter, build_source_index_from_path,
+    configure_source_extraction,
+    GEMINI_REQUESTS_PER_MINUTE, GEMINI_TOKENS_PER_MINUTE,
+    construct_unit_prompt, generate_unit_sequence_json, generate_unit_package,
+    generate_quiz_data_batched, generate_question_bank, generate_qti_zip, QUESTION_BANK_MAX_QUESTIONS,
+)
+
+# --- Manifest ---
+
+class BatchJob(BaseModel):
+    """One row of the manifest. Defaults match the web app's sidebar."""
+    kind: Literal['unit', 'quiz'] = 'unit'
+    topic: str
+    subtopic: str = ""
+    standard: str = "General Standard"
+    grade: str = "10"
+    subject: str = "General"
+    strategy: str = "None / Standard"
+    num_assignments: int = Field(5, ge=1)
+    num_quizzes: int = Field(2, ge=0)
+    question_count: int = Field(10, ge=1, le=QUESTION_BANK_MAX_QUESTIONS)
+    package_as: Literal['quiz', 'bank', 'both'] = 'quiz'
+    question_types: List[str] = ['Multiple Choice']
+    points: int = 100
+    points_per_question: int = 1
+    due_date: datetime.date = Field(default_factory=lambda: datetime.date.today() + datetime.timedelta(days=7))
+    due_time: datetime.time = datetime.time(23, 59)
+    is_sped: bool = False
+    is_gifted: bool = False
+    is_ml: bool = False
+    language: str = "Spanish"
+    source_file: Optional[str] = None
+    name: Optional[str] = None
+
+    @field_validator('question_types', mode='before')
+    @classmethod
+    def split_question_types(cls, value):
+        # CSV cells hold several types separated by semicolons
+        if isinstance(value, str):
+            return [t.strip() for t in value.split(';') if t.strip()]
+        return value
+
+def load_manifest(path):
+    """Reads a CSV or JSON manifest into a list of BatchJob. Raises ValueError naming the bad row."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.json'):
+            rows = json.load(f)
+            if isinstance(rows, dict):
+                rows = rows.get('jobs', [])
+        else:
+            # Blank cells fall back to the defaults
+            rows = [{k.strip(): v for k, v in row.items() if k and v not in (None, '')} for row in csv.DictReader(f)]
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for i, row in enumerate(rows, start=1):
+        try:
+            job = BatchJob.model_validate(row)
+        except ValidationError as e:
+            raise ValueError(f"Manifest row {i}: {e}") from e
+        if job.source_file:
+            job.source_file = os.path.join(base_dir, job.source_file)
+        jobs.append(job)
+    return jobs
+
+# --- Jobs ---
+
+class JobReporter(Reporter):
+    """Prints errors tagged with the job they belong to, and keeps them for the summary."""
+
+    def __init__(self, label):
+        self.label = label
+        self.errors = []
+
+    def error(self, message):
+        self.errors.append(message)
+        print(f"[{self.label}] {message}", file=sys.stderr)
+
+    def warning(self, message):
+        print(f"[{self.label}] {message}", file=sys.stderr)
+
+def init_worker(api_key, requests_per_minute, tokens_per_minute):
+    configure_gemini(api_key=api_key)
+    configure_rate_limits(requests_per_minute, tokens_per_minute)
+    # Jobs already run one per process; don't start another pool per job for large PDFs
+    configure_source_extraction(processes=1)
+
+def output_name(index, job):
+    safe_name = (job.name or job.topic).replace(" ", "_").replace("/", "-")
+    return f"{index:02d}_{job.kind.capitalize()}_{safe_name}.zip"
+
+def write_trace(tracer, path, trace_format):
+    if trace_format == 'otlp':
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(tracer.to_otlp(), f)
+    else:
+        tracer.write_jsonl(path)
+
+def run_job(index, job, out_dir, use_cache=True, trace_format=None):
+    """Generates one package and writes it to `out_dir`. Returns a result dict for the summary."""
+    reporter = JobReporter(f"{index:02d} {job.topic}")
+    set_reporter(reporter)
+    tracer = Tracer() if trace_format else None
+    set_tracer(tracer)
+    limiter_before = get_rate_limiter().stats()
+    start = time.perf_counter()
+    result = {'index': index, 'kind': job.kind, 'topic': job.topic, 'status': 'failed', 'output': None, 'bytes': 0}
+
+    try:
+        source_text = build_source_index_from_path(job.source_file) if job.source_file else ""
+
+        package = None
+        if job.kind == 'unit':
+            prompt = construct_unit_prompt(job.topic, job.num_assignments, job.num_quizzes, job.grade, job.is_sped, job.is_gifted, job.is_ml, job.language, job.subject, job.strategy, source_text)
+            sequence_data = generate_unit_sequence_json(prompt, use_cache=use_cache)
+            if sequence_data:
+                result['items'] = len(sequence_data)
+                package = generate_unit_package(
+                    sequence_data, job.topic, job.grade, job.is_sped, job.is_gifted, job.is_ml, job.language,
+                    job.subject, job.strategy, source_text, job.due_date, job.due_time,
+                    job.points, job.points_per_question, job.question_types, standard=job.standard,
+                    use_cache=use_cache, stream_preview=False,
+                    on_manifest=lambda manifest: result.update(files=manifest.counts)
+                )
+        else:
+            generate = generate_quiz_data_batched if job.package_as == 'quiz' else generate_question_bank
+            quiz_data = generate(job.topic, job.subtopic or job.topic, job.question_count, job.due_date, job.due_time, job.points_per_question, job.question_types, job.grade, job.is_sped, job.is_gifted, job.is_ml, job.language, source_text, show_progress=False, use_cache=use_cache)
+            result['items'] = len(quiz_data.questions)
+            if quiz_data.questions:
+                package = generate_qti_zip(quiz_data, title=f"{job.topic} Quiz", package_as=job.package_as)
+
+        if package:
+            output = os.path.join(out_dir, output_name(index, job))
+            with open(output, 'wb') as f:
+                shutil.copyfileobj(package, f)
+            package.close()
+            result.update(status='ok', output=output, bytes=os.path.getsize(output))
+    except Exception as e:
+        reporter.error(f"Job failed: {e}")
+
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    limiter_after = get_rate_limiter().stats()
+    result['api_calls'] = limiter_after['calls'] - limiter_before['calls']
+    result['quota_wait_seconds'] = round(limiter_after['total_wait'] - limiter_before['total_wait'], 3)
+    result['rate_limited'] = limiter_after['throttled'] - limiter_before['throttled']
+    result['errors'] = reporter.errors
+    if tracer:
+        trace_path = os.path.join(out_dir, os.path.splitext(output_name(index, job))[0] + ('.trace.json' if trace_format == 'otlp' else '.trace.jsonl'))
+        write_trace(tracer, trace_path, trace_format)
+        result['trace'] = trace_path
+        result['stages'] = {row['name']: round(row['seconds'], 3) for row in tracer.summary()}
+    return result
+
+# --- Runner ---
+
+def run_batch(jobs, out_dir, processes, use_cache=True, api_key=None, requests_per_minute=GEMINI_REQUESTS_PER_MINUTE, tokens_per_minute=GEMINI_TOKENS_PER_MINUTE, trace_format=None):
+    """Runs every job across a process pool, printing a line as each one finishes. Returns the summary dict.
+
+    The API quota is split evenly between the processes, each of which rate-limits its own calls.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    results = []
+    start = time.perf_counter()
+    quota = (api_key, requests_per_minute / processes, tokens_per_minute / processes)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=quota) as executor:
+        futures = [executor.submit(run_job, i, job, out_dir, use_cache, trace_format) for i, job in enumerate(jobs, start=1)]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results.append(result)
+            files = result.get('files')
+            file_note = f" [{files['retried']} retried, {files['degraded']} degraded, {files['failed']} missing]" if files and (files['retried'] or files['degraded'] or files['failed']) else ""
+            print(f"[{len(results)}/{len(jobs)}] {result['status']:<6} {result['seconds']:7.1f}s  {result['topic']} ({result['kind']})"
+                  + (f" -> {result['output']}" if result['output'] else "") + file_note, flush=True)
+
+    wall = time.perf_counter() - start
+    results.sort(key=lambda r: r['index'])
+    succeeded = [r for r in results if r['status'] == 'ok']
+    busy = sum(r['seconds'] for r in results)
+    return {
+        'jobs': len(results),
+        'succeeded': len(succeeded),
+        'failed': len(results) - len(succeeded),
+        'processes': processes,
+        'wall_seconds': round(wall, 3),
+        'jobs_per_minute': round(len(succeeded) / wall * 60, 2) if wall else 0.0,
+        'mean_job_seconds': round(busy / len(results), 3) if results else 0.0,
+        'parallelism': round(busy / wall, 2) if wall else 0.0,
+        'bytes_written': sum(r['bytes'] for r in succeeded),
+        'api_calls': sum(r['api_calls'] for r in results),
+        'quota_wait_seconds': round(sum(r['quota_wait_seconds'] for r in results), 3),
+        'rate_limited': sum(r['rate_limited'] for r in results),
+        'results': results,
+    }
+
+def print_summary(summary):
+    print()
+    print(f"Jobs:        {summary['succeeded']}/{summary['jobs']} succeeded, {summary['failed']} failed")
+    print(f"Wall time:   {summary['wall_seconds']:.1f}s across {summary['processes']} processes "
+          f"(effective parallelism {summary['parallelism']:.1f}x)")
+    print(f"Throughput:  {summary['jobs_per_minute']:.1f} packages/min, {summary['mean_job_seconds']:.1f}s mean per job")
+    print(f"Written:     {summary['bytes_written'] / (1024 * 1024):.1f} MB")
+    print(f"API calls:   {summary['api_calls']}, {summary['quota_wait_seconds']:.1f}s queued for quota, {summary['rate_limited']} rate-limit responses")
+    for r in summary['results']:
+        if r['status'] != 'ok':
+            print(f"  FAILED {r['index']:02d} {r['topic']}: {r['errors'][-1] if r['errors'] else 'no package produced'}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Canvas units and quizzes in bulk from a CSV or JSON manifest.")
+    parser.add_argument('manifest', help="CSV or JSON manifest of jobs")
+    parser.add_argument('--out', default='output', help="Directory for the generated packages (default: output)")
+    parser.add_argument('--processes', type=int, default=min(4, os.cpu_count() or 1), help="Jobs run at the same time (default: up to 4)")
+    parser.add_argument('--no-cache', action='store_true', help="Bypass the response cache")
+    parser.add_argument('--api-key', default=None, help="Gemini API key (default: GEMINI_API_KEY)")
+    parser.add_argument('--rpm', type=float, default=float(os.environ.get("GEMINI_RPM") or GEMINI_REQUESTS_PER_MINUTE), help="API requests per minute shared by all processes")
+    parser.add_argument('--tpm', type=float, default=float(os.environ.get("GEMINI_TPM") or GEMINI_TOKENS_PER_MINUTE), help="API tokens per minute shared by all processes")
+    parser.add_argument('--trace', choices=['jsonl', 'otlp'], default=None, help="Write each job's timing spans next to its package")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = load_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        print(f"Could not read manifest: {e}", file=sys.stderr)
+        return 2
+    if not jobs:
+        print("Manifest has no jobs.", file=sys.stderr)
+        return 2
+    if not (args.api_key or os.environ.get("GEMINI_API_KEY")):
+        print("⚠️ GEMINI_API_KEY not configured (set the environment variable or pass --api-key)", file=sys.stderr)
+        return 2
+
+    print(f"Generating {len(jobs)} packages with {args.processes} processes into {args.out}/")
+    summary = run_batch(jobs, args.out, max(1, args.processes), use_cache=not args.no_cache, api_key=args.api_key,
+                        requests_per_minute=args.rpm, tokens_per_minute=args.tpm, trace_format=args.trace)
+    with open(os.path.join(args.out, 'summary.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+    print_summary(summary)
+    return 0 if summary['failed'] == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""Per-call overhead of building a new genai.Client vs. reusing the shared pooled client.
+
+Runs the same generate_content call against a local HTTP stand-in, first constructing a fresh
+client for every call (the old get_gemini_client() behaviour), then through
+content_engine.get_shared_gemini_client(). Reports mean/p50/p95 latency per call and how many TCP
+connections the server saw. The stand-in speaks plain HTTP, so the savings shown here exclude
+the TLS handshake that real Gemini calls also avoid.
+
+    python benchmarks/bench_gemini_client.py --calls 200 --threads 4
+"""
+import argparse
+import concurrent.futures
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google import genai
+from google.genai import types
+
+import content_engine
+from fake_gemini import FakeGeminiServer
+
+API_KEY = "benchmark-key"
+
+
+def fresh_client(base_url):
+    return genai.Client(api_key=API_KEY, http_options=types.HttpOptions(base_url=base_url))
+
+
+def shared_client(base_url):
+    return content_engine.get_shared_gemini_client(API_KEY, base_url=base_url)
+
+
+def run(get_client, base_url, calls, threads):
+    def one_call(_):
+        start = time.perf_counter()
+        client = get_client(base_url)
+        client.models.generate_content(model="gemini-2.0-flash", contents="ping")
+        return time.perf_counter() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(one_call, range(calls)))
+
+
+def summarize(name, timings, server):
+    timings_ms = sorted(t * 1000 for t in timings)
+    p95 = timings_ms[int(len(timings_ms) * 0.95) - 1]
+    print(f"{name:<22} mean {statistics.mean(timings_ms):7.2f} ms  p50 {statistics.median(timings_ms):7.2f} ms  "
+          f"p95 {p95:7.2f} ms  requests {server.requests:4d}  connections {server.connections:4d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    with FakeGeminiServer() as server:
+        # Warm up imports and the shared client so neither side pays one-off costs
+        run(shared_client, server.base_url, 5, 1)
+        run(fresh_client, server.base_url, 5, 1)
+
+        server.reset_counters()
+        summarize("new client per call", run(fresh_client, server.base_url, args.calls, args.threads), server)
+
+        server.reset_counters()
+        summarize("shared pooled client", run(shared_client, server.base_url, args.calls, args.threads), server)
+
+
+if __name__ == "__main__":
+    main()
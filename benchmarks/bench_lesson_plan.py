@@ -0,0 +1,63 @@
+"""Lesson plan PDF rendering throughput, in plans per second.
+
+Renders realistic lesson plans (the fake Gemini backend's canned 5E plans) three ways:
+
+    multi_cell   the compiled template, but wrapping text with FPDF.multi_cell() as before
+    single       render_lesson_plan_pdf() once per plan
+    batch        render_lesson_plan_pdfs() over the raw JSON payloads, validation included
+
+Reported per mode: seconds for --plans plans (best of --repeat runs), plans/s and ms per plan.
+
+    python benchmarks/bench_lesson_plan.py --plans 200
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import content_engine
+from fake_gemini import CannedResponses
+
+TOPIC = "Photosynthesis"
+STANDARD = "NGSS HS-LS1-5: Use a model to illustrate how photosynthesis transforms light energy into stored chemical energy."
+GRADE = "10"
+STRATEGY = "Inquiry-Based Learning"
+
+
+def best_time(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--plans", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    canned = CannedResponses(args.seed)
+    payloads = [canned.lesson_plan() for _ in range(args.plans)]
+    plans = [content_engine.LessonPlan.model_validate_json(payload) for payload in payloads]
+    batch = [{"plan": payload, "topic": TOPIC, "standard": STANDARD, "grade": GRADE, "strategy": STRATEGY} for payload in payloads]
+    reference = content_engine.LessonPlanTemplate(direct_lines=False)
+
+    modes = (
+        ("multi_cell", lambda: [reference.render(plan, TOPIC, STANDARD, GRADE, STRATEGY) for plan in plans]),
+        ("single", lambda: [content_engine.render_lesson_plan_pdf(plan, TOPIC, STANDARD, GRADE, STRATEGY) for plan in plans]),
+        ("batch", lambda: content_engine.render_lesson_plan_pdfs(batch)),
+    )
+    for name, fn in modes:
+        seconds = best_time(fn, args.repeat)
+        print(f"{args.plans:>5} plans  {name:<10} {seconds:7.3f}s  {args.plans / seconds:8.1f} plans/s  "
+              f"{seconds / args.plans * 1000:7.2f} ms/plan", flush=True)
+
+
+if __name__ == "__main__":
+    main()
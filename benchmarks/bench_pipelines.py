@@ -0,0 +1,224 @@
+"""End-to-end timings of the generation pipelines against the local fake Gemini backend.
+
+Runs the real code paths through the real client, rate limiter and response cache, with the API
+served by fake_gemini.FakeGeminiServer:
+
+    quiz_5 / quiz_25 / quiz_50        generate_quiz_data_batched() + generate_qti_zip()
+    unit_small / unit_medium / unit_max
+                                      unit sequence + generate_unit_package() for 2+1, 5+2 and
+                                      10+5 Assignments+Quizzes (the app's default and maximum)
+    assignment                        the Assignment builder: prompt, Lesson Plan PDF and Slides
+
+Each scenario runs in a fresh process, so peak RSS is its own. Reported per scenario: wall time,
+API calls and tokens served, CPU time spent rendering (PDF, PPTX and QTI XML, measured per thread)
+and peak RSS. With --source, every prompt also carries passages from that document, and prompt
+tokens sent versus served from Gemini's context cache show what caching saves (compare a run with
+--no-context-cache). Results can be saved as a JSON baseline and later runs compared against it:
+
+    python benchmarks/bench_pipelines.py --profile fast --save benchmarks/baselines/pipelines-fast.json
+    python benchmarks/bench_pipelines.py --profile fast --compare benchmarks/baselines/pipelines-fast.json
+    python benchmarks/bench_pipelines.py --scenarios quiz_50 unit_medium --source textbook.pdf
+"""
+import argparse
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_gemini import FakeGeminiServer, CannedResponses, latency_profile
+
+SCENARIOS = ["quiz_5", "quiz_25", "quiz_50", "unit_small", "unit_medium", "unit_max", "assignment"]
+
+UNIT_SIZES = {"unit_small": (2, 1), "unit_medium": (5, 2), "unit_max": (10, 5)}
+
+# Metrics checked by --compare; the scenario regresses if any grows by more than --tolerance
+COMPARED_METRICS = ["wall_seconds", "api_calls", "render_cpu_seconds", "peak_rss_mb"]
+
+TOPIC = "Photosynthesis"
+GRADE = "10"
+STANDARD = "NGSS HS-LS1-5"
+STRATEGY = "Inquiry-Based Learning"
+QUESTION_TYPES = ["Multiple Choice", "True/False", "Short Answer"]
+
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _time_rendering(engine, names):
+    """Wraps the named content_engine functions to add up the CPU time spent inside them."""
+    totals = {name: 0.0 for name in names}
+    lock = threading.Lock()
+
+    for name in names:
+        original = getattr(engine, name)
+
+        def timed(*args, __original=original, __name=name, **kwargs):
+            start = time.thread_time()
+            try:
+                return __original(*args, **kwargs)
+            finally:
+                with lock:
+                    totals[__name] += time.thread_time() - start
+
+        setattr(engine, name, timed)
+    return totals
+
+
+def run_scenario(name, base_url, source=None, context_cache=True):
+    """Runs one scenario in this (fresh) process and returns its client-side metrics."""
+    import content_engine as engine
+
+    engine.configure_gemini(api_key="benchmark-key", base_url=base_url)
+    engine.configure_context_cache(enabled=context_cache)
+    # Measure the pipeline, not the default quota
+    engine.configure_rate_limits(requests_per_minute=1_000_000, tokens_per_minute=1_000_000_000)
+    cache_dir = tempfile.mkdtemp(prefix="bench-cache-")
+    engine.RESPONSE_CACHE_PATH = os.path.join(cache_dir, "responses.sqlite3")
+    # Every run plans quiz batches from scratch, not from yields recorded by earlier runs
+    engine.QUIZ_YIELD_PATH = os.path.join(cache_dir, "quiz_yield.sqlite3")
+    render_cpu = _time_rendering(engine, ["render_lesson_plan_pdf", "render_slide_deck", "write_quiz_xml"])
+
+    source_text = engine.build_source_index_from_path(source) if source else ""
+    due_date = datetime.date.today() + datetime.timedelta(days=7)
+    due_time = datetime.time(23, 59)
+    baseline_rss = _peak_rss_mb()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    details = {}
+
+    if name.startswith("quiz_"):
+        count = int(name.split("_")[1])
+        quiz = engine.generate_quiz_data_batched(TOPIC, "Light-dependent reactions", count, due_date, due_time, 1, QUESTION_TYPES, GRADE, False, False, False, "Spanish", source_text, show_progress=False, use_cache=False)
+        package = engine.generate_qti_zip(quiz, title=f"{TOPIC} Quiz")
+        details["questions"] = len(quiz.questions)
+        details["output_bytes"] = len(engine.read_package(package))
+    elif name in UNIT_SIZES:
+        assignments, quizzes = UNIT_SIZES[name]
+        prompt = engine.construct_unit_prompt(TOPIC, assignments, quizzes, GRADE, False, False, False, "Spanish", "Science", STRATEGY, source_text)
+        sequence = engine.generate_unit_sequence_json(prompt, use_cache=False)
+        manifests = []
+        package = engine.generate_unit_package(sequence, TOPIC, GRADE, False, False, False, "Spanish", "Science", STRATEGY, source_text, due_date, due_time, 100, 1, QUESTION_TYPES, standard=STANDARD, use_cache=False, on_manifest=manifests.append)
+        details["items"] = len(sequence)
+        details["files"] = manifests[0].counts
+        details["output_bytes"] = len(engine.read_package(package))
+    elif name == "assignment":
+        engine.construct_assignment_prompt(TOPIC, "Light-dependent reactions", "None", due_date, due_time, 100, GRADE, False, False, False, "Spanish", "Science", STRATEGY, source_text)
+        pdf_bytes, lesson_plan_text = engine.generate_lesson_plan_pdf(TOPIC, STANDARD, GRADE, STRATEGY, use_cache=False)
+        pptx_bytes = engine.generate_slide_deck(TOPIC, GRADE, STRATEGY, source_text=lesson_plan_text, use_cache=False)
+        details["output_bytes"] = len(pdf_bytes or b"") + len(pptx_bytes or b"")
+    else:
+        raise ValueError(f"Unknown scenario {name!r}")
+
+    wall = time.perf_counter() - start
+    return {
+        "wall_seconds": round(wall, 3),
+        "client_cpu_seconds": round(time.process_time() - cpu_start, 3),
+        "render_cpu_seconds": round(sum(render_cpu.values()), 4),
+        "render_cpu_breakdown": {k: round(v, 4) for k, v in render_cpu.items()},
+        "baseline_rss_mb": round(baseline_rss, 1),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "quota_wait_seconds": round(engine.get_rate_limiter().stats()["total_wait"], 3),
+        **details,
+    }
+
+
+def run_all(scenarios, profile, seed=0, source=None, context_cache=True):
+    results = {}
+    with FakeGeminiServer(respond=CannedResponses(seed), **latency_profile(profile, seed)) as server:
+        context = multiprocessing.get_context("spawn")
+        for name in scenarios:
+            server.reset_counters()
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                metrics = executor.submit(run_scenario, name, server.base_url, source, context_cache).result()
+            counters = server.counters()
+            metrics["api_calls"] = counters["requests"]
+            metrics["streamed_calls"] = counters["stream_requests"]
+            metrics["output_tokens"] = counters["output_tokens"]
+            metrics["prompt_tokens"] = counters["prompt_tokens"]
+            metrics["cached_prompt_tokens"] = counters["cached_prompt_tokens"]
+            results[name] = metrics
+            print(f"{name:<12} wall {metrics['wall_seconds']:7.2f}s  calls {metrics['api_calls']:4d}  "
+                  f"render cpu {metrics['render_cpu_seconds']:6.3f}s  client cpu {metrics['client_cpu_seconds']:6.2f}s  "
+                  f"peak rss {metrics['peak_rss_mb']:6.1f} MB  prompt tokens {metrics['prompt_tokens']:7d} "
+                  f"(+{metrics['cached_prompt_tokens']} cached)", flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Prints each compared metric against the baseline. Returns the list of regressions."""
+    regressions = []
+    for name, metrics in results.items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = base.get(metric), metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            flag = "REGRESSION" if change > tolerance else ""
+            print(f"  {name:<12} {metric:<20} {old:>10} -> {new:<10} {change:+7.1%} {flag}")
+            if flag:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", default="fast", choices=["instant", "fast", "realistic"], help="Fake backend latency profile")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--source", help="PDF, DOCX or TXT source material for every prompt")
+    parser.add_argument("--no-context-cache", action="store_true", help="Send shared prompt prefixes with every call")
+    parser.add_argument("--save", help="Write the results to this JSON baseline file")
+    parser.add_argument("--compare", help="Compare against this JSON baseline; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative growth before a metric counts as a regression")
+    args = parser.parse_args()
+
+    source = os.path.abspath(args.source) if args.source else None
+    results = run_all(args.scenarios, args.profile, args.seed, source, not args.no_context_cache)
+    report = {
+        "profile": args.profile,
+        "seed": args.seed,
+        "source": args.source,
+        "context_cache": not args.no_context_cache,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scenarios": results,
+    }
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("profile") != args.profile:
+            print(f"Warning: baseline was recorded with profile {baseline.get('profile')!r}, not {args.profile!r}")
+        print(f"Compared with {args.compare} (tolerance {args.tolerance:.0%}):")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s)")
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
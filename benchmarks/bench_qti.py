@@ -0,0 +1,76 @@
+"""Throughput of QTI quiz packaging for large question banks.
+
+Builds banks of 1k-10k questions (realistic text, mixed question types, from the fake Gemini
+backend's canned quizzes) and times, for each size:
+
+    xml       create_quiz_xml(): the whole quiz.xml as bytes in memory
+    package   generate_qti_zip(): quiz.xml streamed straight into the compressed archive member
+
+Reported per size: seconds (best of --repeat runs), items/s, MB/s of XML, archive size and the
+peak Python memory allocated during one run (measured in a separate, untimed run).
+
+    python benchmarks/bench_qti.py --sizes 1000 2000 5000 10000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import content_engine
+from fake_gemini import CannedResponses
+
+QUESTION_TYPES = ["Multiple Choice", "True/False", "Multiple Choice", "Short Answer", "Multiple Select", "Essay"]
+
+
+def question_bank(size, seed=0):
+    quiz = content_engine.Quiz.model_validate_json(CannedResponses(seed).quiz(size))
+    for i, question in enumerate(quiz.questions):
+        if QUESTION_TYPES[i % len(QUESTION_TYPES)] == "Multiple Select" and question.options:
+            question.type = "Multiple Select"
+            question.correct_answer_index = [0, len(question.options) - 1]
+        elif QUESTION_TYPES[i % len(QUESTION_TYPES)] == "Essay":
+            question.type = "Essay"
+    return quiz
+
+
+def best_time(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def peak_memory_mb(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000, 5000, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        quiz = question_bank(size)
+        xml_bytes = len(content_engine.create_quiz_xml(quiz.questions))
+        archive_bytes = len(content_engine.read_package(content_engine.generate_qti_zip(quiz)))
+        for name, fn in (("xml", lambda: content_engine.create_quiz_xml(quiz.questions)),
+                         ("package", lambda: content_engine.generate_qti_zip(quiz).close())):
+            seconds = best_time(fn, args.repeat)
+            print(f"{size:>6} items  {name:<8} {seconds:7.3f}s  {size / seconds:9.0f} items/s  "
+                  f"{xml_bytes / (1024 * 1024) / seconds:6.1f} MB/s  xml {xml_bytes / (1024 * 1024):6.1f} MB  "
+                  f"zip {archive_bytes / (1024 * 1024):5.1f} MB  peak mem {peak_memory_mb(fn):6.1f} MB", flush=True)
+
+
+if __name__ == "__main__":
+    main()
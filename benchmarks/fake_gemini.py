@@ -0,0 +1,373 @@
+"""Local HTTP stand-in for the Gemini REST API, used by the benchmarks.
+
+Serves `POST /v1beta/models/<model>:generateContent` and `:streamGenerateContent` (server-sent
+events) over HTTP/1.1 keep-alive, and counts requests, distinct TCP connections and tokens served,
+so client-side overhead and whole pipelines can be measured without network access or an API key.
+Context caching (`POST /v1beta/cachedContents`, `DELETE /v1beta/cachedContents/<id>` and
+`cachedContent` in requests) is supported unless disabled, counting the prompt tokens that were
+referred to by handle instead of being sent again.
+
+Each response waits `latency` seconds (a number, or a callable drawing from a distribution) before
+the first token, then is paced at `tokens_per_second` if set. `canned_response()` answers the
+app's prompts (quizzes, lesson plans, slides, unit sequences, Assignments) with realistic content.
+"""
+import json
+import math
+import random
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Tokens per streamed chunk; Gemini sends a few dozen tokens at a time
+STREAM_CHUNK_TOKENS = 24
+
+
+def estimate_tokens(text):
+    return max(1, math.ceil(len(text) / 4))
+
+
+def gemini_response(text, prompt_tokens=10, final=True, cached_tokens=0):
+    """Builds a minimal generateContent response body for `text`. `prompt_tokens` includes the
+    `cached_tokens` that came from a cached prefix."""
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}}
+    body = {"candidates": [candidate]}
+    if final:
+        candidate["finishReason"] = "STOP"
+        output_tokens = estimate_tokens(text)
+        body["usageMetadata"] = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens,
+                                 "totalTokenCount": prompt_tokens + output_tokens}
+        if cached_tokens:
+            body["usageMetadata"]["cachedContentTokenCount"] = cached_tokens
+    return body
+
+
+def prompt_text(body):
+    """The text of the user messages in a generateContent (or cachedContents) request body."""
+    try:
+        return "".join(part.get("text", "") for content in body["contents"] for part in content.get("parts", []))
+    except (KeyError, TypeError, AttributeError):
+        return ""
+
+
+def error_body(code, status, message):
+    return json.dumps({"error": {"code": code, "message": message, "status": status}}).encode("utf-8")
+
+
+# --- Latency distributions (each returns a callable giving seconds) ---
+
+def fixed(seconds):
+    return lambda: seconds
+
+
+def uniform(low, high, seed=0):
+    rng = random.Random(seed)
+    return lambda: rng.uniform(low, high)
+
+
+def lognormal(median, sigma, seed=0):
+    """Right-skewed latency with the given median, like real API time-to-first-token."""
+    rng = random.Random(seed)
+    return lambda: rng.lognormvariate(math.log(median), sigma)
+
+
+def latency_profile(name, seed=0):
+    """Keyword arguments for FakeGeminiServer for a named backend profile."""
+    profiles = {
+        # No waiting at all: measures pure client, parsing and rendering cost
+        "instant": dict(latency=0.0, tokens_per_second=None),
+        # A quick backend, so whole-pipeline benchmarks stay short
+        "fast": dict(latency=lognormal(0.15, 0.3, seed), tokens_per_second=2000),
+        # Roughly what gemini-2.0-flash looks like from a classroom network
+        "realistic": dict(latency=lognormal(0.6, 0.35, seed), tokens_per_second=250),
+    }
+    return profiles[name]
+
+
+# --- Canned responses ---
+
+_WORDS = (
+    "energy cell light water carbon oxygen glucose plant leaf root membrane enzyme protein molecule "
+    "reaction process system structure function cycle model evidence claim data graph variable "
+    "experiment result pattern force motion mass wave signal current circuit atom element compound "
+    "mixture solution density pressure climate ecosystem species population habitat adaptation trait "
+    "gene inherit mutation organism tissue organ nutrient producer consumer decomposer chain web "
+    "stability change rate scale proportion quantity measure compare contrast explain predict analyze"
+).split()
+
+
+class CannedResponses:
+    """Answers the app's prompts with well-formed, realistically sized content.
+
+    Quiz questions are unique across the whole run (so deduplication does not discard them), and
+    `seed` makes the content repeatable.
+    """
+
+    def __init__(self, seed=0, assignment_chars=9000):
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._question_serial = 0
+        self.assignment_chars = assignment_chars
+
+    def _words(self, n):
+        with self._lock:
+            return " ".join(self._rng.choice(_WORDS) for _ in range(n))
+
+    def __call__(self, body):
+        prompt = prompt_text(body)
+        match = re.search(r"mixing (\d+) Assignments and (\d+) Quizzes", prompt)
+        if match:
+            return self.unit_sequence(int(match.group(1)), int(match.group(2)))
+        match = re.search(r"Generate (\d+) questions", prompt)
+        if match:
+            return self.quiz(int(match.group(1)))
+        if "5E Lesson Plan" in prompt:
+            return self.lesson_plan()
+        if "slide" in prompt.lower() and "presentation" in prompt.lower():
+            return self.slides()
+        if "ONE of these tools" in prompt:
+            return "None"
+        return self.assignment()
+
+    def unit_sequence(self, assignments, quizzes):
+        items = []
+        every = max(1, math.ceil(assignments / max(1, quizzes)))
+        made_quizzes = 0
+        for i in range(assignments):
+            items.append({"type": "Assignment", "title": f"Investigation {i + 1}: {self._words(3).title()}", "focus_topic": self._words(4)})
+            if (i + 1) % every == 0 and made_quizzes < quizzes:
+                made_quizzes += 1
+                items.append({"type": "Quiz", "title": f"Checkpoint Quiz {made_quizzes}", "focus_topic": self._words(3)})
+        while made_quizzes < quizzes:
+            made_quizzes += 1
+            items.append({"type": "Quiz", "title": f"Checkpoint Quiz {made_quizzes}", "focus_topic": self._words(3)})
+        return json.dumps(items)
+
+    def quiz(self, count):
+        questions = []
+        for _ in range(count):
+            with self._lock:
+                self._question_serial += 1
+                serial = self._question_serial
+            kind = ("Multiple Choice", "True/False", "Multiple Choice", "Short Answer")[serial % 4]
+            question = {"type": kind, "question_text": f"Question {serial}: how does {self._words(10)} explain {self._words(4)}?"}
+            if kind == "Multiple Choice":
+                question["options"] = [self._words(5) for _ in range(4)]
+                question["correct_answer_index"] = serial % 4
+            elif kind == "True/False":
+                question["options"] = ["True", "False"]
+                question["correct_answer_index"] = serial % 2
+            else:
+                question["correct_answer_text"] = self._words(6)
+            questions.append(question)
+        return json.dumps({"questions": questions})
+
+    def lesson_plan(self):
+        phases = ["Engage", "Explore", "Explain", "Elaborate", "Evaluate"]
+        return json.dumps({
+            "metadata": {
+                "duration": "60 minutes",
+                "materials": [self._words(3) for _ in range(5)],
+                "vocabulary": [self._words(1) for _ in range(6)],
+                "differentiation": {"sped": [self._words(8) for _ in range(3)], "ml": [self._words(8) for _ in range(3)]},
+            },
+            "sections": [{"phase": phase, "time": "12 mins", "activity": self._words(45)} for phase in phases],
+        })
+
+    def slides(self):
+        return json.dumps({"slides": [
+            {"title": self._words(4).title(), "bullet_points": [self._words(6) for _ in range(5)],
+             "speaker_notes": self._words(60), "image_ai_prompt": self._words(20)}
+            for _ in range(7)
+        ]})
+
+    def assignment(self):
+        parts = ["```html\n<!DOCTYPE html><html><head><style>body{font-family:sans-serif}</style></head><body>"]
+        size = sum(len(p) for p in parts)
+        section = 0
+        while size < self.assignment_chars:
+            section += 1
+            block = f"<h2>Part {section}: {self._words(4).title()}</h2><p>{self._words(60)}</p><ol>" + "".join(
+                f"<li>{self._words(14)}</li>" for _ in range(4)) + "</ol>"
+            parts.append(block)
+            size += len(block)
+        parts.append("</body></html>\n```")
+        return "".join(parts)
+
+
+def canned_response(body):
+    """Shared CannedResponses instance, for callers that just need a `respond` function."""
+    return _default_canned(body)
+
+
+_default_canned = CannedResponses()
+
+
+class FakeGeminiServer:
+    """Threaded local server answering every generateContent call with `respond(body) -> text`.
+
+    `latency` is the time to first token in seconds, or a callable returning it. With
+    `tokens_per_second`, the rest of the response is paced at that rate; streamed responses are
+    sent in chunks of STREAM_CHUNK_TOKENS tokens as they are "generated". With
+    `context_caching=False` the server behaves like a backend without context caching (404).
+    """
+
+    def __init__(self, respond=None, latency=0.0, tokens_per_second=None, context_caching=True):
+        self.respond = respond or (lambda body: "OK")
+        self.latency = latency if callable(latency) else fixed(latency)
+        self.tokens_per_second = tokens_per_second
+        self.context_caching = context_caching
+        self.requests = 0
+        self.stream_requests = 0
+        self.connections = 0
+        self.output_tokens = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.caches_created = 0
+        self.caches_deleted = 0
+        self._caches = {}
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # Headers and body go out in separate writes; avoid Nagle/delayed-ACK stalls
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with server._lock:
+                    server.connections += 1
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    # A client that exits drops its idle keep-alive connections
+                    pass
+
+            def _send_json(self, status, payload):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path.split("?")[0].endswith("/cachedContents"):
+                    return self._create_cache(body)
+                streaming = ":streamGenerateContent" in self.path
+                cached_tokens = 0
+                if body.get("cachedContent"):
+                    with server._lock:
+                        cached = server._caches.get(body["cachedContent"])
+                    if cached is None:
+                        return self._send_json(404, error_body(404, "NOT_FOUND", f"CachedContent not found: {body['cachedContent']}"))
+                    # The model sees the cached prefix followed by the request's own contents
+                    body = dict(body, contents=cached["contents"] + body.get("contents", []))
+                    cached_tokens = cached["tokens"]
+                text = server.respond(body)
+                prompt_tokens = estimate_tokens(prompt_text(body))
+                output_tokens = estimate_tokens(text)
+                with server._lock:
+                    server.requests += 1
+                    server.stream_requests += streaming
+                    server.output_tokens += output_tokens
+                    server.prompt_tokens += prompt_tokens - cached_tokens
+                    server.cached_prompt_tokens += cached_tokens
+                time.sleep(server.latency())
+                if streaming:
+                    self._stream(text, prompt_tokens, cached_tokens)
+                else:
+                    if server.tokens_per_second:
+                        time.sleep(output_tokens / server.tokens_per_second)
+                    payload = json.dumps(gemini_response(text, prompt_tokens, cached_tokens=cached_tokens)).encode("utf-8")
+                    self._send_json(200, payload)
+
+            def _create_cache(self, body):
+                if not server.context_caching:
+                    return self._send_json(404, error_body(404, "NOT_FOUND", "Context caching is not supported"))
+                tokens = estimate_tokens(prompt_text(body))
+                with server._lock:
+                    server.caches_created += 1
+                    name = f"cachedContents/fake-{server.caches_created}"
+                    server._caches[name] = {"contents": body.get("contents", []), "tokens": tokens}
+                    server.prompt_tokens += tokens
+                self._send_json(200, json.dumps({"name": name, "model": body.get("model"),
+                                                 "usageMetadata": {"totalTokenCount": tokens}}).encode("utf-8"))
+
+            def do_DELETE(self):
+                name = self.path.split("/v1beta/", 1)[-1].split("?")[0]
+                with server._lock:
+                    found = server._caches.pop(name, None) is not None
+                    server.caches_deleted += found
+                if found:
+                    self._send_json(200, b"{}")
+                else:
+                    self._send_json(404, error_body(404, "NOT_FOUND", f"CachedContent not found: {name}"))
+
+            def _stream(self, text, prompt_tokens, cached_tokens=0):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                step = STREAM_CHUNK_TOKENS * 4
+                pieces = [text[i:i + step] for i in range(0, len(text), step)] or [""]
+                try:
+                    for i, piece in enumerate(pieces):
+                        if i and server.tokens_per_second:
+                            time.sleep(STREAM_CHUNK_TOKENS / server.tokens_per_second)
+                        final = i == len(pieces) - 1
+                        event = gemini_response(piece, prompt_tokens, final=final, cached_tokens=cached_tokens)
+                        if final:
+                            # Usage covers the whole response, as Gemini reports it on the last chunk
+                            event["usageMetadata"]["candidatesTokenCount"] = estimate_tokens(text)
+                            event["usageMetadata"]["totalTokenCount"] = prompt_tokens + estimate_tokens(text)
+                        data = f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8")
+                        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client abandoned the stream (e.g. a quiz that already has enough questions)
+                    self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address
+        return f"http://{host}:{port}/"
+
+    def counters(self):
+        with self._lock:
+            return {"requests": self.requests, "stream_requests": self.stream_requests,
+                    "connections": self.connections, "output_tokens": self.output_tokens,
+                    "prompt_tokens": self.prompt_tokens, "cached_prompt_tokens": self.cached_prompt_tokens,
+                    "caches_created": self.caches_created, "caches_deleted": self.caches_deleted}
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = 0
+            self.stream_requests = 0
+            self.connections = 0
+            self.output_tokens = 0
+            self.prompt_tokens = 0
+            self.cached_prompt_tokens = 0
+            self.caches_created = 0
+            self.caches_deleted = 0
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,3807 @@
+# -*- coding: utf-8 -*-
+"""Generation pipeline behind Canvas Content Creator.
+
+Everything that talks to Gemini or builds a file lives here, free of Streamlit, so the same code
+serves the web app (app.py) and headless batch runs (batch_generate.py). User-facing errors,
+progress and live previews go through the current Reporter (see set_reporter()), and timing
+spans to the current Tracer if one is installed (see set_tracer()).
+
+Model calls are coroutines on the SDK's async client: generate_quiz_data_batched_async(),
+generate_unit_package_async() and the other *_async functions can be awaited from any event loop.
+Each has a synchronous counterpart of the same name without the suffix, which runs it on a shared
+background loop (see run_async()).
+"""
+import httpx
+import os
+import sys
+import threading
+import asyncio
+import queue
+import concurrent.futures
+import multiprocessing
+import contextvars
+import contextlib
+import functools
+import inspect
+import weakref
+import zipfile
+import zlib
+import tempfile
+import collections
+import io
+import html
+from google import genai
+from google.genai import types
+from google.genai import errors
+from pydantic import BaseModel, TypeAdapter
+import datetime
+import json
+import re
+import hashlib
+import random
+import math
+import heapq
+import statistics
+import sqlite3
+import time
+import pypdf
+import docx
+from fpdf import FPDF
+from fpdf.enums import Align, XPos, YPos
+from fpdf.fonts import CORE_FONTS_CHARWIDTHS
+from fpdf.line_break import TextLine
+from pptx import Presentation
+from pptx.util import Inches, Pt
+from pptx.dml.color import RGBColor
+from pptx.enum.dml import MSO_LINE
+from pptx.oxml import parse_xml
+from pptx.oxml.ns import nsdecls, qn
+from typing import Optional, List, Union, Any, Literal
+
+# --- Constants ---
+
+STEM_TOOLS = {
+    "PhET: Balancing Chemical Equations": "https://phet.colorado.edu/sims/html/balancing-chemical-equations/latest/balancing-chemical-equations_en.html",
+    "PhET: Circuit Construction Kit": "https://phet.colorado.edu/sims/html/circuit-construction-kit-dc/latest/circuit-construction-kit-dc_en.html",
+    "PhET: Energy Skate Park": "https://phet.colorado.edu/sims/html/energy-skate-park/latest/energy-skate-park_en.html",
+    "PhET: Natural Selection": "https://phet.colorado.edu/sims/html/natural-selection/latest/natural-selection_en.html",
+    "PhET: Projectile Motion": "https://phet.colorado.edu/sims/html/projectile-motion/latest/projectile-motion_en.html",
+    "PhET: Forces and Motion": "https://phet.colorado.edu/sims/html/forces-and-motion-basics/latest/forces-and-motion-basics_en.html",
+    "Desmos: Graphing Calculator": "https://www.desmos.com/calculator",
+    "Desmos: Scientific Calculator": "https://www.desmos.com/scientific",
+    "GeoGebra: Geometry": "https://www.geogebra.org/geometry",
+    "YouTube: Crash Course": "https://www.youtube.com/user/crashcourse",
+    "YouTube: Khan Academy": "https://www.youtube.com/user/khanacademy",
+    "YouTube: National Geographic": "https://www.youtube.com/user/NationalGeographic",
+    "Wikipedia": "https://www.wikipedia.org/",
+    "Google Slides": "https://docs.google.com/presentation/u/0/",
+    "Canva": "https://www.canva.com/",
+    "Desmos: Supply & Demand Shifters": "https://www.desmos.com/calculator/6mmm8psho7",
+    "EconGraphs: Competitive Market": "https://www.econgraphs.org/graphs/micro/equilibrium/supply_and_demand_old",
+    "Marginal Revolution: Elasticity Practice": "https://practice.mru.org/interactive-practice-supply-and-demand/",
+    "Omni Margin Calculator": "https://www.omnicalculator.com/finance/margin",
+    "AutoDraw": "https://www.autodraw.com/",
+    "Sketchpad": "https://sketch.io/sketchpad/",
+    "Color Wheel": "https://color.adobe.com/create/color-wheel",
+    "Google Arts & Culture": "https://artsandculture.google.com/",
+    "Python Online Compiler": "https://trinket.io/embed/python3",
+    "Scratch": "https://scratch.mit.edu/projects/editor/embed"
+}
+
+# --- Reporting ---
+
+class ProgressDisplay:
+    """A progress indicator for one long-running step. The base class shows nothing."""
+
+    def update(self, fraction, text):
+        pass
+
+    def close(self):
+        pass
+
+class PreviewDisplay:
+    """A live view of a document while it is being written. The base class shows nothing."""
+
+    def show(self, title, text):
+        pass
+
+    def close(self):
+        pass
+
+class Reporter:
+    """Receives the errors, progress and live previews the pipeline produces.
+
+    The base class prints errors to stderr and shows no progress, which suits headless runs.
+    The web app installs a reporter that draws on the page instead.
+    """
+
+    def error(self, message):
+        print(message, file=sys.stderr)
+
+    def warning(self, message):
+        print(message, file=sys.stderr)
+
+    def progress(self):
+        return ProgressDisplay()
+
+    def preview(self):
+        return PreviewDisplay()
+
+_reporter = contextvars.ContextVar("reporter", default=Reporter())
+
+def set_reporter(reporter):
+    """Sends errors and progress from the current thread (and the jobs it starts) to `reporter`."""
+    _reporter.set(reporter)
+
+def get_reporter():
+    return _reporter.get()
+
+def report_error(message):
+    _reporter.get().error(message)
+
+def report_warning(message):
+    _reporter.get().warning(message)
+
+# --- Tracing ---
+
+class Span(BaseModel):
+    """One timed stage of a run: a Gemini call, a renderer, packaging...
+
+    Times are Unix epoch nanoseconds. `attributes` holds what the stage measured, e.g. model and
+    token counts (`gen_ai.*`, as in the OpenTelemetry GenAI conventions) or `output_bytes`.
+    """
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str] = None
+    start_ns: int
+    end_ns: int = 0
+    thread: str = ""
+    status: Literal['ok', 'error'] = 'ok'
+    error: Optional[str] = None
+    attributes: dict[str, Any] = {}
+
+    @property
+    def duration(self):
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def set(self, **attributes):
+        self.attributes.update((k, v) for k, v in attributes.items() if v is not None)
+
+class _NoSpan:
+    """Stands in for a Span when tracing is off, so instrumented code need not check."""
+
+    def set(self, **attributes):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+class Tracer:
+    """Collects the spans of one run (a web request, a batch job) as a single trace.
+
+    Install it with set_tracer(); spans from the jobs started afterwards land here too, whichever
+    task or worker thread they run on.
+    Export with write_jsonl() (one span per line) or to_otlp() (OTLP/JSON, which OpenTelemetry
+    collectors and viewers import).
+    """
+
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def start(self, name, parent, attributes):
+        span = Span(name=name, trace_id=self.trace_id, span_id=os.urandom(8).hex(),
+                    parent_id=parent.span_id if isinstance(parent, Span) else None,
+                    start_ns=time.time_ns(), thread=threading.current_thread().name)
+        span.set(**attributes)
+        return span
+
+    def finish(self, span):
+        span.end_ns = time.time_ns()
+        with self._lock:
+            self.spans.append(span)
+
+    def finished_spans(self):
+        """Finished spans in start order."""
+        with self._lock:
+            return sorted(self.spans, key=lambda span: span.start_ns)
+
+    def write_jsonl(self, file):
+        """Writes one JSON span per line to `file` (a path or a text file handle)."""
+        if isinstance(file, str):
+            with open(file, "w", encoding="utf-8") as f:
+                return self.write_jsonl(f)
+        for span in self.finished_spans():
+            file.write(span.model_dump_json() + "\n")
+
+    def to_otlp(self, service_name="canvas-content-creator"):
+        """The trace as an OTLP/JSON ExportTraceServiceRequest dict."""
+        def value(v):
+            if isinstance(v, bool):
+                return {"boolValue": v}
+            if isinstance(v, int):
+                return {"intValue": str(v)}
+            if isinstance(v, float):
+                return {"doubleValue": v}
+            return {"stringValue": str(v)}
+
+        spans = [{
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+            "name": span.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": k, "value": value(v)} for k, v in {**span.attributes, "thread.name": span.thread}.items()],
+            "status": {"code": 2, "message": span.error or ""} if span.status == 'error' else {"code": 1},
+        } for span in self.finished_spans()]
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+            "scopeSpans": [{"scope": {"name": "content_engine"}, "spans": spans}],
+        }]}
+
+    def timeline(self):
+        """Rows for a waterfall chart, in start order: each span's offset from the start of the
+        trace and duration in seconds, nesting depth, label and attributes."""
+        spans = self.finished_spans()
+        if not spans:
+            return []
+        origin = spans[0].start_ns
+        depths = {}
+        rows = []
+        for span in spans:
+            depth = depths[span.span_id] = depths.get(span.parent_id, -1) + 1
+            detail = span.attributes.get("task")
+            rows.append({
+                "label": f"{span.name}: {detail}" if detail else span.name,
+                "name": span.name,
+                "depth": depth,
+                "start": (span.start_ns - origin) / 1e9,
+                "end": (span.end_ns - origin) / 1e9,
+                "seconds": round(span.duration, 3),
+                "status": span.status,
+                **span.attributes,
+            })
+        return rows
+
+    def summary(self):
+        """Per span name: count, total seconds, tokens and output bytes, slowest first."""
+        totals = {}
+        for span in self.finished_spans():
+            row = totals.setdefault(span.name, {"name": span.name, "count": 0, "seconds": 0.0, "input_tokens": 0, "output_tokens": 0, "output_bytes": 0, "errors": 0})
+            row["count"] += 1
+            row["seconds"] += span.duration
+            row["input_tokens"] += span.attributes.get("gen_ai.usage.input_tokens", 0)
+            row["output_tokens"] += span.attributes.get("gen_ai.usage.output_tokens", 0)
+            row["output_bytes"] += span.attributes.get("output_bytes", 0)
+            row["errors"] += span.status == 'error'
+        return sorted(totals.values(), key=lambda row: -row["seconds"])
+
+_tracer = contextvars.ContextVar("tracer", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+def set_tracer(tracer):
+    """Records spans from the current thread (and the jobs it starts) in `tracer`; None turns tracing off."""
+    _tracer.set(tracer)
+    _current_span.set(None)
+
+def get_tracer():
+    return _tracer.get()
+
+def current_span():
+    """The innermost open span in this thread or task, for adding attributes to it."""
+    return _current_span.get() or _NO_SPAN
+
+@contextlib.contextmanager
+def trace_span(name, **attributes):
+    """Times the enclosed block as a span named `name`, nested under the current span.
+
+    Yields the Span (or a do-nothing stand-in when no Tracer is installed) so the block can add
+    attributes. An exception marks the span as an error and propagates.
+    """
+    tracer = _tracer.get()
+    if tracer is None:
+        yield _NO_SPAN
+        return
+    span = tracer.start(name, _current_span.get(), attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except asyncio.CancelledError:
+        # Cancelling a task whose result is no longer needed is not a failure
+        span.set(stopped_early=True)
+        raise
+    except BaseException as e:
+        span.status = 'error'
+        span.error = f"{type(e).__name__}: {e}"[:300]
+        raise
+    finally:
+        _current_span.reset(token)
+        tracer.finish(span)
+
+def output_size(result):
+    """Size in bytes of what a stage produced: bytes, text, a file handle, or the first item of a tuple."""
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    if isinstance(result, (bytes, bytearray)):
+        return len(result)
+    if isinstance(result, str):
+        return len(result.encode("utf-8"))
+    if hasattr(result, "seek") and hasattr(result, "tell"):
+        position = result.tell()
+        size = result.seek(0, io.SEEK_END)
+        result.seek(position)
+        return size
+    return None
+
+def traced(name):
+    """Decorator that runs the function (or coroutine function) inside trace_span(name) and records
+    the size of its result."""
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with trace_span(name) as span:
+                    result = await fn(*args, **kwargs)
+                    span.set(output_bytes=output_size(result))
+                    return result
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace_span(name) as span:
+                result = fn(*args, **kwargs)
+                span.set(output_bytes=output_size(result))
+                return result
+        return wrapper
+    return decorate
+
+# --- Async Runtime ---
+
+class _CallerThreadReporter(Reporter):
+    """Queues a Reporter's calls for the thread waiting in run_async(), which carries them out in order.
+
+    Coroutines run on the shared event loop, but a reporter such as the web app's has to be called
+    from the thread that started the job.
+    """
+
+    def __init__(self, reporter, calls):
+        self._reporter = reporter
+        self._calls = calls
+
+    def error(self, message):
+        self._calls.put(functools.partial(self._reporter.error, message))
+
+    def warning(self, message):
+        self._calls.put(functools.partial(self._reporter.warning, message))
+
+    def progress(self):
+        return _CallerThreadDisplay(self._reporter.progress, self._calls)
+
+    def preview(self):
+        return _CallerThreadDisplay(self._reporter.preview, self._calls)
+
+class _CallerThreadDisplay:
+    """A ProgressDisplay or PreviewDisplay created, updated and closed on the thread waiting in run_async()."""
+
+    def __init__(self, create, calls):
+        self._display = None
+        self._calls = calls
+        calls.put(lambda: setattr(self, '_display', create()))
+
+    def _call(self, method, *args):
+        self._calls.put(lambda: getattr(self._display, method)(*args))
+
+    def update(self, fraction, text):
+        self._call('update', fraction, text)
+
+    def show(self, title, text):
+        self._call('show', title, text)
+
+    def close(self):
+        self._call('close')
+
+_async_loop = None
+_async_loop_pid = None
+_async_loop_lock = threading.Lock()
+
+def get_async_loop():
+    """Returns the process-wide event loop behind run_async(), starting its daemon thread on first use.
+
+    A forked child starts a loop of its own, since the parent's loop thread does not survive the fork.
+    """
+    global _async_loop, _async_loop_pid
+    if _async_loop is None or _async_loop_pid != os.getpid():
+        with _async_loop_lock:
+            if _async_loop is None or _async_loop_pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="content-engine-loop", daemon=True).start()
+                _async_loop, _async_loop_pid = loop, os.getpid()
+    return _async_loop
+
+async def _run_in_context(coro, context):
+    return await asyncio.get_running_loop().create_task(coro, context=context)
+
+def run_async(coro):
+    """Runs `coro` on the shared event loop and returns its result. The synchronous API is built on this.
+
+    The coroutine sees the caller's Reporter, Tracer, current span and ContextCache, and its
+    Reporter calls are carried out on the calling thread, which waits here meanwhile, so the web app
+    draws progress as before. If the caller is interrupted (or a Reporter call raises) the coroutine
+    is cancelled. Not for use inside a coroutine: await the *_async function instead.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        coro.close()
+        raise RuntimeError("run_async() cannot wait inside a running event loop; await the coroutine instead")
+
+    calls = queue.SimpleQueue()
+    context = contextvars.copy_context()
+    context.run(set_reporter, _CallerThreadReporter(get_reporter(), calls))
+    future = asyncio.run_coroutine_threadsafe(_run_in_context(coro, context), get_async_loop())
+    future.add_done_callback(lambda _: calls.put(None))
+    try:
+        for call in iter(calls.get, None):
+            call()
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+# --- Context Cache ---
+
+# Prompt prefixes (role and source material) shared by calls in one job are uploaded to Gemini's
+# context cache once and referred to by handle (override with configure_context_cache() or
+# GEMINI_CONTEXT_CACHE=0 / GEMINI_CONTEXT_CACHE_MIN_TOKENS). A prefix is cached once at least
+# CONTEXT_CACHE_MIN_USES prompts in the job start with it and it is estimated at
+# CONTEXT_CACHE_MIN_TOKENS tokens or more (the smallest the API accepts). Only preambles with source
+# material are noted: the role plus SOURCE_CONTEXT_MAX_CHARS of retrieved passages comes to about
+# 1200 tokens, so any source longer than about 4000 characters qualifies
+CONTEXT_CACHE_ENABLED = True
+CONTEXT_CACHE_MIN_TOKENS = 1024
+CONTEXT_CACHE_MIN_USES = 2
+
+# Lifetime of a cached prefix on the backend; jobs delete theirs when they finish
+CONTEXT_CACHE_TTL_SECONDS = 900
+
+# HTTP status codes meaning the backend has no context caching at all
+_CONTEXT_CACHE_UNSUPPORTED = (404, 405, 501)
+
+# Set by configure_context_cache()
+_context_cache_settings = {}
+
+def configure_context_cache(enabled=None, min_tokens=None):
+    """Turns context caching on or off and sets the smallest prefix worth caching in this process.
+    Settings left as None fall back to GEMINI_CONTEXT_CACHE / GEMINI_CONTEXT_CACHE_MIN_TOKENS and
+    then the defaults above."""
+    _context_cache_settings['enabled'] = enabled
+    _context_cache_settings['min_tokens'] = min_tokens
+
+def context_cache_enabled():
+    enabled = _context_cache_settings.get('enabled')
+    if enabled is None:
+        enabled = os.environ.get("GEMINI_CONTEXT_CACHE", "1" if CONTEXT_CACHE_ENABLED else "0").lower() not in ("0", "false", "no", "off")
+    return enabled
+
+class ContextCache:
+    """Prompt prefixes registered with Gemini's context cache for the length of one job.
+
+    Prompt builders note the opening they share with add() (see prompt_preamble()). The first call
+    whose prompt starts with a prefix used often enough uploads it (caches.create); from then on
+    calls send only the rest of the prompt plus the handle. If the backend has no context caching or
+    refuses a prefix, calls carry the full prompt as before; after a transient error (a rate limit,
+    a timeout) the next call that needs the prefix tries the upload again. Thread-safe; close() deletes whatever
+    the job created.
+    """
+
+    def __init__(self, min_tokens=CONTEXT_CACHE_MIN_TOKENS, min_uses=CONTEXT_CACHE_MIN_USES, ttl_seconds=CONTEXT_CACHE_TTL_SECONDS):
+        self.min_tokens = min_tokens
+        self.min_uses = min_uses
+        self.ttl_seconds = ttl_seconds
+        self.available = True
+        self.created = 0
+        self.hits = 0
+        self.fallbacks = 0
+        self.prefix_tokens_saved = 0
+        self._uses = collections.Counter()
+        self._entries = {}  # (model, prefix) -> (handle, tokens), or None if it could not be cached
+        self._creating = collections.defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def add(self, prefix):
+        """Notes that a prompt about to be sent starts with `prefix`."""
+        with self._lock:
+            self._uses[prefix] += 1
+
+    async def split(self, prompt, model):
+        """Returns (handle, tokens, rest) for a prompt starting with a cacheable prefix, uploading
+        the prefix on first use, or (None, 0, prompt) if the prompt has to be sent whole. The upload
+        runs on a worker thread, so the event loop keeps serving other calls meanwhile."""
+        if not self.available:
+            return None, 0, prompt
+        with self._lock:
+            prefixes = [p for p, uses in self._uses.items() if uses >= self.min_uses and prompt.startswith(p)]
+            prefix = max(prefixes, key=len, default=None)
+            known = (model, prefix) in self._entries
+            entry = self._entries.get((model, prefix))
+        if prefix is None or estimate_tokens(prefix) < self.min_tokens:
+            return None, 0, prompt
+        if not known:
+            entry = await asyncio.to_thread(self._entry, model, prefix)
+        if entry is None:
+            return None, 0, prompt
+        return entry[0], entry[1], prompt[len(prefix):]
+
+    def _entry(self, model, prefix):
+        key = (model, prefix)
+        with self._lock:
+            if key in self._entries:
+                return self._entries[key]
+            creating = self._creating[key]
+        # One upload per prefix; calls that need it meanwhile wait for the handle
+        with creating:
+            with self._lock:
+                if key in self._entries:
+                    return self._entries[key]
+            entry = None
+            try:
+                with trace_span("gemini.cache_context", prefix_chars=len(prefix)) as span:
+                    cached = get_gemini_client().caches.create(
+                        model=model,
+                        config=types.CreateCachedContentConfig(contents=prefix, ttl=f"{self.ttl_seconds}s")
+                    )
+                    tokens = usage_tokens(cached) or estimate_tokens(prefix)
+                    span.set(**{'gen_ai.usage.input_tokens': tokens})
+                entry = (cached.name, tokens)
+            except Exception as e:
+                if getattr(e, 'code', None) in _CONTEXT_CACHE_UNSUPPORTED:
+                    self.available = False
+                elif is_retryable_error(e):
+                    # A rate limit or timeout says nothing about the prefix; the next call tries again
+                    return None
+            with self._lock:
+                self._entries[key] = entry
+                self.created += entry is not None
+            return entry
+
+    def record(self, tokens):
+        """Counts a call that was answered with a cached prefix of `tokens` tokens."""
+        with self._lock:
+            self.hits += 1
+            self.prefix_tokens_saved += tokens
+
+    def discard(self, handle):
+        """Stops using `handle` (e.g. it expired); its prompts are sent whole from now on."""
+        with self._lock:
+            self.fallbacks += 1
+            for key, entry in self._entries.items():
+                if entry and entry[0] == handle:
+                    self._entries[key] = None
+
+    def close(self):
+        """Deletes the job's cached prefixes from the backend. Failures are ignored; they expire anyway."""
+        with self._lock:
+            handles = [entry[0] for entry in self._entries.values() if entry]
+            self._entries.clear()
+        for handle in handles:
+            try:
+                get_gemini_client().caches.delete(name=handle)
+            except Exception:
+                pass
+
+    def stats(self):
+        """Returns counts of prefixes cached, calls that used one or fell back, and prompt tokens not re-sent."""
+        with self._lock:
+            return {"created": self.created, "hits": self.hits, "fallbacks": self.fallbacks,
+                    "prefix_tokens_saved": self.prefix_tokens_saved}
+
+_context_cache = contextvars.ContextVar("context_cache", default=None)
+
+@contextlib.asynccontextmanager
+async def context_cache_scope():
+    """Shares one ContextCache across every call in the enclosed job, including the tasks it starts.
+
+    Yields the ContextCache, or None when context caching is turned off. Inside an existing scope
+    the outer job's cache is reused; the scope that created the cache closes it on exit.
+    """
+    cache = _context_cache.get()
+    if cache is not None or not context_cache_enabled():
+        yield cache
+        return
+    min_tokens = int(_context_cache_settings.get('min_tokens') or os.environ.get("GEMINI_CONTEXT_CACHE_MIN_TOKENS") or CONTEXT_CACHE_MIN_TOKENS)
+    cache = ContextCache(min_tokens=min_tokens)
+    token = _context_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _context_cache.reset(token)
+        await asyncio.to_thread(cache.close)
+        current_span().set(**{f"context_cache.{name}": value for name, value in cache.stats().items()})
+
+def note_prompt_prefix(prefix):
+    """Tells the current job's ContextCache (if any) that a prompt starting with `prefix` is coming."""
+    cache = _context_cache.get()
+    if cache is not None:
+        cache.add(prefix)
+
+async def send_with_context_cache(prompt, config, model, send, can_fall_back=lambda: True):
+    """Awaits `send(contents, config)` for `prompt`, replacing its cached prefix with a handle.
+
+    If the backend rejects the handle (e.g. it expired), the handle is dropped and the full prompt
+    is sent instead, unless `can_fall_back()` says part of the answer was already used. Rate limit
+    and other errors propagate unchanged so the caller can re-queue or report the call.
+    """
+    cache = _context_cache.get()
+    handle, tokens, rest = await cache.split(prompt, model) if cache is not None else (None, 0, prompt)
+    if handle is None:
+        return await send(prompt, config)
+    cached_config = config.model_copy() if config else types.GenerateContentConfig()
+    cached_config.cached_content = handle
+    current_span().set(cached_prefix_tokens=tokens)
+    try:
+        result = await send(rest, cached_config)
+    except BaseException as e:
+        if not can_fall_back():
+            # The answer was already coming back (e.g. a stream cancelled part-way), so the prefix was used
+            cache.record(tokens)
+            raise
+        if not isinstance(e, errors.APIError) or is_rate_limit_error(e):
+            raise
+        cache.discard(handle)
+        current_span().set(cached_prefix_tokens=0)
+        return await send(prompt, config)
+    cache.record(tokens)
+    return result
+
+# --- Retries ---
+
+class RetryBudget:
+    """A pool of retries shared by every call in one job, so a failing backend cannot multiply its run time."""
+
+    def __init__(self, retries):
+        self.remaining = retries
+        self._lock = threading.Lock()
+
+    def spend(self):
+        """Takes one retry from the pool. Returns False once the pool is empty."""
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+class RetryPolicy:
+    """How one kind of call is retried.
+
+    Up to `attempts` tries, each limited to `timeout` seconds (None for no limit), with exponential
+    backoff and full jitter between them. If `budget` is set, every retry must also be paid for from
+    it. `on_failure(error, will_retry)` is called after each failed try.
+    """
+
+    def __init__(self, attempts=3, base_delay=1.0, max_delay=20.0, timeout=None, budget=None, on_failure=None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.budget = budget
+        self.on_failure = on_failure
+
+    def bind(self, budget=None, on_failure=None):
+        """Returns a copy of this policy that draws on `budget` and reports to `on_failure`."""
+        return RetryPolicy(self.attempts, self.base_delay, self.max_delay, self.timeout, budget, on_failure)
+
+    async def run_async(self, fn):
+        """Awaits `fn(timeout)` until it returns, retrying errors that may be transient. Raises the last error."""
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return await fn(self.timeout)
+            except Exception as e:
+                will_retry = attempt < self.attempts and is_retryable_error(e) and (self.budget is None or self.budget.spend())
+                if self.on_failure:
+                    self.on_failure(e, will_retry)
+                if not will_retry:
+                    raise
+                await asyncio.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))))
+
+def is_retryable_error(error):
+    """True for errors another try may fix: timeouts, dropped connections, 408/429/5xx and malformed output."""
+    if isinstance(error, errors.APIError):
+        return error.code in (408, 429) or (error.code or 0) >= 500
+    # ValueError covers JSON and schema validation failures
+    return isinstance(error, (httpx.TransportError, TimeoutError, ValueError))
+
+# Retry policies for each kind of call (timeouts are per attempt, in seconds)
+ASSIGNMENT_RETRY = RetryPolicy(attempts=3, timeout=180)
+LESSON_PLAN_RETRY = RetryPolicy(attempts=3, timeout=120)
+SLIDES_RETRY = RetryPolicy(attempts=3, timeout=120)
+QUIZ_BATCH_RETRY = RetryPolicy(attempts=2, timeout=120)
+UNIT_SEQUENCE_RETRY = RetryPolicy(attempts=3, timeout=60)
+
+# --- Packaging ---
+
+# Archives stay in memory up to this size, then spill to a temporary file on disk
+ZIP_SPOOL_LIMIT = 16 * 1024 * 1024
+# Threads used to DEFLATE archive members in parallel
+ZIP_COMPRESS_WORKERS = 4
+# Members that are already compressed (ZIP containers, images, video) are stored as-is
+ALREADY_COMPRESSED_EXTENSIONS = ('.zip', '.pptx', '.docx', '.xlsx', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp4')
+
+def is_already_compressed(name, data):
+    """Returns True for members that DEFLATE would not shrink (ZIP-based formats and media files)."""
+    return name.lower().endswith(ALREADY_COMPRESSED_EXTENSIONS) or data[:4] == b"PK\x03\x04"
+
+# zipfile has no public API for adding pre-compressed data. On the CPython releases whose zipfile
+# internals _write_deflated() was checked against, members DEFLATEd on the pool are written as-is;
+# on any other Python they are compressed again through the public ZipFile.writestr()
+_ZIP_RAW_WRITES = (3, 8) <= sys.version_info < (3, 14)
+
+def _deflate(data):
+    """Returns (crc32, raw DEFLATE stream) for `data`. zlib releases the GIL, so this runs in parallel."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return zlib.crc32(data), compressor.compress(data) + compressor.flush()
+
+class ZipPackageWriter:
+    """Builds a ZIP archive in a spooled temporary file instead of an in-memory blob.
+
+    Members are written in the order they are added. Already-compressed members are stored
+    without recompression; the rest are DEFLATEd on a thread pool and written as soon as every
+    earlier member is done. close() returns the finished archive as a file handle positioned at 0.
+    """
+
+    def __init__(self, spool_limit=ZIP_SPOOL_LIMIT, max_workers=ZIP_COMPRESS_WORKERS):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_limit)
+        self._zf = zipfile.ZipFile(self.file, "w", zipfile.ZIP_DEFLATED)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self._pending = collections.deque()  # (name, data, future or None) in archive order
+        self._raw_writes = _ZIP_RAW_WRITES and all(hasattr(self._zf, attr) for attr in ('_lock', 'fp', 'start_dir', 'filelist', 'NameToInfo'))
+
+    def writestr(self, name, data):
+        """Queues `data` (bytes, str or a readable file handle) as archive member `name`."""
+        if hasattr(data, "read"):
+            data.seek(0)
+            data = data.read()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        future = None if is_already_compressed(name, data) else self._executor.submit(_deflate, data)
+        self._pending.append((name, data, future))
+        self._flush(wait=False)
+
+    def _flush(self, wait):
+        while self._pending:
+            name, data, future = self._pending[0]
+            if future is not None and not wait and not future.done():
+                return
+            self._pending.popleft()
+            if future is None:
+                self._zf.writestr(name, data, compress_type=zipfile.ZIP_STORED)
+                continue
+            crc, compressed = future.result()
+            if len(compressed) >= len(data):
+                self._zf.writestr(name, data, compress_type=zipfile.ZIP_STORED)
+            elif self._raw_writes:
+                self._write_deflated(name, data, crc, compressed)
+            else:
+                self._zf.writestr(name, data, compress_type=zipfile.ZIP_DEFLATED)
+
+    def _write_deflated(self, name, data, crc, compressed):
+        # Write the local header and payload ourselves and register the entry so close() emits the
+        # central directory (only where _ZIP_RAW_WRITES says these zipfile internals are known)
+        zf = self._zf
+        zinfo = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.external_attr = 0o600 << 16
+        zinfo.file_size = len(data)
+        zinfo.compress_size = len(compressed)
+        zinfo.CRC = crc
+        zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+        with zf._lock:
+            zinfo.header_offset = zf.fp.tell()
+            zf.fp.write(zinfo.FileHeader(zip64))
+            zf.fp.write(compressed)
+            zf.start_dir = zf.fp.tell()
+            zf.filelist.append(zinfo)
+            zf.NameToInfo[name] = zinfo
+
+    @contextlib.contextmanager
+    def open(self, name):
+        """Yields a binary file handle for writing member `name` incrementally. The member is
+        compressed on this thread as it is written, after every member queued before it."""
+        self._flush(wait=True)
+        with self._zf.open(name, "w") as member:
+            yield member
+
+    def close(self):
+        """Writes any remaining members and the central directory, and returns the archive file."""
+        with trace_span("package.zip", members=len(self._zf.filelist) + len(self._pending)) as span:
+            try:
+                self._flush(wait=True)
+                self._zf.close()
+            finally:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            span.set(output_bytes=self.file.tell())
+        self.file.seek(0)
+        return self.file
+
+def read_package(package):
+    """Returns the full contents of a package file handle (or passes bytes through)."""
+    if hasattr(package, "read"):
+        package.seek(0)
+        return package.read()
+    return package
+
+# Maximum number of quiz batches requested from Gemini at the same time
+QUIZ_BATCH_MAX_WORKERS = 4
+# Token ceilings for one quiz batch call (override with configure_quiz_batching() or
+# QUIZ_MAX_INPUT_TOKENS / QUIZ_MAX_OUTPUT_TOKENS): batches ask for as many questions as fit under
+# the output ceiling, and source material is cut to keep the prompt under the input ceiling.
+# gemini-2.0-flash stops at 8192 output tokens, which would cut the last questions off
+QUIZ_MAX_INPUT_TOKENS = 8000
+QUIZ_MAX_OUTPUT_TOKENS = 6000
+# Expected JSON output tokens per question by type (question, options, answer and keys), and for
+# types not listed; a batch is sized for its most expensive requested type
+QUESTION_TYPE_OUTPUT_TOKENS = {
+    "Multiple Choice": 120,
+    "Multiple Select": 150,
+    "True/False": 70,
+    "Short Answer": 90,
+    "Essay": 80,
+}
+QUESTION_DEFAULT_OUTPUT_TOKENS = 120
+# Headroom for questions running longer than expected, and the response's own wrapper
+QUIZ_OUTPUT_TOKEN_MARGIN = 1.5
+QUIZ_RESPONSE_OVERHEAD_TOKENS = 20
+# Batch size bounds: batches ask for at least QUIZ_MIN_BATCH_QUESTIONS (unless the output ceiling
+# allows fewer) and never more than QUIZ_MAX_BATCH_QUESTIONS, past which the model loses count
+QUIZ_MIN_BATCH_QUESTIONS = 10
+QUIZ_MAX_BATCH_QUESTIONS = 50
+# Extra rounds of smaller batches used to replace questions dropped as duplicates
+QUIZ_MAX_TOP_UP_ROUNDS = 2
+# Question banks are large, so more of their batches run at once (the rate limiter still applies)
+QUESTION_BANK_MAX_WORKERS = 8
+# Largest question bank the app will generate in one go
+QUESTION_BANK_MAX_QUESTIONS = 1000
+# Bank batches rotate through these cognitive levels so they do not all write the same questions
+QUESTION_BANK_FOCUSES = ["Remember", "Understand", "Apply", "Analyze", "Evaluate"]
+# Questions per QTI file; larger banks and quizzes are split into parts that Canvas imports quickly
+QTI_MAX_ITEMS_PER_FILE = 200
+# How generate_qti_zip() can package questions: one quiz, Canvas item banks, or both
+QTI_PACKAGE_MODES = ('quiz', 'bank', 'both')
+
+# --- Helper Functions (QTI) ---
+
+class Question(BaseModel):
+    type: str  # Type is crucial for correct QTI rendering
+    question_text: str
+    options: Optional[List[str]] = None
+    correct_answer_index: Optional[Union[int, List[int]]] = None # Can be list for multiple select, or None for essay
+    correct_answer_text: Optional[str] = None # For short answer/fill in blank
+
+class Quiz(BaseModel):
+    questions: list[Question]
+
+class QuestionStreamParser:
+    """Incremental decoder for a streamed Quiz JSON document.
+
+    feed() scans each new chunk once and returns every element of the top-level `questions`
+    array that closed in it, validated into a Question. Elements that fail validation are counted
+    in `invalid` and skipped, so a truncated stream still yields every question that completed.
+    """
+
+    def __init__(self, key="questions"):
+        self.key = key
+        self.invalid = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key_chars = None  # Collects string content at depth 1 (object keys)
+        self._last_key = None
+        self._in_array = False
+        self._element_parts = None  # Pieces of the current array element, once it has started
+
+    def feed(self, chunk):
+        questions = []
+        start = 0 if self._element_parts is not None else None
+
+        for i, ch in enumerate(chunk):
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._key_chars is not None:
+                        self._last_key = "".join(self._key_chars)
+                        self._key_chars = None
+                    continue
+                if self._key_chars is not None:
+                    self._key_chars.append(ch)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._key_chars = [] if self._depth == 1 else None
+            elif ch == '{' or ch == '[':
+                self._depth += 1
+                if ch == '[' and self._depth == 2 and self._last_key == self.key:
+                    self._in_array = True
+                elif ch == '{' and self._in_array and self._depth == 3:
+                    self._element_parts = []
+                    start = i
+            elif ch == '}' or ch == ']':
+                if ch == '}' and self._in_array and self._depth == 3 and self._element_parts is not None:
+                    self._element_parts.append(chunk[start:i + 1])
+                    question = self._decode("".join(self._element_parts))
+                    if question is not None:
+                        questions.append(question)
+                    self._element_parts = None
+                    start = None
+                elif ch == ']' and self._in_array and self._depth == 2:
+                    self._in_array = False
+                self._depth -= 1
+
+        if self._element_parts is not None and start is not None:
+            self._element_parts.append(chunk[start:])
+        return questions
+
+    def _decode(self, text):
+        try:
+            return Question.model_validate_json(text)
+        except ValueError:
+            self.invalid += 1
+            return None
+
+# --- Structured Output Models ---
+# Passed to Gemini as response schemas, so JSON responses decode straight into these types.
+
+class UnitItem(BaseModel):
+    type: Literal['Assignment', 'Quiz']
+    title: str
+    focus_topic: Optional[str] = None  # Not requested for outlines
+
+class UnitOutline(BaseModel):
+    items: list[UnitItem]
+
+class LessonPlanDifferentiation(BaseModel):
+    sped: list[str]
+    ml: list[str]
+
+class LessonPlanMetadata(BaseModel):
+    duration: str
+    materials: list[str]
+    vocabulary: list[str]
+    differentiation: LessonPlanDifferentiation
+
+class LessonPlanSection(BaseModel):
+    phase: str
+    time: str
+    activity: str
+
+class LessonPlan(BaseModel):
+    metadata: LessonPlanMetadata
+    sections: list[LessonPlanSection]
+
+class Slide(BaseModel):
+    title: str
+    bullet_points: list[str]
+    speaker_notes: str
+    image_ai_prompt: str
+
+class SlideDeck(BaseModel):
+    slides: list[Slide]
+
+# --- Helper Functions (Quiz Dedup) ---
+
+# Estimated Jaccard similarity at which two questions count as near-duplicates
+QUESTION_DUPLICATE_THRESHOLD = 0.7
+
+# Fixed (a, b) pairs for the MinHash permutations h -> (a*h + b) mod p, so signatures are stable across runs
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(20240601)
+_MINHASH_PERMS = [(_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(0, _MINHASH_PRIME)) for _ in range(32)]
+
+class QuestionDedupIndex:
+    """Incremental near-duplicate index over quiz questions.
+
+    Each question's normalized text and options are split into word-bigram shingles and reduced
+    to a MinHash signature. LSH banding finds candidate matches, so each add() costs time
+    proportional to the question's length rather than the size of the index.
+    """
+    NUM_PERM = len(_MINHASH_PERMS)
+    BANDS = 8
+    ROWS = 4  # BANDS * ROWS == NUM_PERM
+
+    def __init__(self, threshold=QUESTION_DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self.duplicates = 0
+        self._exact = set()
+        self._signatures = []
+        self._buckets = [{} for _ in range(self.BANDS)]
+
+    @staticmethod
+    def _normalize(text):
+        return re.sub(r'[^a-z0-9]+', ' ', str(text).lower()).strip()
+
+    def _shingles(self, question):
+        stem = self._normalize(question.question_text)
+        options = sorted(self._normalize(o) for o in (question.options or []))
+        words = f"{stem} {' '.join(options)}".split()
+        if len(words) < 2:
+            return {" ".join(words)}
+        return {f"{words[i]} {words[i + 1]}" for i in range(len(words) - 1)}
+
+    def _signature(self, shingles):
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little') for s in shingles]
+        return tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PERMS)
+
+    def add(self, question):
+        """Adds a Question. Returns False (and adds nothing) if it near-duplicates one already seen."""
+        shingles = self._shingles(question)
+        exact_key = " ".join(sorted(shingles))
+        if exact_key in self._exact:
+            self.duplicates += 1
+            return False
+
+        signature = self._signature(shingles)
+        band_keys = [signature[b * self.ROWS:(b + 1) * self.ROWS] for b in range(self.BANDS)]
+        candidates = set()
+        for bucket, band_key in zip(self._buckets, band_keys):
+            candidates.update(bucket.get(band_key, ()))
+        for candidate in candidates:
+            other = self._signatures[candidate]
+            similarity = sum(x == y for x, y in zip(signature, other)) / self.NUM_PERM
+            if similarity >= self.threshold:
+                self.duplicates += 1
+                return False
+
+        position = len(self._signatures)
+        self._signatures.append(signature)
+        self._exact.add(exact_key)
+        for bucket, band_key in zip(self._buckets, band_keys):
+            bucket.setdefault(band_key, []).append(position)
+        return True
+
+def create_imsmanifest(files=("quiz.xml",)):
+    """Creates the imsmanifest.xml content, listing each QTI file in `files` as a resource."""
+    resources = "".join(f"""
+    <resource identifier="res{k:05d}" type="imsqti_xmlv1p2">
+      <file href="{xml_text(href)}"/>
+    </resource>""" for k, href in enumerate(files, start=1))
+    manifest_template = f"""<?xml version="1.0" encoding="UTF-8"?>
+<manifest identifier="man00001" xmlns="http://www.imsglobal.org/xsd/imscp_v1p1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.imsglobal.org/xsd/imscp_v1p1 http://www.imsglobal.org/xsd/imscp_v1p1.xsd">
+  <metadata>
+    <schema>IMS Content</schema>
+    <schemaversion>1.1.3</schemaversion>
+  </metadata>
+  <organizations/>
+  <resources>{resources}
+  </resources>
+</manifest>"""
+    return manifest_template.encode('utf-8')
+
+# Characters XML 1.0 does not allow anywhere in a document (they are dropped from question text)
+_XML_INVALID_CHARS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+# Quiz XML is encoded and written to the archive in blocks of about this many characters
+QTI_WRITE_BUFFER_CHARS = 256 * 1024
+
+QTI_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<questestinterop xmlns="http://www.imsglobal.org/xsd/ims_qtiasiv1p2" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    'xsi:schemaLocation="http://www.imsglobal.org/xsd/ims_qtiasiv1p2 http://www.imsglobal.org/xsd/ims_qtiasiv1p2.xsd">'
+)
+QTI_SCORE_OUTCOMES = '<outcomes><decvar defaultval="0" varname="SCORE" vartype="Integer"/></outcomes>'
+
+def xml_text(text):
+    """`text` escaped for use in XML character data or a double-quoted attribute."""
+    text = _XML_INVALID_CHARS.sub("", str(text))
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+def cdata(text):
+    """`text` as a CDATA section. A "]]>" inside it is split across two sections so it cannot end
+    the section early, and characters XML forbids are dropped."""
+    text = _XML_INVALID_CHARS.sub("", str(text))
+    return "<![CDATA[" + text.replace("]]>", "]]]]><![CDATA[>") + "]]>"
+
+def mattext(text):
+    # Questions and options are plain text, but mattext is text/html: escape it, then wrap it in CDATA
+    return f'<material><mattext texttype="text/html">{cdata(html.escape(str(text), quote=False))}</mattext></material>'
+
+def qti_scoring(condition):
+    """The resprocessing block that sets SCORE to 1 when `condition` (a conditionvar body) holds."""
+    return (f'<resprocessing>{QTI_SCORE_OUTCOMES}<respcondition continue="No"><conditionvar>{condition}</conditionvar>'
+            f'<setvar action="Set" varname="SCORE">1</setvar></respcondition></resprocessing>')
+
+def qti_choices(n, options):
+    return "".join(f'<response_label ident="opt_{n}_{j}">{mattext(option)}</response_label>' for j, option in enumerate(options or []))
+
+def qti_item(i, q, item_prefix="q"):
+    """The QTI 1.2 <item> for question `q` at position `i`, supporting multiple question types.
+    Its ident is `item_prefix` followed by the question number."""
+    n = i + 1
+    q_type = q.type.lower().strip()
+    scoring = ""
+
+    if "multiple choice" in q_type or "true/false" in q_type or "true" in q_type:
+        # Response Lid (Single Choice)
+        response = f'<response_lid ident="response_{n}" rcardinality="Single"><render_choice>{qti_choices(n, q.options)}</render_choice></response_lid>'
+        if q.correct_answer_index is not None and isinstance(q.correct_answer_index, int):
+            scoring = qti_scoring(f'<varequal respident="response_{n}">opt_{n}_{q.correct_answer_index}</varequal>')
+
+    elif "multiple select" in q_type or "select all" in q_type:
+        # Response Lid (Multiple Choice - Multiple Response)
+        response = f'<response_lid ident="response_{n}" rcardinality="Multiple"><render_choice>{qti_choices(n, q.options)}</render_choice></response_lid>'
+        if q.correct_answer_index and isinstance(q.correct_answer_index, list):
+            # 'and' block ensuring ALL correct options are selected
+            correct = "".join(f'<varequal respident="response_{n}">opt_{n}_{idx}</varequal>' for idx in q.correct_answer_index)
+            scoring = qti_scoring(f'<and>{correct}</and>')
+
+    elif "short answer" in q_type or "fill" in q_type:
+        # Render FIB (Fill in Blank), just a visual box
+        response = f'<response_str ident="response_{n}" rcardinality="Single"><render_fib><response_label ident="ans_{n}"/></render_fib></response_str>'
+        if q.correct_answer_text:
+            # Case insensitive match usually preferred for short answer
+            scoring = qti_scoring(f'<varequal respident="response_{n}" case="No">{xml_text(q.correct_answer_text)}</varequal>')
+
+    elif "essay" in q_type:
+        # Essay implies manual grading: no scoring condition, but QTI expects resprocessing
+        response = f'<response_str ident="response_{n}" rcardinality="Single"><render_fib/></response_str>'
+        scoring = f'<resprocessing>{QTI_SCORE_OUTCOMES}</resprocessing>'
+
+    else:
+        # Fallback for unknown types (Treat as Essay/Open Text to be safe)
+        response = f'<response_str ident="response_{n}" rcardinality="Single"><render_fib/></response_str>'
+
+    return f'<item ident="{item_prefix}{n}" title="Question {n}"><presentation>{mattext(q.question_text)}{response}</presentation>{scoring}</item>'
+
+def write_quiz_xml(out, questions, title="Generated Quiz", ident="quiz001", item_prefix="q", start=0, bank=False):
+    """Streams quiz.xml (QTI v1.2) for `questions` to the binary file handle `out`, one block of
+    items at a time, so the whole document is never held in memory. Returns the bytes written.
+
+    The document holds one assessment with identifier `ident`, or with `bank` an item bank
+    (objectbank) that Canvas imports as a Question Bank. Questions are numbered from `start` + 1.
+    """
+    with trace_span("render.quiz_xml", items=len(questions)) as span:
+        written = 0
+        if bank:
+            opening = (f'<objectbank ident="{xml_text(ident)}"><qtimetadata><qtimetadatafield><fieldlabel>bank_title</fieldlabel>'
+                       f'<fieldentry>{xml_text(title)}</fieldentry></qtimetadatafield></qtimetadata>')
+            closing = "</objectbank></questestinterop>"
+        else:
+            opening = f'<assessment ident="{xml_text(ident)}" title="{xml_text(title)}"><section ident="sec001" title="Main Section">'
+            closing = "</section></assessment></questestinterop>"
+        block = [QTI_HEADER, opening]
+        block_chars = 0
+        for i, q in enumerate(questions, start=start):
+            item = qti_item(i, q, item_prefix)
+            block.append(item)
+            block_chars += len(item)
+            if block_chars >= QTI_WRITE_BUFFER_CHARS:
+                written += out.write("".join(block).encode("utf-8"))
+                block, block_chars = [], 0
+        block.append(closing)
+        written += out.write("".join(block).encode("utf-8"))
+        span.set(output_bytes=written)
+        return written
+
+def create_quiz_xml(questions, title="Generated Quiz"):
+    """Creates the quiz.xml content (QTI v1.2) as bytes. Packaging streams it with write_quiz_xml() instead."""
+    out = io.BytesIO()
+    write_quiz_xml(out, questions, title)
+    return out.getvalue()
+
+def qti_package_id(title, questions):
+    """Short identifier derived from the content, so every package gets its own QTI idents
+    (Canvas matches imports by ident) while re-exporting the same quiz gives the same ones."""
+    digest = hashlib.sha1("\n".join([title, *(q.question_text for q in questions)]).encode("utf-8")).hexdigest()
+    return digest[:10]
+
+@traced("package.qti_zip")
+def generate_qti_zip(quiz_data, title="Generated Quiz", package_as="quiz", max_items_per_file=QTI_MAX_ITEMS_PER_FILE):
+    """Generates a QTI 1.2 Zip package from a Quiz. Returns a file handle to the archive (see ZipPackageWriter).
+
+    `package_as` is 'quiz' (one assessment, quiz.xml), 'bank' (Canvas item banks) or 'both'.
+    More than `max_items_per_file` questions are split into parts of that size, each its own
+    assessment or bank in quiz_NN.xml / bank_NN.xml, all listed in one manifest. Every QTI file
+    is compressed into the archive as it is written, never built up as one string.
+    """
+    try:
+        if package_as not in QTI_PACKAGE_MODES:
+            raise ValueError(f"package_as must be one of {QTI_PACKAGE_MODES}, not {package_as!r}")
+        questions = quiz_data.questions
+        package_id = qti_package_id(title, questions)
+        chunk_size = max(1, max_items_per_file)
+        chunks = [questions[i:i + chunk_size] for i in range(0, len(questions), chunk_size)] or [[]]
+
+        files = []  # (file name, write_quiz_xml keyword arguments)
+        for kind in ('bank', 'quiz'):
+            if package_as not in (kind, 'both'):
+                continue
+            for k, chunk in enumerate(chunks, start=1):
+                name = "quiz.xml" if package_as == 'quiz' and len(chunks) == 1 else f"{kind}_{k:02d}.xml"
+                files.append((name, dict(
+                    questions=chunk,
+                    title=title if len(chunks) == 1 else f"{title} (Part {k} of {len(chunks)})",
+                    ident=f"{kind}_{package_id}_{k:02d}",
+                    item_prefix=f"{kind[0]}_{package_id}_",
+                    start=(k - 1) * chunk_size,
+                    bank=kind == 'bank',
+                )))
+
+        package = ZipPackageWriter()
+        package.writestr("imsmanifest.xml", create_imsmanifest([name for name, _ in files]))
+        for name, arguments in files:
+            with package.open(name) as member:
+                write_quiz_xml(member, **arguments)
+        return package.close()
+    except Exception as e:
+        report_error(f"Error creating QTI Zip: {e}")
+        return None
+
+# --- Quiz Yield Statistics ---
+
+# How many usable questions quiz batch calls return, per configuration, kept on disk so batch
+# planning improves across sessions
+QUIZ_YIELD_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "quiz_yield.sqlite3")
+# Chance that the planned batches deliver the whole quiz without a top-up round
+QUIZ_YIELD_CONFIDENCE = 0.9
+# Calls recorded for a configuration before its statistics replace the fixed over-provisioning rule
+QUIZ_YIELD_MIN_CALLS = 5
+# Weight kept by earlier calls each time one is recorded, so the statistics follow model changes
+QUIZ_YIELD_DECAY = 0.98
+# Lowest yield planned for, so a run of failures cannot ask for an unbounded number of batches
+QUIZ_YIELD_FLOOR = 0.25
+
+class QuizYieldStats:
+    """SQLite-backed yield statistics for quiz batch calls, keyed by configuration (see make_key()).
+
+    A call's yield is the share of the questions it asked for that were valid and not duplicates.
+    Each configuration keeps an exponentially decayed mean and variance of that yield, plus the
+    share of valid questions dropped as duplicates, so recent calls count most.
+    """
+
+    def __init__(self, path, decay=QUIZ_YIELD_DECAY):
+        self.path = path
+        self.decay = decay
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS yields ("
+                "key TEXT PRIMARY KEY, calls INTEGER NOT NULL, weight REAL NOT NULL, "
+                "yield_sum REAL NOT NULL, yield_sq_sum REAL NOT NULL, duplicate_sum REAL NOT NULL, "
+                "updated REAL NOT NULL)"
+            )
+
+    @staticmethod
+    def make_key(grade_level, question_types, has_source, bank):
+        """The configuration a quiz's calls are pooled under: grade, question type mix, whether a
+        source is attached and whether it is a question bank (whose batches target Bloom's levels)."""
+        return json.dumps([str(grade_level), sorted(question_types or []), bool(has_source), bool(bank)])
+
+    def record(self, key, calls):
+        """Folds finished calls, given as (asked, valid, unique) question counts, into `key`'s statistics."""
+        calls = [(asked, valid, unique) for asked, valid, unique in calls if asked]
+        if not calls:
+            return
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT calls, weight, yield_sum, yield_sq_sum, duplicate_sum FROM yields WHERE key = ?", (key,)
+            ).fetchone()
+            count, weight, total, squares, duplicates = row or (0, 0.0, 0.0, 0.0, 0.0)
+            for asked, valid, unique in calls:
+                share = min(unique / asked, 1.0)
+                count += 1
+                weight = weight * self.decay + 1
+                total = total * self.decay + share
+                squares = squares * self.decay + share * share
+                duplicates = duplicates * self.decay + ((valid - unique) / valid if valid else 0.0)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO yields (key, calls, weight, yield_sum, yield_sq_sum, duplicate_sum, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, count, weight, total, squares, duplicates, time.time())
+            )
+
+    def get(self, key):
+        """Returns {'calls', 'mean', 'stdev', 'duplicate_rate'} for `key`, or None if nothing is recorded."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT calls, weight, yield_sum, yield_sq_sum, duplicate_sum FROM yields WHERE key = ?", (key,)
+            ).fetchone()
+        if not row:
+            return None
+        count, weight, total, squares, duplicates = row
+        mean = total / weight
+        return {"calls": count, "mean": mean, "stdev": math.sqrt(max(squares / weight - mean * mean, 0.0)),
+                "duplicate_rate": duplicates / weight}
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM yields")
+
+_quiz_yield_stats = None
+_quiz_yield_stats_lock = threading.Lock()
+
+def get_quiz_yield_stats():
+    """Returns the process-wide QuizYieldStats, opening it on first use. Returns None if the database
+    cannot be opened, in which case batches are planned with the fixed rule."""
+    global _quiz_yield_stats
+    if _quiz_yield_stats is None:
+        with _quiz_yield_stats_lock:
+            if _quiz_yield_stats is None:
+                try:
+                    _quiz_yield_stats = QuizYieldStats(QUIZ_YIELD_PATH)
+                except (sqlite3.Error, OSError) as e:
+                    report_warning(f"Quiz yield statistics disabled: {e}")
+                    return None
+    return _quiz_yield_stats
+
+def plan_quiz_batches(target_count, batch_size, yield_stats=None, confidence=QUIZ_YIELD_CONFIDENCE):
+    """Number of batches of `batch_size` to request for `target_count` questions.
+
+    A single batch whose expected yield already covers the target is enough: whatever it falls
+    short by comes from a top-up round. Otherwise, with at least QUIZ_YIELD_MIN_CALLS recorded
+    calls, the fewest batches whose total yield reaches the target with probability `confidence`
+    (normal approximation of the sum of per-call yields), or else the fixed rule:
+    (target // batch size) + 2.
+    """
+    known = yield_stats and yield_stats["calls"] >= QUIZ_YIELD_MIN_CALLS
+    mean = max(yield_stats["mean"], QUIZ_YIELD_FLOOR) if known else 1.0
+    if batch_size * mean >= target_count:
+        return 1
+    if not known:
+        return (target_count // batch_size) + 2
+    z = statistics.NormalDist().inv_cdf(confidence)
+    stdev = yield_stats["stdev"]
+    batches = max(1, math.ceil(target_count / (batch_size * mean)))
+    while batches * batch_size * mean - z * math.sqrt(batches) * batch_size * stdev < target_count:
+        batches += 1
+    return batches
+
+def _quiz_yield_lookup(key):
+    stats = get_quiz_yield_stats()
+    if not stats:
+        return None
+    try:
+        return stats.get(key)
+    except sqlite3.Error as e:
+        report_warning(f"Quiz yield statistics read failed: {e}")
+        return None
+
+def _quiz_yield_record(key, calls):
+    stats = get_quiz_yield_stats()
+    if not stats:
+        return
+    try:
+        stats.record(key, calls)
+    except sqlite3.Error as e:
+        report_warning(f"Quiz yield statistics write failed: {e}")
+
+# --- Quiz Generation ---
+
+# Set by configure_quiz_batching()
+_quiz_batch_settings = {}
+
+def configure_quiz_batching(max_input_tokens=None, max_output_tokens=None):
+    """Sets the token ceilings for one quiz batch call in this process. Settings left as None fall
+    back to QUIZ_MAX_INPUT_TOKENS / QUIZ_MAX_OUTPUT_TOKENS and then the defaults above."""
+    _quiz_batch_settings['max_input_tokens'] = max_input_tokens
+    _quiz_batch_settings['max_output_tokens'] = max_output_tokens
+
+def quiz_token_ceilings():
+    """The configured (input, output) token ceilings for one quiz batch call."""
+    max_input = _quiz_batch_settings.get('max_input_tokens') or os.environ.get("QUIZ_MAX_INPUT_TOKENS") or QUIZ_MAX_INPUT_TOKENS
+    max_output = _quiz_batch_settings.get('max_output_tokens') or os.environ.get("QUIZ_MAX_OUTPUT_TOKENS") or QUIZ_MAX_OUTPUT_TOKENS
+    return int(max_input), int(max_output)
+
+def estimate_question_tokens(question_types):
+    """Expected output tokens for one question when a batch mixes `question_types` (the most expensive one)."""
+    return max((QUESTION_TYPE_OUTPUT_TOKENS.get(t, QUESTION_DEFAULT_OUTPUT_TOKENS) for t in question_types or []), default=QUESTION_DEFAULT_OUTPUT_TOKENS)
+
+def quiz_batch_size(target_count, question_types, max_workers=QUIZ_BATCH_MAX_WORKERS, max_output_tokens=None):
+    """Questions to ask for per batch call.
+
+    As many as fit under the output ceiling (with QUIZ_OUTPUT_TOKEN_MARGIN to spare), but no more
+    than it takes to spread the quiz over `max_workers` concurrent batches, so a quiz still arrives
+    in one wave of calls. Never less than QUIZ_MIN_BATCH_QUESTIONS unless the ceiling itself
+    allows fewer, and never more than `target_count`.
+    """
+    if max_output_tokens is None:
+        max_output_tokens = quiz_token_ceilings()[1]
+    per_question = estimate_question_tokens(question_types) * QUIZ_OUTPUT_TOKEN_MARGIN
+    capacity = int((max_output_tokens - QUIZ_RESPONSE_OVERHEAD_TOKENS) // per_question)
+    capacity = max(1, min(capacity, QUIZ_MAX_BATCH_QUESTIONS))
+    spread = math.ceil(target_count / max(1, max_workers))
+    return min(capacity, max(spread, QUIZ_MIN_BATCH_QUESTIONS), max(1, target_count))
+
+async def generate_quiz_json_async(prompt, use_cache=True, variant=0, on_question=None, retry=QUIZ_BATCH_RETRY):
+    """Generates a Quiz from Gemini. `variant` distinguishes repeated batches of the same prompt in the cache.
+
+    If `on_question` is given the response is streamed and `on_question(question)` is called for each
+    question as soon as it is complete. A stream that fails part-way still returns the questions
+    that completed. A batch that fails before producing any
+    question is retried under `retry`.
+    """
+    if not on_question:
+        try:
+            return await generate_json_async(prompt, Quiz, use_cache=use_cache, variant=variant, retry=retry)
+        except Exception as e:
+            report_error(f"Error generating quiz JSON: {e}")
+            return None
+
+    questions = []
+
+    async def attempt(timeout):
+        parser = QuestionStreamParser()
+
+        def on_text(chunk):
+            for question in parser.feed(chunk):
+                questions.append(question)
+                on_question(question)
+
+        try:
+            await generate_text_stream_async(prompt, on_text, config=json_config(Quiz), use_cache=use_cache, variant=variant, parse=Quiz.model_validate_json, timeout=timeout)
+        except Exception as e:
+            if not questions:
+                raise
+            report_warning(f"Quiz batch ended early, keeping {len(questions)} complete questions: {e}")
+
+    try:
+        if retry:
+            await retry.run_async(attempt)
+        else:
+            await attempt(None)
+    except Exception as e:
+        report_error(f"Error generating quiz JSON: {e}")
+        return None
+    return Quiz(questions=questions)
+
+def generate_quiz_json(prompt, use_cache=True, variant=0, on_question=None, retry=QUIZ_BATCH_RETRY):
+    """Synchronous generate_quiz_json_async(). `on_question` is called on the shared event loop's thread."""
+    return run_async(generate_quiz_json_async(prompt, use_cache, variant, on_question, retry))
+
+@traced("quiz")
+@context_cache_scope()
+async def generate_quiz_data_batched_async(topic, subtopic, target_count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text="", context_topics=None, show_progress=True, max_workers=QUIZ_BATCH_MAX_WORKERS, use_cache=True, retry=QUIZ_BATCH_RETRY, batch_focuses=None):
+    """Generates quiz questions in batches to ensure target count is met.
+
+    Batches run as tasks of one TaskGroup, up to `max_workers` at a time, and are streamed, so each
+    question is counted the moment it is complete. Near-duplicate questions are dropped as they
+    arrive. If every batch is back and the quiz is still short, smaller top-up batches ask for just
+    the missing questions. As soon as enough unique questions have arrived, the remaining batches
+    are cancelled, whether still waiting or mid-stream. With `batch_focuses`, batch k asks for
+    questions at level `batch_focuses[k % len(batch_focuses)]` (see construct_quiz_prompt()).
+
+    Batch size follows the token ceilings (see quiz_batch_size() and configure_quiz_batching()), and
+    the source material in each prompt is cut to what fits under the input ceiling. The number of
+    batches is planned from the yield earlier calls with the same configuration achieved (see
+    plan_quiz_batches()), and this quiz's finished batches are added to those statistics.
+    """
+    all_questions = []
+    max_input_tokens, max_output_tokens = quiz_token_ceilings()
+    batch_size = quiz_batch_size(target_count, question_types, max_workers, max_output_tokens)
+    # Over-provision by the recorded yield for this configuration (or the fixed rule, until there is one)
+    yield_key = QuizYieldStats.make_key(grade_level, question_types, source_text, batch_focuses)
+    yield_stats = await asyncio.to_thread(_quiz_yield_lookup, yield_key)
+    num_batches = plan_quiz_batches(target_count, batch_size, yield_stats)
+    dedup = QuestionDedupIndex()
+
+    # Whatever the prompt itself (source section included, here with one character of source)
+    # leaves of the input ceiling goes to source material
+    longest_focus = max(batch_focuses, key=len) if batch_focuses else None
+    bare_prompt = construct_quiz_prompt(topic, subtopic, batch_size, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, "-", context_topics, longest_focus)
+    source_max_chars = max(0, max_input_tokens - estimate_tokens(bare_prompt)) * 4
+    current_span().set(batch_size=batch_size, batches=num_batches, source_max_chars=source_max_chars,
+                       planned_yield=round(yield_stats["mean"], 3) if yield_stats else None)
+    
+    # Unit quizzes run alongside other unit items, which report their own progress
+    progress = get_reporter().progress() if show_progress else None
+    if progress:
+        progress.update(0.0, f"Generating {num_batches} batches...")
+    
+    def build_prompt(count, batch):
+        focus = batch_focuses[batch % len(batch_focuses)] if batch_focuses else None
+        return construct_quiz_prompt(topic, subtopic, count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text, context_topics, focus, source_max_chars)
+    
+    # Batches push (batch, Question) onto `events` for each finished question, then (batch, None)
+    # when they end
+    events = asyncio.Queue()
+    slots = asyncio.Semaphore(max(1, max_workers))
+    
+    async def run_batch(prompt, batch):
+        try:
+            async with slots:
+                await generate_quiz_json_async(prompt, use_cache, batch, on_question=lambda question: events.put_nowait((batch, question)), retry=retry)
+        finally:
+            events.put_nowait((batch, None))
+    
+    batches = []
+    running = 0
+    # Per batch: questions asked for, valid questions received and unique ones kept, and whether it ended
+    asked = {}
+    valid = collections.Counter()
+    unique = collections.Counter()
+    ended = set()
+    
+    try:
+        async with asyncio.TaskGroup() as group:
+            def submit(count, n):
+                nonlocal running
+                for _ in range(n):
+                    # The batch number keeps repeated prompts apart in the response cache
+                    batch = len(batches)
+                    batches.append(group.create_task(run_batch(build_prompt(count, batch), batch)))
+                    asked[batch] = count
+                    running += 1
+        
+            # Every full batch asks for the same number of questions
+            # Note: We use batch_size here, not target_count
+            submit(batch_size, num_batches)
+            top_up_rounds = 0
+        
+            while running:
+                batch, event = await events.get()
+                if event is None:
+                    running -= 1
+                    ended.add(batch)
+                else:
+                    valid[batch] += 1
+                    if dedup.add(event):
+                        unique[batch] += 1
+                        all_questions.append(event)
+            
+                # Update progress
+                if progress:
+                    progress.update(min(len(all_questions) / target_count, 1.0), f"Received {min(len(all_questions), target_count)}/{target_count} questions ({len(ended)}/{len(batches)} batches done, {dedup.duplicates} duplicates dropped)...{rate_limit_status()}")
+            
+                # Early break if we have enough
+                if len(all_questions) >= target_count:
+                    break
+            
+                # Everything is back but duplicates left us short: ask only for what is missing
+                if not running and top_up_rounds < QUIZ_MAX_TOP_UP_ROUNDS:
+                    top_up_rounds += 1
+                    missing = target_count - len(all_questions)
+                    full_batches, remainder = divmod(missing, batch_size)
+                    if full_batches:
+                        submit(batch_size, full_batches)
+                    if remainder:
+                        submit(remainder, 1)
+        
+            # Drop over-provisioned batches that are no longer needed
+            for task in batches:
+                task.cancel()
+    finally:
+        if progress:
+            progress.close()
+
+    # A batch's yield is known if it ran to the end, or if every question it asked for arrived
+    # before the quiz filled up; batches cut short say nothing about it
+    finished = [(asked[b], valid[b], unique[b]) for b in asked if b in ended or valid[b] >= asked[b]]
+    await asyncio.to_thread(_quiz_yield_record, yield_key, finished)
+    
+    current_span().set(questions=min(len(all_questions), target_count), duplicates_dropped=dedup.duplicates)
+    # Trim to exact count
+    return Quiz(questions=all_questions[:target_count])
+
+def generate_quiz_data_batched(topic, subtopic, target_count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text="", context_topics=None, show_progress=True, max_workers=QUIZ_BATCH_MAX_WORKERS, use_cache=True, retry=QUIZ_BATCH_RETRY, batch_focuses=None):
+    """Synchronous generate_quiz_data_batched_async()."""
+    return run_async(generate_quiz_data_batched_async(topic, subtopic, target_count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text, context_topics, show_progress, max_workers, use_cache, retry, batch_focuses))
+
+async def generate_question_bank_async(topic, subtopic, target_count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text="", show_progress=True, use_cache=True):
+    """Generates a large set of questions (up to QUESTION_BANK_MAX_QUESTIONS) for a question bank.
+
+    Like generate_quiz_data_batched_async(), with more batches in flight and each batch aimed at a
+    different cognitive level, so hundreds of questions come back quickly and with few duplicates.
+    """
+    return await generate_quiz_data_batched_async(topic, subtopic, min(target_count, QUESTION_BANK_MAX_QUESTIONS), due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text, show_progress=show_progress, max_workers=QUESTION_BANK_MAX_WORKERS, use_cache=use_cache, batch_focuses=QUESTION_BANK_FOCUSES)
+
+def generate_question_bank(topic, subtopic, target_count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text="", show_progress=True, use_cache=True):
+    """Synchronous generate_question_bank_async()."""
+    return run_async(generate_question_bank_async(topic, subtopic, target_count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text, show_progress, use_cache))
+
+@traced("unit_sequence")
+async def generate_unit_sequence_json_async(prompt, use_cache=True, retry=UNIT_SEQUENCE_RETRY):
+    """Generates the Unit Sequence (a list of UnitItem) from Gemini."""
+    try:
+        return await generate_json_async(prompt, list[UnitItem], use_cache=use_cache, retry=retry)
+    except Exception as e:
+        report_error(f"Error generating unit sequence: {e}")
+        return None
+
+def generate_unit_sequence_json(prompt, use_cache=True, retry=UNIT_SEQUENCE_RETRY):
+    """Synchronous generate_unit_sequence_json_async()."""
+    return run_async(generate_unit_sequence_json_async(prompt, use_cache, retry))
+
+# --- Unit Pipeline Executor ---
+
+# Maximum number of unit steps (HTML, Lesson Plan, Slides, Quiz) running at the same time
+UNIT_MAX_WORKERS = 4
+
+# Live Assignment preview: minimum seconds between redraws, and how much of the document to show
+ASSIGNMENT_PREVIEW_INTERVAL = 0.25
+ASSIGNMENT_PREVIEW_CHARS = 4000
+
+# Retries a whole unit may spend, per file it contains
+UNIT_RETRIES_PER_FILE = 1
+
+# Questions requested for each unit Quiz
+UNIT_QUIZ_QUESTIONS = 10
+
+# When a Lesson Plan fails, Slides are built from this much of the Assignment text instead
+SLIDES_FALLBACK_SOURCE_CHARS = 6000
+
+class UnitFileOutcome(BaseModel):
+    """What happened to one file of a unit, as listed in unit_manifest.json."""
+    item: int
+    kind: Literal['assignment', 'lesson_plan', 'slides', 'quiz']
+    title: str
+    file: Optional[str] = None
+    status: Literal['ok', 'retried', 'degraded', 'failed'] = 'ok'
+    attempts: int = 1
+    notes: List[str] = []
+
+class UnitManifest(BaseModel):
+    """unit_manifest.json: which files of a unit succeeded, were retried, were degraded or failed."""
+    topic: str
+    generated_at: str
+    counts: dict[str, int]
+    retry_budget_left: int
+    files: List[UnitFileOutcome]
+
+def record_failures(outcome, budget):
+    """Returns an on_failure hook for RetryPolicy that logs each failed try in `outcome`."""
+    def on_failure(error, will_retry):
+        message = str(error)[:300]
+        if will_retry:
+            outcome.attempts += 1
+            outcome.notes.append(f"Retried after: {message}")
+        elif budget.remaining <= 0 and is_retryable_error(error):
+            outcome.notes.append(f"Gave up, unit retry budget spent: {message}")
+        else:
+            outcome.notes.append(f"Gave up: {message}")
+    return on_failure
+
+def strip_html(html):
+    """Plain text of an HTML document, for use as prompt source material."""
+    text = re.sub(r'(?is)<(script|style)\b.*?</\1>', ' ', html)
+    text = re.sub(r'<[^>]+>', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+async def run_task_graph(tasks, max_workers=UNIT_MAX_WORKERS, on_task_done=None, labels=None, on_task_error=None):
+    """Runs a dependency graph of coroutine tasks in one TaskGroup.
+
+    `tasks` maps a task key to `(fn, deps)`. Once every key in `deps` has finished, a task queues
+    for one of `max_workers` slots (tasks that become ready together queue in `tasks` order) and
+    `fn` is awaited with a dict of those dependency results. A task that raises is reported
+    through the Reporter, passed to `on_task_error(key, error)` if given, and recorded as None so
+    dependents still run. `on_task_done(key, result)` is called as each task completes. Each task is traced as a `task` span named by `labels[key]` if given.
+    Returns {key: result}.
+    """
+    for key, (_, deps) in tasks.items():
+        for dep in deps:
+            if dep not in tasks:
+                raise ValueError(f"Task {key!r} depends on unknown task {dep!r}")
+
+    # Create tasks in dependency order, so each one can await the tasks it depends on
+    order = []
+    waiting = list(tasks)  # Preserves insertion order so earlier items are scheduled first
+    while waiting:
+        ready = [key for key in waiting if all(dep in order for dep in tasks[key][1])]
+        if not ready:
+            raise ValueError(f"Task graph has a dependency cycle: {waiting}")
+        order.extend(ready)
+        waiting = [key for key in waiting if key not in ready]
+
+    labels = labels or {}
+    slots = asyncio.Semaphore(max(1, max_workers))
+    results = {}
+    running = {}
+
+    async def run_task(key, fn, deps):
+        dep_results = {dep: await running[dep] for dep in deps}
+        async with slots:
+            try:
+                with trace_span("task", task=labels.get(key, str(key))):
+                    results[key] = await fn(dep_results)
+            except Exception as e:
+                report_error(f"Error generating {labels.get(key, key)}: {e}")
+                if on_task_error:
+                    on_task_error(key, e)
+                results[key] = None
+        if on_task_done:
+            on_task_done(key, results[key])
+        return results[key]
+
+    async with asyncio.TaskGroup() as group:
+        for key in order:
+            fn, deps = tasks[key]
+            running[key] = group.create_task(run_task(key, fn, deps))
+
+    return results
+
+class HtmlFenceStripper:
+    """Strips a leading ```html fence and a trailing ``` fence from text that arrives in chunks.
+
+    Matches the whole-document cleanup below, but only holds text back while it could still be
+    part of a fence (the first 7 characters and the last 3); everything else is released as soon
+    as it arrives.
+    """
+    OPEN = "```html"
+    CLOSE = "```"
+
+    def __init__(self):
+        self._head = ""
+        self._tail = ""
+        self._started = False
+
+    def feed(self, chunk):
+        """Adds a chunk and returns the cleaned text that is now safe to show."""
+        if not self._started:
+            self._head += chunk
+            if len(self._head) < len(self.OPEN) and self.OPEN.startswith(self._head):
+                return ""
+            self._started = True
+            chunk = self._head[len(self.OPEN):] if self._head.startswith(self.OPEN) else self._head
+            self._head = ""
+
+        text = self._tail + chunk
+        self._tail = text[-len(self.CLOSE):]
+        return text[:-len(self.CLOSE)]
+
+    def finish(self):
+        """Returns whatever was held back, minus a closing fence."""
+        text = self._head + self._tail
+        self._head = self._tail = ""
+        if text.endswith(self.CLOSE):
+            text = text[:-len(self.CLOSE)]
+        return text
+
+@traced("assignment_html")
+async def generate_unit_assignment_html_async(prompt, title="Assignment", use_cache=True, on_update=None, retry=ASSIGNMENT_RETRY):
+    """Generates the HTML for one unit Assignment. Returns the HTML string or None on failure.
+
+    If `on_update` is given the response is streamed, and `on_update(html_so_far)` is called with
+    the fence-stripped document as it grows, at most once per ASSIGNMENT_PREVIEW_INTERVAL and once
+    more with the finished document. A retried stream starts the document over.
+    """
+    async def attempt(timeout):
+        if on_update:
+            stripper = HtmlFenceStripper()
+            parts = []
+            last_update = 0.0
+
+            def on_text(chunk):
+                nonlocal last_update
+                cleaned = stripper.feed(chunk)
+                if cleaned:
+                    parts.append(cleaned)
+                    # Join the document only when it is due to be shown, not on every chunk
+                    now = time.monotonic()
+                    if now - last_update >= ASSIGNMENT_PREVIEW_INTERVAL:
+                        last_update = now
+                        on_update("".join(parts))
+
+            await generate_text_stream_async(prompt, on_text, use_cache=use_cache, timeout=timeout)
+            parts.append(stripper.finish())
+            html_content = "".join(parts)
+            on_update(html_content)
+            return html_content
+
+        html_content = await generate_text_async(prompt, use_cache=use_cache, timeout=timeout)
+        # Clean markdown code blocks if present
+        if html_content.startswith("```html"):
+            html_content = html_content[7:]
+        if html_content.endswith("```"):
+            html_content = html_content[:-3]
+        return html_content
+
+    try:
+        return await (retry.run_async(attempt) if retry else attempt(None))
+    except Exception as e:
+        report_error(f"Error generating assignment {title}: {e}")
+        return None
+
+def generate_unit_assignment_html(prompt, title="Assignment", use_cache=True, on_update=None, retry=ASSIGNMENT_RETRY):
+    """Synchronous generate_unit_assignment_html_async(). `on_update` is called on the shared event loop's thread."""
+    return run_async(generate_unit_assignment_html_async(prompt, title, use_cache, on_update, retry))
+
+@traced("unit_package")
+@context_cache_scope()
+async def generate_unit_package_async(sequence_data, topic, grade_level, is_sped, is_gifted, is_ml, language, subject, strategy, source_text, due_date, due_time, points, points_per_question, question_types, standard="General Standard", max_workers=UNIT_MAX_WORKERS, use_cache=True, stream_preview=True, on_manifest=None):
+    """Generates all files for a unit and zips them, including Lesson Plans and Slides for each Assignment.
+
+    Independent items run concurrently as tasks of one TaskGroup (up to `max_workers` at a time, see
+    run_task_graph()). Slides still wait for their Lesson Plan,
+    and each Quiz still waits for the Assignments whose focus topics feed its context. Files are
+    written to the zip in sequence order, so the archive layout matches a one-at-a-time run.
+    With `stream_preview`, Assignment HTML is streamed and shown in the Reporter's preview as it is written.
+    With a SourceIndex as `source_text`, each Assignment and Quiz gets the source passages about its own focus.
+
+    Every call is retried under its RetryPolicy, sharing a budget of UNIT_RETRIES_PER_FILE retries
+    per file. Whatever still fails is left out, and unit_manifest.json in the archive lists each
+    file as ok, retried, degraded or failed; `on_manifest(manifest)` receives the same UnitManifest.
+    Returns a file handle to the archive (see ZipPackageWriter).
+    """
+    last_preview = [0.0]
+
+    def show_preview(title, html_so_far, final=False):
+        # Throttle redraws; several Assignments may be streaming at once. The finished document is
+        # always shown, so the preview never stops short of the end
+        now = time.monotonic()
+        if not final and now - last_preview[0] < ASSIGNMENT_PREVIEW_INTERVAL:
+            return
+        last_preview[0] = now
+        preview_display.show(title, html_so_far[-ASSIGNMENT_PREVIEW_CHARS:])
+
+    async def assignment_html(prompt, title, on_update, retry):
+        html_content = await generate_unit_assignment_html_async(prompt, title, use_cache, on_update, retry=retry)
+        if on_update and html_content:
+            show_preview(title, html_content, final=True)
+        return html_content
+
+    tasks = {}
+    labels = {}
+    outcomes = {}
+    budget = RetryBudget(0)  # Sized once the number of files is known
+    context_sources = []  # (html task key, focus) of Assignments since the last Quiz
+
+    def retry_for(policy, key):
+        return policy.bind(budget, record_failures(outcomes[key], budget))
+
+    sequence_data = [UnitItem.model_validate(item) for item in sequence_data]
+
+    for i, item in enumerate(sequence_data):
+        idx = i + 1
+        item_type = item.type
+        title = item.title
+        focus = item.focus_topic or topic
+
+        if item_type == "Assignment":
+            # --- Step 1: Assignment HTML ---
+            prompt = construct_assignment_prompt(topic, focus, "None", due_date, due_time, points, grade_level, is_sped, is_gifted, is_ml, language, subject, strategy, source_text)
+            on_update = (lambda html_so_far, title=title: show_preview(title, html_so_far)) if stream_preview else None
+            outcomes[(idx, 'html')] = UnitFileOutcome(item=idx, kind='assignment', title=title)
+            tasks[(idx, 'html')] = (
+                lambda deps, idx=idx, prompt=prompt, title=title, on_update=on_update: assignment_html(
+                    prompt, title, on_update, retry_for(ASSIGNMENT_RETRY, (idx, 'html'))
+                ),
+                []
+            )
+            labels[(idx, 'html')] = f"Assignment {idx}: {title} (HTML)"
+            context_sources.append(((idx, 'html'), focus))
+
+            # --- Step 2: Lesson Plan PDF (with focus-specific content) ---
+            outcomes[(idx, 'lesson_plan')] = UnitFileOutcome(item=idx, kind='lesson_plan', title=title)
+            tasks[(idx, 'lesson_plan')] = (
+                lambda deps, idx=idx, focus=focus: generate_lesson_plan_pdf_async(
+                    topic=f"{topic}: {focus}",  # Include subtopic for specificity
+                    standard=standard,
+                    grade=grade_level,
+                    strategy=strategy,
+                    use_cache=use_cache,
+                    retry=retry_for(LESSON_PLAN_RETRY, (idx, 'lesson_plan'))
+                ),
+                []
+            )
+            labels[(idx, 'lesson_plan')] = f"Assignment {idx}: {title} (Lesson Plan)"
+
+            # --- Step 3: Slide Deck (CHAINED from Lesson Plan to prevent overlap) ---
+            # CRITICAL: Pass lesson_plan_text as source_text to ensure slides are
+            # complementary (keywords only) and don't duplicate lesson plan content
+            outcomes[(idx, 'slides')] = UnitFileOutcome(item=idx, kind='slides', title=title)
+
+            async def slides_task(deps, idx=idx, focus=focus):
+                outcome = outcomes[(idx, 'slides')]
+                lesson_plan = deps[(idx, 'lesson_plan')]
+                lesson_plan_text = lesson_plan[1] if lesson_plan else ""
+                if not lesson_plan_text:
+                    # Never build slides from nothing: fall back to the Assignment, or skip them
+                    html_content = deps[(idx, 'html')]
+                    if not html_content:
+                        outcome.notes.append("Skipped: neither the Lesson Plan nor the Assignment was generated")
+                        return None
+                    lesson_plan_text = strip_html(html_content)[:SLIDES_FALLBACK_SOURCE_CHARS]
+                    outcome.status = 'degraded'
+                    outcome.notes.append("Lesson Plan unavailable; slides were built from the Assignment instead")
+                return await generate_slide_deck_async(
+                    topic=f"{topic}: {focus}",
+                    grade=grade_level,
+                    strategy=strategy,
+                    source_text=lesson_plan_text,
+                    use_cache=use_cache,
+                    retry=retry_for(SLIDES_RETRY, (idx, 'slides'))
+                )
+            tasks[(idx, 'slides')] = (slides_task, [(idx, 'lesson_plan'), (idx, 'html')])
+            labels[(idx, 'slides')] = f"Assignment {idx}: {title} (Slides)"
+
+        elif item_type == "Quiz":
+            # Use the focus of every Assignment since the last Quiz (that generated successfully)
+            # for contextual awareness.
+            outcomes[(idx, 'quiz')] = UnitFileOutcome(item=idx, kind='quiz', title=title)
+
+            async def quiz_task(deps, idx=idx, focus=focus, title=title, sources=list(context_sources)):
+                outcome = outcomes[(idx, 'quiz')]
+                context_buffer = [f for key, f in sources if deps[key] is not None]
+                quiz_data = await generate_quiz_data_batched_async(topic, focus, UNIT_QUIZ_QUESTIONS, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text, context_topics=context_buffer, show_progress=False, use_cache=use_cache, retry=retry_for(QUIZ_BATCH_RETRY, (idx, 'quiz')))
+                if not quiz_data or not quiz_data.questions:
+                    return None
+                if len(context_buffer) < len(sources):
+                    outcome.status = 'degraded'
+                    outcome.notes.append(f"Written without the focus of {len(sources) - len(context_buffer)} Assignment(s) that failed")
+                if len(quiz_data.questions) < UNIT_QUIZ_QUESTIONS:
+                    outcome.status = 'degraded'
+                    outcome.notes.append(f"Only {len(quiz_data.questions)} of {UNIT_QUIZ_QUESTIONS} questions were generated")
+                return await asyncio.to_thread(generate_qti_zip, quiz_data, title=title)
+            tasks[(idx, 'quiz')] = (quiz_task, [key for key, _ in context_sources])
+            labels[(idx, 'quiz')] = f"Quiz {idx}: {title}"
+
+            # Clear context after quiz
+            context_sources = []
+
+    budget.remaining = len(tasks) * UNIT_RETRIES_PER_FILE
+    total_steps = len(tasks)
+    completed = []
+
+    def on_task_error(key, error):
+        outcomes[key].notes.append(f"Failed: {str(error)[:300]}")
+
+    def on_task_done(key, result):
+        completed.append(key)
+        progress.update(len(completed) / total_steps, f"Finished {labels[key]} ({len(completed)}/{total_steps})...{rate_limit_status()}")
+
+    # Write artifacts in sequence order so the archive matches a sequential run (on a worker
+    # thread, since compressing a large unit would hold up every other call on the event loop)
+    def write_package():
+        zf = ZipPackageWriter()
+        try:
+            for i, item in enumerate(sequence_data):
+                idx = i + 1
+                safe_title = item.title.replace(" ", "_").replace("/", "-")
+
+                if item.type == "Assignment":
+                    html_content = results.get((idx, 'html'))
+                    if html_content is not None:
+                        outcomes[(idx, 'html')].file = f"{idx:02d}_Assignment_{safe_title}.html"
+                        zf.writestr(outcomes[(idx, 'html')].file, html_content)
+
+                    lesson_plan = results.get((idx, 'lesson_plan'))
+                    if lesson_plan and lesson_plan[0]:
+                        outcomes[(idx, 'lesson_plan')].file = f"{idx:02d}_LessonPlan_{safe_title}.pdf"
+                        zf.writestr(outcomes[(idx, 'lesson_plan')].file, lesson_plan[0])
+
+                    slide_deck_pptx = results.get((idx, 'slides'))
+                    if slide_deck_pptx:
+                        outcomes[(idx, 'slides')].file = f"{idx:02d}_Slides_{safe_title}.pptx"
+                        zf.writestr(outcomes[(idx, 'slides')].file, slide_deck_pptx)
+
+                elif item.type == "Quiz":
+                    qti_zip = results.get((idx, 'quiz'))
+                    if qti_zip:
+                        outcomes[(idx, 'quiz')].file = f"{idx:02d}_Quiz_{safe_title}.zip"
+                        zf.writestr(outcomes[(idx, 'quiz')].file, qti_zip)
+
+            for outcome in outcomes.values():
+                if outcome.file is None:
+                    outcome.status = 'failed'
+                elif outcome.status == 'ok' and outcome.attempts > 1:
+                    outcome.status = 'retried'
+            counts = collections.Counter(outcome.status for outcome in outcomes.values())
+            manifest = UnitManifest(
+                topic=topic,
+                generated_at=datetime.datetime.now().isoformat(timespec='seconds'),
+                counts={status: counts.get(status, 0) for status in ('ok', 'retried', 'degraded', 'failed')},
+                retry_budget_left=budget.remaining,
+                files=list(outcomes.values()),
+            )
+            zf.writestr("unit_manifest.json", manifest.model_dump_json(indent=2))
+        finally:
+            unit_package = zf.close()
+        return unit_package, manifest
+
+    progress = get_reporter().progress()
+    preview_display = get_reporter().preview() if stream_preview else None
+    try:
+        progress.update(0.0, f"Generating {total_steps} unit resources...")
+        results = await run_task_graph(tasks, max_workers=max_workers, on_task_done=on_task_done, labels=labels, on_task_error=on_task_error)
+        unit_package, manifest = await asyncio.to_thread(write_package)
+    finally:
+        # Clear the widgets even if a task failed or the job was cancelled
+        progress.close()
+        if preview_display:
+            preview_display.close()
+    if manifest.counts['failed'] or manifest.counts['degraded']:
+        report_warning(f"Unit finished with {manifest.counts['failed']} missing and {manifest.counts['degraded']} degraded files "
+                       f"({manifest.counts['retried']} recovered by retrying). See unit_manifest.json in the download for details.")
+    if on_manifest:
+        on_manifest(manifest)
+    return unit_package
+
+def generate_unit_package(sequence_data, topic, grade_level, is_sped, is_gifted, is_ml, language, subject, strategy, source_text, due_date, due_time, points, points_per_question, question_types, standard="General Standard", max_workers=UNIT_MAX_WORKERS, use_cache=True, stream_preview=True, on_manifest=None):
+    """Synchronous generate_unit_package_async(). `on_manifest` is called on the calling thread."""
+    manifests = []
+    unit_package = run_async(generate_unit_package_async(sequence_data, topic, grade_level, is_sped, is_gifted, is_ml, language, subject, strategy, source_text, due_date, due_time, points, points_per_question, question_types, standard, max_workers, use_cache, stream_preview, manifests.append))
+    if on_manifest:
+        on_manifest(manifests[0])
+    return unit_package
+
+# --- Lesson Plan PDF ---
+
+# Word-break characters FPDF.multi_cell() recognises in latin-1 text
+_PDF_BREAK_CHARS = " \t"
+
+def pdf_safe_text(text):
+    """`text` with characters the core PDF fonts cannot encode (outside latin-1) replaced by '?'."""
+    if text.isascii():
+        return text
+    return text.encode('latin-1', 'replace').decode('latin-1')
+
+def wrap_pdf_text(text, widths, max_units):
+    """Splits `text` into lines exactly where FPDF.multi_cell(align='J') would break it.
+
+    `widths` maps a latin-1 code point to its glyph width and `max_units` is the line width, both in
+    the font's 1/1000 em units. Returns (line, width_units, justified, ends_with_newline) tuples:
+    lines broken at a word are justified; the last line, hard breaks and words split mid-word are not.
+    """
+    lines = []
+    start, n = 0, len(text)
+    while start < n:
+        units = space_units = 0
+        space = -1
+        i = start
+        while i < n:
+            char = text[i]
+            if char == "\n":
+                lines.append((text[start:i], units, False, True))
+                start = i + 1
+                break
+            width = widths[ord(char)]
+            if units + width > max_units:
+                if char in _PDF_BREAK_CHARS:
+                    # An overflowing space is dropped and the line breaks there
+                    lines.append((text[start:i], units, True, False))
+                    start = i + 1
+                elif space >= 0:
+                    lines.append((text[start:space], space_units, True, False))
+                    start = space + 1
+                else:
+                    # A single word wider than the line is split (always keep one character)
+                    i = max(i, start + 1)
+                    lines.append((text[start:i], units if i > start + 1 else width, False, False))
+                    start = i
+                break
+            if char in _PDF_BREAK_CHARS:
+                space, space_units = i, units
+            units += width
+            i += 1
+        else:
+            if units:
+                lines.append((text[start:], units, False, False))
+            start = n
+    return lines
+
+class LessonPlanTemplate:
+    """The fixed layout of the one-page 5E lesson plan, compiled once per process.
+
+    Holds the page geometry, colours and a glyph-width table for each font the plan uses, so
+    rendering a plan only lays out its own text. Text blocks are wrapped with wrap_pdf_text() and
+    drawn line by line, giving the same output as FPDF.multi_cell(), whose line breaker re-measures
+    the whole line for every character and was most of the cost of a plan.
+    """
+
+    # Colours
+    header_bg = (30, 36, 58)  # Dark Blue
+    sidebar_bg = (240, 244, 248)  # Light Grey/Blue
+    header_text_color = (255, 255, 255)
+    subtitle_color = (200, 200, 200)  # Light Grey
+    accent_color = (13, 148, 136)  # Teal
+    text_color = (0, 0, 0)
+
+    # Geometry (mm on US Letter): full-width header, left sidebar, main column
+    page_width = 216
+    page_bottom = 279
+    header_height = 38  # 1.5 inch approx 38mm
+    sidebar_width = 64  # Left 2.5 inches -> 63.5mm
+    sidebar_x = 5
+    sidebar_text_width = 55
+    main_x = sidebar_width + 10  # 74mm
+    main_width = 130
+    content_top = 45
+    # Sections starting below these are dropped to keep the plan on one page
+    sidebar_bottom = 250
+    main_bottom = 260
+    # Longer standards and activities are cut with an ellipsis
+    standard_max_chars = 120
+    activity_max_chars = 400
+
+    def __init__(self, direct_lines=True):
+        pdf = FPDF(orientation='P', unit='mm', format='Letter')
+        self.k = pdf.k
+        self.c_margin = pdf.c_margin
+        # Helvetica glyph widths by style, indexed by latin-1 code point
+        self.widths = {style: [CORE_FONTS_CHARWIDTHS['helvetica' + style][chr(code)] for code in range(256)]
+                       for style in ('', 'B', 'I', 'BI')}
+        # Lines are drawn through FPDF's own single-line renderer (private API, checked against the
+        # fpdf2 range in requirements.txt); fall back to multi_cell() if this release does not have it
+        self.direct_lines = direct_lines and hasattr(pdf, '_render_styled_text_line') and hasattr(pdf, '_preload_font_styles')
+
+    def text_block(self, pdf, w, h, text):
+        """Draws `text` at the current position like pdf.multi_cell(w, h, text), in the current font."""
+        if self.direct_lines:
+            x, y = pdf.get_x(), pdf.get_y()
+            try:
+                self._draw_lines(pdf, w, h, text)
+                return
+            except (TypeError, AttributeError):
+                # fpdf2 changed its private line renderer; use multi_cell() from now on
+                self.direct_lines = False
+                pdf.set_xy(x, y)
+        pdf.multi_cell(w, h, text)
+
+    def _draw_lines(self, pdf, w, h, text):
+        if w == 0:
+            w = pdf.w - pdf.r_margin - pdf.x
+        text = pdf.normalize_text(text).replace("\r", "")
+        scale = pdf.font_size_pt * 0.001 / self.k
+        lines = wrap_pdf_text(text, self.widths[pdf.font_style], (w - 2 * self.c_margin + 1e-9) / scale)
+        if not lines:
+            lines = [("", 0, False, False)]  # multi_cell() always draws at least one line
+        last = len(lines) - 1
+        for i, (line, units, justified, _) in enumerate(lines):
+            line = line.replace("\u00a0", " ")  # multi_cell() draws no-break spaces as spaces
+            text_line = TextLine(
+                pdf._preload_font_styles(line, False) if line else [],
+                text_width=units * scale,
+                number_of_spaces=sum(map(line.count, _PDF_BREAK_CHARS)),
+                align=Align.J if justified else Align.L,
+                height=h,
+                max_width=w,
+                trailing_nl=lines[i][3],
+            )
+            pdf._render_styled_text_line(text_line, h=h, new_x=XPos.RIGHT if i == last else XPos.LEFT, new_y=YPos.NEXT)
+        if lines[-1][3]:
+            # Like multi_cell(), text ending in a newline leaves a blank line after it
+            pdf.ln()
+
+    def render(self, data, topic, standard, grade, strategy="None / Standard"):
+        """Renders a LessonPlan as the High-Design one-page PDF. Returns the PDF bytes."""
+        pdf = FPDF(orientation='P', unit='mm', format='Letter')
+        pdf.add_page()
+        pdf.set_auto_page_break(auto=False) # Disable auto page break
+
+        # --- Header (Full Width) ---
+        pdf.set_fill_color(*self.header_bg)
+        pdf.rect(0, 0, self.page_width, self.header_height, 'F')
+
+        pdf.set_text_color(*self.header_text_color)
+        pdf.set_font("Helvetica", 'B', 16)
+        pdf.set_xy(10, 10)
+        pdf.cell(0, 8, pdf_safe_text(f"Lesson Plan: {topic}"), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+        # Strategy (Top Right)
+        pdf.set_xy(120, 10)
+        pdf.set_font("Helvetica", 'I', 10)
+        pdf.cell(86, 8, pdf_safe_text(f"Strategy: {strategy}"), new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='R')
+
+        pdf.set_font("Helvetica", '', 10)
+        pdf.set_text_color(*self.subtitle_color)
+        pdf.set_xy(10, 20)
+        pdf.cell(0, 5, pdf_safe_text(f"Grade: {grade}"), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+        std_desc = standard
+        if len(std_desc) > self.standard_max_chars:
+            std_desc = std_desc[:self.standard_max_chars - 3] + "..."
+        self.text_block(pdf, 0, 5, pdf_safe_text(f"Standard: {std_desc}"))
+
+        # --- Sidebar ---
+        pdf.set_fill_color(*self.sidebar_bg)
+        pdf.rect(0, self.header_height, self.sidebar_width, self.page_bottom - self.header_height, 'F')
+
+        pdf.set_text_color(*self.text_color)
+        x_pos = self.sidebar_x
+        y_pos = self.content_top
+
+        def sidebar_section(title, items):
+            nonlocal y_pos
+            if y_pos > self.sidebar_bottom: return # Stop if too low
+            pdf.set_xy(x_pos, y_pos)
+            pdf.set_font("Helvetica", 'B', 9)
+            pdf.cell(50, 5, title.upper(), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+            pdf.set_font("Helvetica", '', 8)
+            if isinstance(items, list):
+                content_str = "".join(f"- {item}\n" for item in items)
+            else:
+                content_str = items
+            pdf.set_x(x_pos)
+            self.text_block(pdf, self.sidebar_text_width, 4, pdf_safe_text(content_str))
+            y_pos = pdf.get_y() + 10
+
+        def differentiation_group(label, items):
+            pdf.set_xy(x_pos, y_pos)
+            pdf.set_font("Helvetica", 'BI', 8)
+            pdf.cell(50, 4, label, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+            pdf.set_font("Helvetica", '', 8)
+            for item in items[:3]: # Limit to 3 items
+                pdf.set_x(x_pos)
+                self.text_block(pdf, self.sidebar_text_width, 4, pdf_safe_text(f"- {item}"))
+
+        sidebar_section("Duration", data.metadata.duration or '60 mins')
+        sidebar_section("Materials", data.metadata.materials)
+        sidebar_section("Vocabulary", data.metadata.vocabulary)
+
+        # Differentiation
+        if y_pos < self.sidebar_bottom:
+            pdf.set_xy(x_pos, y_pos)
+            pdf.set_font("Helvetica", 'B', 9)
+            pdf.cell(50, 5, "DIFFERENTIATION", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+            y_pos = pdf.get_y()
+
+            diff = data.metadata.differentiation
+            if diff.sped:
+                differentiation_group("SPED:", diff.sped)
+                y_pos = pdf.get_y() + 2
+            if diff.ml and y_pos < self.sidebar_bottom:
+                differentiation_group("ML Support:", diff.ml)
+
+        # --- Main Content (Right Side) ---
+        pdf.set_draw_color(200, 200, 200)
+        pdf.line(self.sidebar_width, self.header_height, self.sidebar_width, self.page_bottom)
+
+        y_pos = self.content_top
+        for section in data.sections:
+            if y_pos > self.main_bottom: break # Stop if page full
+
+            pdf.set_xy(self.main_x, y_pos)
+            pdf.set_font("Helvetica", 'B', 11)
+            pdf.set_text_color(*self.accent_color)
+            pdf.cell(self.main_width, 6, pdf_safe_text(f"{section.phase or 'Phase'} ({section.time})"), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+            y_pos += 6
+
+            pdf.set_xy(self.main_x, y_pos)
+            pdf.set_font("Helvetica", '', 10)
+            pdf.set_text_color(*self.text_color)
+            activity = section.activity
+            if len(activity) > self.activity_max_chars:
+                activity = activity[:self.activity_max_chars - 3] + "..."
+            self.text_block(pdf, self.main_width, 5, pdf_safe_text(activity))
+            y_pos = pdf.get_y() + 6
+
+        return bytes(pdf.output())
+
+@functools.lru_cache(maxsize=None)
+def lesson_plan_template():
+    """The process-wide LessonPlanTemplate, compiled on first use."""
+    return LessonPlanTemplate()
+
+@traced("render.lesson_plan_pdf")
+def render_lesson_plan_pdf(data, topic, standard, grade, strategy="None / Standard"):
+    """Renders a LessonPlan as the High-Design one-page PDF. Returns the PDF bytes."""
+    return lesson_plan_template().render(data, topic, standard, grade, strategy)
+
+def render_lesson_plan_pdfs(plans):
+    """Renders many lesson plans in one pass with the shared template.
+
+    Each plan is a dict with 'plan' (a LessonPlan, its dict or its JSON text, e.g. a saved Gemini
+    response), 'topic', 'standard', 'grade' and optionally 'strategy'. Returns one PDF per plan, in
+    order, with None for plans that fail validation (reported as errors).
+    """
+    template = lesson_plan_template()
+    pdfs = []
+    with trace_span("render.lesson_plan_pdfs") as span:
+        for i, plan in enumerate(plans):
+            data = plan['plan']
+            try:
+                if isinstance(data, (str, bytes)):
+                    data = LessonPlan.model_validate_json(data)
+                elif not isinstance(data, LessonPlan):
+                    data = LessonPlan.model_validate(data)
+            except ValueError as e:
+                report_error(f"Lesson plan {i + 1} is not valid: {e}")
+                pdfs.append(None)
+                continue
+            pdfs.append(template.render(data, plan['topic'], plan['standard'], plan['grade'], plan.get('strategy') or "None / Standard"))
+        span.set(plans=len(pdfs), output_bytes=sum(len(pdf) for pdf in pdfs if pdf))
+    return pdfs
+
+# --- Slide Deck PPTX ---
+
+# Slides prebuilt in the base deck (decks are asked for 7); longer decks add the rest one at a time
+SLIDE_DECK_BASE_SLIDES = 8
+
+SLIDE_DECK_PRO_TIP = "💡 PRO TIP: To style this presentation instantly, click the Design tab and select Designer (or a Theme) to match your classroom style."
+
+def add_deck_slide(prs, is_first=False):
+    """Adds an empty slide with the deck's fixed shapes: title, resized body, notes and prompt footer.
+
+    The first slide also gets the pro-tip banner. fill_deck_slide() puts the text in.
+    """
+    slide = prs.slides.add_slide(prs.slide_layouts.get_by_name("Title and Content"))
+
+    # Body Content (Standard Placeholder)
+    if len(slide.placeholders) > 1:
+        content = slide.placeholders[1]
+        content.width = Inches(4.5)
+        content.height = Inches(5.5)
+        content.top = Inches(1.5)
+        content.text_frame.word_wrap = True
+        content.text_frame.clear()
+
+    # Speaker Notes (created on first access)
+    slide.notes_slide
+
+    # Slide 1: Pro Tip
+    if is_first:
+        tip_box = slide.shapes.add_textbox(Inches(0.5), Inches(0.2), Inches(9.0), Inches(0.5)) # Very top
+        p = tip_box.text_frame.add_paragraph()
+        p.text = SLIDE_DECK_PRO_TIP
+        p.font.size = Pt(11)
+        p.font.color.rgb = RGBColor(100, 100, 100) # Grey
+
+    # Footer: Nano Banana Prompt
+    footer = slide.shapes.add_textbox(Inches(0.5), Inches(7.0), Inches(9.0), Inches(0.5))
+    footer.name = "Image Prompt"
+    p = footer.text_frame.add_paragraph()
+    p.font.italic = True
+    p.font.size = Pt(9)
+    p.font.color.rgb = RGBColor(150, 150, 150) # Light Grey
+    return slide
+
+def pptx_runs(text):
+    """DrawingML runs for one paragraph of `text`, with line breaks where it has newlines."""
+    markup = []
+    for i, piece in enumerate(re.split("\n|\v", text)):
+        if i:
+            markup.append("<a:br/>")
+        if piece:
+            markup.append(f"<a:r><a:t>{xml_text(piece)}</a:t></a:r>")
+    return "".join(markup)
+
+def append_pptx_markup(parent, markup):
+    """Parses DrawingML `markup` (any number of elements) and appends the elements to `parent`."""
+    for element in list(parse_xml(f"<a:p {nsdecls('a')}>{markup}</a:p>")):
+        parent.append(element)
+
+# ElementPaths to a shape's placeholder and non-visual properties (which hold its name)
+_PPTX_PH_PATH = f"{qn('p:nvSpPr')}/{qn('p:nvPr')}/{qn('p:ph')}"
+_PPTX_CNVPR_PATH = f"{qn('p:nvSpPr')}/{qn('p:cNvPr')}"
+
+def pptx_text_bodies(element):
+    """The `p:txBody` of each text shape in a slide or notes slide element, keyed by placeholder
+    type ('title', 'body'; a placeholder with no type is a body) or, for other shapes, by name."""
+    bodies = {}
+    for sp in element.iter(qn('p:sp')):
+        txBody = sp.find(qn('p:txBody'))
+        if txBody is None:
+            continue
+        ph = sp.find(_PPTX_PH_PATH)
+        bodies[ph.get('type', 'body') if ph is not None else sp.find(_PPTX_CNVPR_PATH).get('name')] = txBody
+    return bodies
+
+def set_pptx_paragraphs(txBody, text):
+    """Replaces the paragraphs of `txBody` with one per line of `text`, like python-pptx's `text_frame.text`."""
+    for p in txBody.findall(qn('a:p')):
+        txBody.remove(p)
+    append_pptx_markup(txBody, "".join(f"<a:p>{pptx_runs(line)}</a:p>" for line in text.split("\n")))
+
+def fill_deck_slide(slide, title_text, bullets_list, notes_text, ai_prompt):
+    """Writes one slide's text into a slide made by add_deck_slide().
+
+    Shapes are found and filled at the XML level, one parse per shape: going through python-pptx's
+    shape and paragraph objects, which search the XML again on every access, cost more than
+    building and saving the rest of the deck.
+    """
+    bodies = pptx_text_bodies(slide.element)
+    if 'title' in bodies:
+        set_pptx_paragraphs(bodies['title'], title_text)
+    # Bullets follow the body's empty first paragraph
+    if 'body' in bodies:
+        append_pptx_markup(bodies['body'], "".join(f"<a:p><a:pPr/>{pptx_runs(b)}</a:p>" for b in bullets_list))
+    if 'Image Prompt' in bodies:
+        append_pptx_markup(bodies['Image Prompt'].findall(qn('a:p'))[-1], pptx_runs(f"🍌 Nano Banana Image Prompt: {ai_prompt}"))
+
+    notes = pptx_text_bodies(slide.notes_slide.element)
+    if 'body' in notes:
+        set_pptx_paragraphs(notes['body'], notes_text)
+
+@functools.lru_cache(maxsize=None)
+def slide_deck_base():
+    """The base deck every slide deck is opened from, built once per process. Returns PPTX bytes.
+
+    Only the Title and Content layout is kept (the ten other default layouts were never used but
+    were written into every file), the notes master already exists, and SLIDE_DECK_BASE_SLIDES
+    slides already carry their fixed shapes, so a deck only has to fill in its text.
+    """
+    prs = Presentation()
+    layouts = prs.slide_master.slide_layouts
+    for layout in list(layouts):
+        if layout.name != "Title and Content":
+            layouts.remove(layout)
+    for i in range(SLIDE_DECK_BASE_SLIDES):
+        add_deck_slide(prs, is_first=(i == 0))
+    base = io.BytesIO()
+    prs.save(base)
+    return base.getvalue()
+
+@traced("render.slide_deck")
+def render_slide_deck(slides_data, topic):
+    """Builds the PowerPoint file for a list of Slide, from a copy of the base deck. Returns the PPTX bytes."""
+    contents = []
+    for slide_info in slides_data:
+        title = slide_info.title or 'Untitled Slide'
+        bullets = slide_info.bullet_points
+        notes = slide_info.speaker_notes
+        prompt = slide_info.image_ai_prompt or f"Image of {topic}"
+
+        # Split if too many bullets
+        if len(bullets) > 6:
+            contents.append((f"{title} (Part 1)", bullets[:6], notes, prompt))
+            contents.append((f"{title} (Part 2)", bullets[6:], notes, prompt))
+        else:
+            contents.append((title, bullets, notes, prompt))
+
+    prs = Presentation(io.BytesIO(slide_deck_base()))
+    while len(prs.slides) < len(contents):
+        add_deck_slide(prs)
+    # Drop the prebuilt slides this deck does not need; parts nothing refers to are not saved
+    slide_ids = prs.slides._sldIdLst
+    for slide_id in list(slide_ids)[len(contents):]:
+        prs.part.drop_rel(slide_id.rId)
+        slide_ids.remove(slide_id)
+
+    for slide, content in zip(prs.slides, contents):
+        fill_deck_slide(slide, *content)
+
+    # Save to buffer
+    pptx_buffer = io.BytesIO()
+    prs.save(pptx_buffer)
+    return pptx_buffer.getvalue()
+
+# --- Source Extraction ---
+
+# Extraction processes for large PDFs (override with configure_source_extraction() or
+# SOURCE_EXTRACT_PROCESSES); 1 reads every page in the calling thread
+SOURCE_EXTRACT_PROCESSES = min(4, os.cpu_count() or 1)
+
+# Pages a worker process extracts per task, and the fewest pages still to read that make
+# starting the process pool worthwhile
+PDF_PAGES_PER_TASK = 8
+PDF_PARALLEL_MIN_PAGES = 32
+
+# MIME types extract_text_from_file() understands, by file extension
+SOURCE_FILE_TYPES = {
+    '.pdf': "application/pdf",
+    '.docx': "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    '.txt': "text/plain",
+}
+
+class SourceFile(io.BytesIO):
+    """A file on disk presented like an uploaded file (`.name`, `.type`, `.getvalue()`)."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            super().__init__(f.read())
+        self.name = os.path.basename(path)
+        self.type = SOURCE_FILE_TYPES.get(os.path.splitext(path)[1].lower(), "")
+
+# Set by configure_source_extraction()
+_extraction_settings = {}
+
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+def configure_source_extraction(processes=None):
+    """Sets how many processes extract large PDFs in this process (None: SOURCE_EXTRACT_PROCESSES)."""
+    _extraction_settings['processes'] = processes
+
+def extraction_processes():
+    """How many processes extract large PDFs, as configured."""
+    return int(_extraction_settings.get('processes') or os.environ.get("SOURCE_EXTRACT_PROCESSES") or SOURCE_EXTRACT_PROCESSES)
+
+def get_extraction_pool():
+    """Returns the process-wide pool for extracting PDF pages, or None if extraction is single-process.
+
+    Workers are spawned rather than forked (the app is multi-threaded) when first needed, and are
+    kept for the life of the process.
+    """
+    global _extraction_pool
+    processes = extraction_processes()
+    if processes <= 1:
+        return None
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            _extraction_pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        return _extraction_pool
+
+# The PDF an extraction process last read, as (path, PdfReader), so its later tasks skip re-parsing it
+_worker_pdf = (None, None)
+
+def extract_pdf_pages(path, start, stop):
+    """The text of pages `start` to `stop - 1` of the PDF at `path`. Runs in an extraction process."""
+    global _worker_pdf
+    if _worker_pdf[0] != path:
+        _worker_pdf = (path, pypdf.PdfReader(path))
+    reader = _worker_pdf[1]
+    return [reader.pages[i].extract_text() for i in range(start, stop)]
+
+def iter_pdf_text(uploaded_file, max_chars=None):
+    """Yields the text of each page of a PDF, in order.
+
+    The first PDF_PAGES_PER_TASK pages are read here. If, going by their length, at least
+    PDF_PARALLEL_MIN_PAGES more are needed to reach `max_chars` (None: the whole file), the rest
+    are extracted a few tasks ahead in the extraction process pool. The workers read the file from
+    a temporary copy on disk, so its bytes are not sent with every task.
+    """
+    reader = pypdf.PdfReader(uploaded_file)
+    page_count = len(reader.pages)
+    page = chars = 0
+    while page < min(page_count, PDF_PAGES_PER_TASK):
+        text = reader.pages[page].extract_text() + "\n"
+        page += 1
+        chars += len(text)
+        yield text
+
+    pages_needed = page_count - page
+    if max_chars is not None and chars:
+        pages_needed = min(pages_needed, math.ceil((max_chars - chars) / (chars / page)))
+    pool = get_extraction_pool() if pages_needed >= PDF_PARALLEL_MIN_PAGES else None
+    if pool is None:
+        for i in range(page, page_count):
+            yield reader.pages[i].extract_text() + "\n"
+        return
+
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(uploaded_file.getvalue())
+    starts = iter(range(page, page_count, PDF_PAGES_PER_TASK))
+    pending = collections.deque()
+
+    def submit_next():
+        start = next(starts, None)
+        if start is not None:
+            pending.append(pool.submit(extract_pdf_pages, path, start, min(start + PDF_PAGES_PER_TASK, page_count)))
+
+    try:
+        for _ in range(2 * extraction_processes()):
+            submit_next()
+        while pending:
+            pages = pending.popleft().result()
+            submit_next()
+            for text in pages:
+                yield text + "\n"
+    finally:
+        # The caller may stop early; drop the tasks that have not started (a worker holds the whole
+        # file in memory once it has opened it, so the copy can go straight away)
+        for future in pending:
+            future.cancel()
+        os.remove(path)
+
+def iter_source_text(uploaded_file, max_chars=None):
+    """Yields the text of a PDF, DOCX or TXT file piece by piece (a page or a paragraph), in order.
+
+    Nothing past the point where iteration stops is parsed. `max_chars` is how much the caller
+    expects to read (None: everything); large PDFs use it to decide on parallel extraction.
+    """
+    if uploaded_file.type == "application/pdf":
+        yield from iter_pdf_text(uploaded_file, max_chars)
+    elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+        doc = docx.Document(uploaded_file)
+        for para in doc.paragraphs:
+            yield para.text + "\n"
+    elif uploaded_file.type == "text/plain":
+        yield uploaded_file.getvalue().decode("utf-8")
+
+def extract_text_from_file(uploaded_file, max_chars=None, use_cache=True, while_parsing=None):
+    """Extracts text from PDF, DOCX, or TXT files.
+
+    With `max_chars`, reading stops as soon as there is more than that much text, which is then
+    truncated with a note; by default the whole file is read. Results are kept in the extraction
+    cache, so the same file with the same settings is only parsed once per process. `while_parsing` optionally returns a
+    context manager to run the parsing in (e.g. a spinner); a cache hit skips it.
+    """
+    cache = get_extraction_cache()
+    key = cache.make_key(uploaded_file, max_chars) if use_cache else None
+    if key:
+        text = cache.get(key)
+        if text is not None:
+            return text
+    try:
+        parts = []
+        size = 0
+        with while_parsing() if while_parsing else contextlib.nullcontext(), \
+                contextlib.closing(iter_source_text(uploaded_file, max_chars)) as pieces:
+            for part in pieces:
+                parts.append(part)
+                size += len(part)
+                if max_chars is not None and size > max_chars:
+                    break
+        text = "".join(parts)
+
+        # Truncate if too long
+        if max_chars is not None and len(text) > max_chars:
+            text = text[:max_chars] + "\n\n[Text truncated for prompt limit...]"
+    except Exception as e:
+        report_error(f"Error reading file: {e}")
+        return ""
+    if key:
+        cache.put(key, text)
+    return text
+
+# Extracted text kept in memory per process, so Streamlit reruns don't parse the same upload again
+# (text is held as str; the character limit is roughly its size in memory for mostly-ASCII text)
+EXTRACTION_CACHE_MAX_ENTRIES = 32
+EXTRACTION_CACHE_MAX_CHARS = 32 * 1024 * 1024
+
+class ExtractionCache:
+    """In-memory cache of extracted source text keyed by a SHA-256 of the file's bytes and the
+    extraction settings.
+
+    Least recently used entries are evicted beyond `max_entries` entries or `max_chars` characters
+    of text in total. Thread-safe; hit/miss counters are kept per process. Values may be anything
+    with a len() in characters, such as a SourceIndex.
+    """
+
+    def __init__(self, max_entries=EXTRACTION_CACHE_MAX_ENTRIES, max_chars=EXTRACTION_CACHE_MAX_CHARS):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(uploaded_file, max_chars):
+        """Hashes the file's bytes together with everything else that decides the extracted text."""
+        digest = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+        return f"{digest}:{uploaded_file.type}:{max_chars}"
+
+    def get(self, key):
+        """Returns the cached text for `key`, or None."""
+        with self._lock:
+            text = self._entries.get(key)
+            if text is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return text
+
+    def put(self, key, text):
+        """Stores `text` under `key`, then evicts least recently used entries beyond the limits.
+        Text larger than the whole cache is not stored."""
+        if len(text) > self.max_chars:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._chars -= len(previous)
+            self._entries[key] = text
+            self._chars += len(text)
+            while len(self._entries) > self.max_entries or self._chars > self.max_chars:
+                _, evicted = self._entries.popitem(last=False)
+                self._chars -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._chars = 0
+
+    def stats(self):
+        """Returns hit/miss counters plus the current entry count and stored characters."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "chars": self._chars}
+
+_extraction_cache = ExtractionCache()
+
+def get_extraction_cache():
+    """Returns the process-wide ExtractionCache."""
+    return _extraction_cache
+
+# --- Source Retrieval ---
+
+# Uploads are indexed whole and split into passages of about this many characters; each prompt
+# gets the SOURCE_TOP_K passages that best match its topic, up to SOURCE_CONTEXT_MAX_CHARS
+# characters (a source shorter than that is passed whole)
+SOURCE_PASSAGE_CHARS = 1000
+SOURCE_TOP_K = 5
+SOURCE_CONTEXT_MAX_CHARS = 5000
+
+# BM25 term-frequency saturation and passage-length normalisation
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Indexes kept in memory per process, keyed like the extraction cache (an index is a few times
+# the size of its text)
+SOURCE_INDEX_CACHE_MAX_ENTRIES = 8
+SOURCE_INDEX_CACHE_MAX_CHARS = 8 * 1024 * 1024
+
+# Words too common to say anything about which passage a topic is in
+_STOPWORDS = frozenset(
+    "a an and are as at be been but by can do does for from had has have how in into is it its "
+    "of on or that the their them then there these they this those to was were what when where "
+    "which while who why will with would you your".split()
+)
+
+_WORD_RE = re.compile(r"\w+")
+
+def search_terms(text):
+    """Lower-cased words of `text` without stopwords, numbers or a plural 's', for BM25 matching."""
+    terms = []
+    for word in _WORD_RE.findall(text.lower()):
+        if len(word) < 2 or word in _STOPWORDS or word.isdigit():
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+def split_passages(text, size=SOURCE_PASSAGE_CHARS):
+    """Splits `text` into passages of about `size` characters, breaking between lines (and
+    preferably at blank lines) and only splitting a line that is longer than `size` on its own."""
+    passages = []
+    current = []
+    length = 0
+
+    def flush():
+        nonlocal length
+        if current:
+            passages.append("\n".join(current))
+            current.clear()
+            length = 0
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            if length >= size // 2:
+                flush()
+            continue
+        while len(line) > size:
+            cut = line.rfind(" ", 0, size)
+            cut = cut if cut > 0 else size
+            flush()
+            passages.append(line[:cut])
+            line = line[cut:].lstrip()
+        if length and length + len(line) > size:
+            flush()
+        current.append(line)
+        length += len(line) + 1
+    flush()
+    return passages
+
+class SourceIndex:
+    """BM25 index over the passages of one source document.
+
+    Pass it wherever a prompt takes `source_text`: each prompt then includes only the passages
+    relevant to its own topic (see source_context()). `len()` is the length of the indexed text,
+    so an index of an empty document is falsy like an empty string.
+    """
+
+    def __init__(self, text, passage_chars=SOURCE_PASSAGE_CHARS):
+        self.text = text
+        self.passages = split_passages(text, passage_chars)
+        self._postings = collections.defaultdict(list)
+        lengths = []
+        for pid, passage in enumerate(self.passages):
+            terms = collections.Counter(search_terms(passage))
+            for term, tf in terms.items():
+                self._postings[term].append((pid, tf))
+            lengths.append(sum(terms.values()))
+        average = (sum(lengths) / len(lengths)) if lengths else 0
+        self._norms = [BM25_K1 * (1 - BM25_B + BM25_B * n / average) if average else BM25_K1 for n in lengths]
+
+    def __len__(self):
+        return len(self.text)
+
+    def search(self, query, k=SOURCE_TOP_K):
+        """Returns up to `k` (score, passage number) pairs for `query`, best first."""
+        count = len(self.passages)
+        scores = collections.defaultdict(float)
+        for term in set(search_terms(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for pid, tf in postings:
+                scores[pid] += idf * tf * (BM25_K1 + 1) / (tf + self._norms[pid])
+        return heapq.nlargest(k, ((score, pid) for pid, score in scores.items()))
+
+    def context(self, query, k=SOURCE_TOP_K, max_chars=SOURCE_CONTEXT_MAX_CHARS):
+        """The source text to put in a prompt about `query`: the whole text if it fits in
+        `max_chars`, otherwise the best `k` passages that fit, in document order. If nothing
+        matches, the opening passages are used, as if the text had been truncated."""
+        if len(self.text) <= max_chars:
+            return self.text
+        ranked = [pid for _, pid in self.search(query, k)] or range(min(k, len(self.passages)))
+        chosen = []
+        size = 0
+        for pid in ranked:
+            if chosen and size + len(self.passages[pid]) > max_chars:
+                break
+            chosen.append(pid)
+            size += len(self.passages[pid])
+        return "\n\n[...]\n\n".join(self.passages[pid][:max_chars] for pid in sorted(chosen))
+
+def source_context(source_text, query, max_chars=None):
+    """The source material for a prompt about `query`: retrieved passages for a SourceIndex,
+    or `source_text` unchanged for a plain string. `max_chars` caps either one."""
+    if isinstance(source_text, SourceIndex):
+        return source_text.context(query, max_chars=min(max_chars, SOURCE_CONTEXT_MAX_CHARS) if max_chars is not None else SOURCE_CONTEXT_MAX_CHARS)
+    if max_chars is not None and len(source_text) > max_chars:
+        return source_text[:max_chars]
+    return source_text
+
+_source_index_cache = ExtractionCache(SOURCE_INDEX_CACHE_MAX_ENTRIES, SOURCE_INDEX_CACHE_MAX_CHARS)
+
+def build_source_index(uploaded_file, use_cache=True, while_parsing=None):
+    """Extracts the whole of an uploaded PDF, DOCX or TXT file and indexes it for retrieval.
+
+    The text comes through the extraction cache and the index is cached the same way, so each
+    upload is parsed and indexed once per process. Returns an empty (falsy) index if the file
+    could not be read.
+    """
+    key = ExtractionCache.make_key(uploaded_file, None) if use_cache else None
+    if key:
+        index = _source_index_cache.get(key)
+        if index is not None:
+            return index
+    text = extract_text_from_file(uploaded_file, use_cache=use_cache, while_parsing=while_parsing)
+    with trace_span("source.index") as span:
+        index = SourceIndex(text)
+        span.set(chars=len(text), passages=len(index.passages))
+    if key and text:
+        _source_index_cache.put(key, index)
+    return index
+
+def build_source_index_from_path(path):
+    """Indexes a PDF, DOCX, or TXT file on disk (see build_source_index())."""
+    try:
+        source = SourceFile(path)
+    except OSError as e:
+        report_error(f"Error reading file: {e}")
+        return SourceIndex("")
+    return build_source_index(source)
+
+# --- AI Generation Functions ---
+
+# Keep-alive HTTP connections held open by the shared client (override with configure_gemini() or GEMINI_POOL_SIZE)
+GEMINI_POOL_SIZE = 16
+
+# Set by configure_gemini()
+_gemini_settings = {}
+
+_gemini_clients = {}
+_gemini_clients_lock = threading.Lock()
+_async_gemini_clients = weakref.WeakKeyDictionary()  # event loop -> {settings: genai.Client}
+_gemini_semaphores = weakref.WeakKeyDictionary()  # event loop -> asyncio.Semaphore
+
+def new_gemini_client(api_key, pool_size=GEMINI_POOL_SIZE, base_url=None):
+    """A genai.Client whose sync and async httpx pools each keep up to `pool_size` keep-alive connections."""
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    http_options = types.HttpOptions(base_url=base_url, client_args={'limits': limits}, async_client_args={'limits': limits})
+    return genai.Client(api_key=api_key, http_options=http_options)
+
+def get_shared_gemini_client(api_key, pool_size=GEMINI_POOL_SIZE, base_url=None):
+    """Returns the process-wide genai.Client for these settings, creating it on first use.
+
+    The client is shared by every session and worker thread. Its httpx connection pool keeps up to
+    `pool_size` keep-alive connections, so calls reuse warm connections instead of paying for a new
+    client and TLS handshake each time. httpx clients are thread-safe; creation is guarded by a lock.
+    """
+    key = (api_key, pool_size, base_url)
+    client = _gemini_clients.get(key)
+    if client is None:
+        with _gemini_clients_lock:
+            client = _gemini_clients.get(key)
+            if client is None:
+                client = new_gemini_client(api_key, pool_size, base_url)
+                _gemini_clients[key] = client
+    return client
+
+def configure_gemini(api_key=None, pool_size=None, base_url=None):
+    """Sets the API key, connection pool size and endpoint used by get_gemini_client() in this process.
+
+    Settings left as None fall back to the GEMINI_API_KEY, GEMINI_POOL_SIZE and GEMINI_BASE_URL
+    environment variables. `base_url` points the client at a proxy or a local stand-in.
+    """
+    _gemini_settings['api_key'] = api_key
+    _gemini_settings['pool_size'] = pool_size
+    _gemini_settings['base_url'] = base_url
+
+def gemini_settings():
+    """The configured (api_key, pool_size, base_url). Raises RuntimeError if no key is set."""
+    api_key = _gemini_settings.get('api_key') or os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        raise RuntimeError("⚠️ GEMINI_API_KEY not configured")
+    pool_size = int(_gemini_settings.get('pool_size') or os.environ.get("GEMINI_POOL_SIZE") or GEMINI_POOL_SIZE)
+    base_url = _gemini_settings.get('base_url') or os.environ.get("GEMINI_BASE_URL") or None
+    return api_key, pool_size, base_url
+
+def get_gemini_client():
+    """Returns the shared client for the configured API key. Raises RuntimeError if no key is set."""
+    api_key, pool_size, base_url = gemini_settings()
+    return get_shared_gemini_client(api_key, pool_size=pool_size, base_url=base_url)
+
+def get_async_gemini_client():
+    """Returns the async client (genai AsyncClient) for the configured API key, for the running event loop.
+
+    httpx async connections belong to the loop that opened them, so each loop gets a pooled client
+    of its own; everything run through run_async() shares the one on the shared loop.
+    """
+    key = gemini_settings()
+    loop = asyncio.get_running_loop()
+    with _gemini_clients_lock:
+        clients = _async_gemini_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = clients[key] = new_gemini_client(*key)
+    return client.aio
+
+def get_gemini_semaphore():
+    """Returns the semaphore every Gemini call on the running event loop holds while in flight.
+
+    Sized to the connection pool (GEMINI_POOL_SIZE), so concurrent calls queue here rather than for
+    a connection inside httpx, where the wait would count against their timeout.
+    """
+    loop = asyncio.get_running_loop()
+    with _gemini_clients_lock:
+        semaphore = _gemini_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = _gemini_semaphores[loop] = asyncio.Semaphore(gemini_settings()[1])
+    return semaphore
+
+# --- Rate Limiting ---
+
+# Provider quota shared by every Gemini call in this process
+# (override with configure_rate_limits() or GEMINI_RPM / GEMINI_TPM)
+GEMINI_REQUESTS_PER_MINUTE = 1000
+GEMINI_TOKENS_PER_MINUTE = 1_000_000
+
+# Response size charged up front when the config sets no max_output_tokens; corrected from usage_metadata
+ESTIMATED_OUTPUT_TOKENS = 2048
+
+# Times a call is put back in the queue after a 429 / RESOURCE_EXHAUSTED before the error is raised
+RATE_LIMIT_MAX_RETRIES = 6
+
+# Pause after a 429 that carries no retry delay; doubles for each further 429 up to the maximum
+RATE_LIMIT_BASE_BACKOFF = 2.0
+RATE_LIMIT_MAX_BACKOFF = 60.0
+
+# How often a coroutine waiting for quota checks the queue again
+RATE_LIMIT_POLL_SECONDS = 0.05
+
+class TokenBucket:
+    """Holds up to `capacity` units, refilled continuously at `rate` units per second.
+
+    Not thread-safe on its own; RateLimiter guards it. The level may go negative when a call
+    turns out to use more tokens than were charged for it.
+    """
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.level = capacity
+        self._updated = time.monotonic()
+
+    def refill(self, now, scale=1.0):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate * scale)
+        self._updated = now
+
+    def time_until(self, amount, scale=1.0):
+        """Seconds until `amount` units are available (0 if they already are)."""
+        needed = min(amount, self.capacity) - self.level
+        return max(0.0, needed / (self.rate * scale))
+
+class RateLimiter:
+    """Request and token buckets in front of every Gemini call in the process.
+
+    acquire_async() waits until both buckets can cover a call, serving callers in arrival order, so a
+    burst of calls queues instead of failing. After a 429 the limiter pauses every caller and halves
+    its refill rate, then recovers a little with each successful call.
+    """
+    MIN_SCALE = 0.1
+    RECOVERY_STEP = 0.05
+
+    def __init__(self, requests_per_minute=GEMINI_REQUESTS_PER_MINUTE, tokens_per_minute=GEMINI_TOKENS_PER_MINUTE):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._lock = threading.Lock()
+        self._requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self._tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+        self._waiters = collections.deque()
+        self._scale = 1.0
+        self._backoff = 0.0
+        self._paused_until = 0.0
+        self.calls = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    async def acquire_async(self, tokens):
+        """Waits for quota for one call of about `tokens` tokens and charges it. Returns seconds waited.
+
+        Sleeps instead of blocking, checking the queue again every RATE_LIMIT_POLL_SECONDS, and gives
+        up its place in line if cancelled.
+        """
+        start = time.monotonic()
+        waiter = object()
+        with self._lock:
+            self._waiters.append(waiter)
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._requests.refill(now, self._scale)
+                    self._tokens.refill(now, self._scale)
+                    delay = None  # Others are ahead in line
+                    if self._waiters[0] is waiter:
+                        delay = max(self._paused_until - now,
+                                    self._requests.time_until(1, self._scale),
+                                    self._tokens.time_until(tokens, self._scale))
+                        if delay <= 0:
+                            self._requests.level -= 1
+                            self._tokens.level -= tokens
+                            break
+                await asyncio.sleep(RATE_LIMIT_POLL_SECONDS if delay is None else min(delay, RATE_LIMIT_POLL_SECONDS))
+        finally:
+            with self._lock:
+                self._waiters.remove(waiter)
+        with self._lock:
+            waited = time.monotonic() - start
+            self.calls += 1
+            self.total_wait += waited
+            self.last_wait = waited
+            self.max_wait = max(self.max_wait, waited)
+            return waited
+
+    def settle(self, estimated, actual):
+        """Corrects the token bucket once a call's real usage is known."""
+        with self._lock:
+            self._tokens.level += estimated - actual
+
+    def succeeded(self):
+        with self._lock:
+            self._scale = min(1.0, self._scale + self.RECOVERY_STEP)
+            self._backoff = 0.0
+
+    def throttle(self, retry_after=None):
+        """Records a 429: pauses every caller and slows the refill rate."""
+        with self._lock:
+            self.throttled += 1
+            now = time.monotonic()
+            # Calls in flight when the quota ran out all come back 429; only slow down once for them
+            if now >= self._paused_until:
+                self._scale = max(self.MIN_SCALE, self._scale / 2)
+                self._backoff = min(RATE_LIMIT_MAX_BACKOFF, self._backoff * 2 if self._backoff else RATE_LIMIT_BASE_BACKOFF)
+            delay = retry_after if retry_after is not None else self._backoff * random.uniform(1.0, 1.25)
+            self._paused_until = max(self._paused_until, now + delay)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': len(self._waiters),
+                'calls': self.calls,
+                'throttled': self.throttled,
+                'mean_wait': self.total_wait / self.calls if self.calls else 0.0,
+                'max_wait': self.max_wait,
+                'last_wait': self.last_wait,
+                'total_wait': self.total_wait,
+                'rate_scale': self._scale,
+            }
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+_rate_limit_settings = {}
+
+def configure_rate_limits(requests_per_minute=None, tokens_per_minute=None):
+    """Sets this process's share of the provider quota. Settings left as None fall back to
+    GEMINI_RPM / GEMINI_TPM and then the defaults above. Takes effect for the next call."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limit_settings['requests_per_minute'] = requests_per_minute
+        _rate_limit_settings['tokens_per_minute'] = tokens_per_minute
+        _rate_limiter = None
+
+def get_rate_limiter():
+    """Returns the process-wide RateLimiter, creating it on first use."""
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                rpm = _rate_limit_settings.get('requests_per_minute') or os.environ.get("GEMINI_RPM") or GEMINI_REQUESTS_PER_MINUTE
+                tpm = _rate_limit_settings.get('tokens_per_minute') or os.environ.get("GEMINI_TPM") or GEMINI_TOKENS_PER_MINUTE
+                _rate_limiter = RateLimiter(float(rpm), float(tpm))
+    return _rate_limiter
+
+def rate_limit_status():
+    """A short note on calls waiting for quota, for progress messages. Empty when nothing is waiting."""
+    limiter = _rate_limiter
+    if limiter is None:
+        return ""
+    stats = limiter.stats()
+    if not stats['queued']:
+        return ""
+    return f" ⏳ {stats['queued']} calls waiting for API quota (last wait {stats['last_wait']:.1f}s)"
+
+def estimate_tokens(text):
+    """Rough token count for `text`: about 4 characters per token."""
+    return len(text) // 4
+
+def estimate_call_tokens(prompt, config=None):
+    """Rough token count for a call: the prompt's tokens plus the expected response."""
+    max_output = getattr(config, 'max_output_tokens', None) if config else None
+    return estimate_tokens(prompt) + (max_output or ESTIMATED_OUTPUT_TOKENS)
+
+def is_rate_limit_error(error):
+    return getattr(error, 'code', None) == 429 or 'RESOURCE_EXHAUSTED' in str(error)
+
+def retry_delay_from_error(error):
+    """The delay a 429 asks for (Retry-After header or RetryInfo.retryDelay) in seconds, or None."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    try:
+        if headers and headers.get('retry-after'):
+            return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        pass
+    match = re.search(r'"retryDelay":\s*"(\d+(?:\.\d+)?)s"', json.dumps(getattr(error, 'details', None), default=str))
+    return float(match.group(1)) if match else None
+
+def usage_tokens(response):
+    """Total tokens a response used according to its usage_metadata, or None if not reported."""
+    usage = getattr(response, 'usage_metadata', None)
+    return getattr(usage, 'total_token_count', None) if usage else None
+
+def usage_attributes(response):
+    """Span attributes for the prompt and response token counts in a response's usage_metadata."""
+    usage = getattr(response, 'usage_metadata', None)
+    if not usage:
+        return {}
+    attributes = {
+        'gen_ai.usage.input_tokens': usage.prompt_token_count,
+        'gen_ai.usage.output_tokens': usage.candidates_token_count,
+    }
+    if usage.cached_content_token_count:
+        attributes['gen_ai.usage.cached_input_tokens'] = usage.cached_content_token_count
+    return attributes
+
+async def rate_limited_call(prompt, config, call, timeout=None):
+    """Awaits `call()` under the shared RateLimiter and returns its result.
+
+    `call` makes one Gemini request and returns (result, tokens_used or None). The request holds
+    the loop's Gemini semaphore (see get_gemini_semaphore()) while in flight and is cancelled with
+    TimeoutError after `timeout` seconds; time spent queueing for quota or a connection does not
+    count. A request rejected with 429 / RESOURCE_EXHAUSTED goes back in the queue, up to
+    RATE_LIMIT_MAX_RETRIES times, after the limiter's backoff. Each request is traced as a
+    `gemini.generate_content` span.
+    """
+    limiter = get_rate_limiter()
+    estimate = estimate_call_tokens(prompt, config)
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        waited = await limiter.acquire_async(estimate)
+        try:
+            async with get_gemini_semaphore():
+                with trace_span("gemini.generate_content", attempt=attempt + 1, quota_wait_seconds=round(waited, 3), prompt_chars=len(prompt)):
+                    try:
+                        async with asyncio.timeout(timeout):
+                            result, used = await call()
+                    except TimeoutError as e:
+                        raise TimeoutError(f"No response from Gemini within {timeout}s") from e
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == RATE_LIMIT_MAX_RETRIES:
+                raise
+            limiter.throttle(retry_delay_from_error(e))
+            continue
+        limiter.succeeded()
+        if used is not None:
+            limiter.settle(estimate, used)
+        return result
+
+# --- Response Cache ---
+
+# On-disk cache of model responses, shared by every session and process on this machine
+RESPONSE_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "responses.sqlite3")
+RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+RESPONSE_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+class ResponseCache:
+    """SQLite-backed cache of model response text keyed by a hash of model, prompt and generation config.
+
+    Entries expire after `ttl_seconds`; once the stored text exceeds `max_bytes` the least recently
+    used entries are evicted. Hit/miss counters are kept per process.
+    """
+
+    def __init__(self, path, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def make_key(model, prompt, config=None, variant=0):
+        """Hashes everything that determines a response. `variant` separates calls that intentionally
+        repeat a prompt (e.g. quiz batches) so each one gets its own entry."""
+        config_json = ""
+        if config is not None:
+            # Schemas are Python types, so hash their JSON Schema instead of the type itself
+            # Timeouts do not change the response, so http_options is left out too
+            config_json = config.model_dump_json(exclude_none=True, exclude={'response_schema', 'http_options'})
+            if config.response_schema is not None:
+                config_json += json.dumps(TypeAdapter(config.response_schema).json_schema(), sort_keys=True)
+        payload = json.dumps([model, prompt, config_json, variant], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached text for `key`, or None if missing or expired."""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, text):
+        """Stores `text` under `key`, then evicts least recently used entries beyond `max_bytes`."""
+        now = time.time()
+        size = len(text.encode('utf-8'))
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, text, size, now, now)
+            )
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                stale = []
+                for old_key, old_size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((old_key,))
+                    total -= old_size
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self):
+        """Returns hit/miss counters plus the current entry count and stored bytes."""
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """Returns the process-wide ResponseCache, opening it on first use. Returns None if the cache
+    database cannot be opened, in which case calls simply go to Gemini."""
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                try:
+                    _response_cache = ResponseCache(RESPONSE_CACHE_PATH)
+                except (sqlite3.Error, OSError) as e:
+                    report_warning(f"Response cache disabled: {e}")
+                    return None
+    return _response_cache
+
+def _cache_lookup(key, use_cache):
+    """Returns the cached response text for `key`, or None on a miss, bypass or cache error."""
+    cache = get_response_cache()
+    if not cache or not use_cache:
+        return None
+    try:
+        return cache.get(key)
+    except sqlite3.Error as e:
+        report_warning(f"Response cache read failed: {e}")
+        return None
+
+def _cache_store(key, text):
+    cache = get_response_cache()
+    if not cache:
+        return
+    try:
+        cache.put(key, text)
+    except sqlite3.Error as e:
+        report_warning(f"Response cache write failed: {e}")
+
+async def generate_text_async(prompt, config=None, model='gemini-2.0-flash', use_cache=True, variant=0, parse=None, timeout=None, retry=None):
+    """Calls Gemini for `prompt` and returns the response text, or `parse(text)` if given.
+
+    Responses are served from the response cache when possible; pass use_cache=False to force a
+    fresh call (the new response still refreshes the cache). A response is only cached once
+    `parse` accepts it, so malformed output is never replayed. Calls go through the shared
+    RateLimiter, which queues them and re-queues them on 429. The request gives up after `timeout`
+    seconds. With a RetryPolicy as `retry`, failed or malformed responses are retried under it
+    (its timeout replaces `timeout`). Other errors propagate to the caller.
+    """
+    if retry:
+        return await retry.run_async(lambda attempt_timeout: generate_text_async(prompt, config, model, use_cache, variant, parse, timeout=attempt_timeout))
+
+    key = ResponseCache.make_key(model, prompt, config, variant)
+    cached = await asyncio.to_thread(_cache_lookup, key, use_cache)
+    if cached is not None:
+        return parse_traced(parse, cached)
+
+    client = get_async_gemini_client()
+    request_config = with_timeout(config, timeout)
+
+    async def send(contents, send_config):
+        return await client.models.generate_content(
+            model=model,
+            contents=contents,
+            config=send_config
+        )
+
+    async def call():
+        response = await send_with_context_cache(prompt, request_config, model, send)
+        current_span().set(**{'gen_ai.request.model': model, **usage_attributes(response)}, response_chars=len(response.text or ""))
+        return response.text, usage_tokens(response)
+
+    text = await rate_limited_call(prompt, config, call, timeout)
+    result = parse_traced(parse, text)
+
+    await asyncio.to_thread(_cache_store, key, text)
+    return result
+
+def generate_text(prompt, config=None, model='gemini-2.0-flash', use_cache=True, variant=0, parse=None, timeout=None, retry=None):
+    """Synchronous generate_text_async()."""
+    return run_async(generate_text_async(prompt, config, model, use_cache, variant, parse, timeout, retry))
+
+async def generate_text_stream_async(prompt, on_text, config=None, model='gemini-2.0-flash', use_cache=True, variant=0, parse=None, timeout=None):
+    """Streams the response to `prompt`, calling `on_text(chunk)` as each piece of text arrives.
+
+    Returns the full response text, or `parse(text)` if given. Cache hits are delivered as a single
+    chunk, and a completed stream is cached just like generate_text_async(). Errors (including
+    those raised by `on_text`) propagate to the caller; streams are not
+    retried here, because text already passed to `on_text` cannot be taken back. `timeout` limits
+    the whole stream, not just each read.
+    """
+    key = ResponseCache.make_key(model, prompt, config, variant)
+    cached = await asyncio.to_thread(_cache_lookup, key, use_cache)
+    if cached is not None:
+        on_text(cached)
+        return parse_traced(parse, cached)
+
+    client = get_async_gemini_client()
+    parts = []
+    request_config = with_timeout(config, timeout)
+
+    async def send(contents, send_config):
+        used = None
+        span = current_span()
+        start = time.perf_counter()
+        stream = await client.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=send_config
+        )
+        # Closing the stream when it is abandoned or cancelled hands its connection straight back
+        async with contextlib.aclosing(stream):
+            async for chunk in stream:
+                used = usage_tokens(chunk) or used
+                span.set(**usage_attributes(chunk))
+                if chunk.text:
+                    if not parts:
+                        span.set(first_chunk_seconds=round(time.perf_counter() - start, 3))
+                    parts.append(chunk.text)
+                    on_text(chunk.text)
+        return used
+
+    async def call():
+        span = current_span()
+        span.set(**{'gen_ai.request.model': model}, streaming=True)
+        try:
+            used = await send_with_context_cache(prompt, request_config, model, send, can_fall_back=lambda: not parts)
+        except Exception as e:
+            # Text already handed to on_text cannot be taken back, so a stream cut short is never re-queued
+            if parts and is_rate_limit_error(e):
+                raise RuntimeError(f"Stream interrupted: {e}") from e
+            raise
+        span.set(response_chars=sum(len(part) for part in parts))
+        return "".join(parts), used
+
+    text = await rate_limited_call(prompt, config, call, timeout)
+    result = parse_traced(parse, text)
+
+    await asyncio.to_thread(_cache_store, key, text)
+    return result
+
+def generate_text_stream(prompt, on_text, config=None, model='gemini-2.0-flash', use_cache=True, variant=0, parse=None, timeout=None):
+    """Synchronous generate_text_stream_async(). `on_text` is called on the shared event loop's thread."""
+    return run_async(generate_text_stream_async(prompt, on_text, config, model, use_cache, variant, parse, timeout))
+
+def parse_traced(parse, text):
+    """Returns `parse(text)` (or `text` when parse is None), timed as a `parse` span."""
+    if not parse:
+        return text
+    with trace_span("parse", chars=len(text)):
+        return parse(text)
+
+def with_timeout(config, timeout):
+    """Returns `config` with its HTTP request limited to `timeout` seconds (unchanged if timeout is None)."""
+    if not timeout:
+        return config
+    config = config.model_copy() if config else types.GenerateContentConfig()
+    config.http_options = types.HttpOptions(timeout=int(timeout * 1000))
+    return config
+
+def json_config(schema):
+    """Generation config asking for JSON that matches `schema`."""
+    return types.GenerateContentConfig(
+        response_mime_type='application/json',
+        response_schema=schema
+    )
+
+async def generate_json_async(prompt, schema, use_cache=True, variant=0, with_text=False, retry=None):
+    """Calls Gemini with `schema` (a Pydantic model or list of models) as the response schema and
+    returns the decoded, validated object, or (object, raw_text) if `with_text` is set.
+    Output that fails validation counts as a failed try under `retry`."""
+    adapter = TypeAdapter(schema)
+    config = json_config(schema)
+
+    def parse(text):
+        data = adapter.validate_json(text)
+        return (data, text) if with_text else data
+
+    return await generate_text_async(prompt, config=config, use_cache=use_cache, variant=variant, parse=parse, retry=retry)
+
+def generate_json(prompt, schema, use_cache=True, variant=0, with_text=False, retry=None):
+    """Synchronous generate_json_async()."""
+    return run_async(generate_json_async(prompt, schema, use_cache, variant, with_text, retry))
+
+async def recommend_tool_async(topic, standard, use_cache=True):
+    tools_keys = list(STEM_TOOLS.keys())
+    prompt = f"""
+    Given the topic "{topic}" and standard "{standard}", which ONE of these tools is the absolute best match?
+    Options: {tools_keys}
+    
+    Return ONLY the exact dictionary key. If nothing fits perfectly, return "None".
+    """
+    try:
+        recommended = (await generate_text_async(prompt, use_cache=use_cache)).strip()
+        if recommended in tools_keys:
+            return recommended
+        return "None"
+    except Exception as e:
+        report_error(f"Error recommending tool: {e}")
+        return "None"
+
+def recommend_tool(topic, standard, use_cache=True):
+    """Synchronous recommend_tool_async()."""
+    return run_async(recommend_tool_async(topic, standard, use_cache))
+
+async def generate_unit_outline_async(topic, num_assignments, num_quizzes, use_cache=True):
+    prompt = f"""
+    Create a unit outline for the topic: {topic}.
+    Generate exactly {num_assignments} assignment titles and {num_quizzes} quiz titles.
+    Return a JSON object with a list 'items', where each item has 'type' ('Assignment' or 'Quiz') and 'title'.
+    """
+    try:
+        return (await generate_json_async(prompt, UnitOutline, use_cache=use_cache)).items
+    except Exception as e:
+        report_error(f"Error generating outline: {e}")
+        return []
+
+def generate_unit_outline(topic, num_assignments, num_quizzes, use_cache=True):
+    """Synchronous generate_unit_outline_async()."""
+    return run_async(generate_unit_outline_async(topic, num_assignments, num_quizzes, use_cache))
+
+@traced("lesson_plan")
+async def generate_lesson_plan_pdf_async(topic, standard, grade, strategy="None / Standard", use_cache=True, retry=LESSON_PLAN_RETRY):
+    """Generates a High-Design 5E Lesson Plan PDF (Strict One-Page). Returns (pdf_bytes, raw_text).
+    The PDF is rendered on a worker thread."""
+    # 1. AI Generation (Structured JSON)
+    prompt = f"""
+    Create a 5E Lesson Plan for Grade {grade} on "{topic}" (Standard: {standard}).
+    Return a JSON object with this EXACT structure:
+    {{
+        "metadata": {{
+            "duration": "e.g., 60 minutes",
+            "materials": ["item 1", "item 2"],
+            "vocabulary": ["term 1", "term 2"],
+            "differentiation": {{
+                "sped": ["mod 1", "mod 2"],
+                "ml": ["support 1", "support 2"]
+            }}
+        }},
+        "sections": [
+            {{"phase": "Engage", "time": "10 mins", "activity": "Brief description..."}},
+            {{"phase": "Explore", "time": "15 mins", "activity": "Brief description..."}},
+            {{"phase": "Explain", "time": "10 mins", "activity": "Brief description..."}},
+            {{"phase": "Elaborate", "time": "15 mins", "activity": "Independent Practice referencing the {topic} Assignment..."}},
+            {{"phase": "Evaluate", "time": "10 mins", "activity": "Assessment referencing the {topic} Quiz..."}}
+        ]
+    }}
+    Keep descriptions concise (bullet points preferred).
+    """
+    
+    try:
+        data, response_text = await generate_json_async(prompt, LessonPlan, use_cache=use_cache, with_text=True, retry=retry)
+        
+        pdf_bytes = await asyncio.to_thread(render_lesson_plan_pdf, data, topic, standard, grade, strategy)
+        return pdf_bytes, response_text
+        
+    except Exception as e:
+        report_error(f"Error generating lesson plan: {e}")
+        return None, ""
+
+def generate_lesson_plan_pdf(topic, standard, grade, strategy="None / Standard", use_cache=True, retry=LESSON_PLAN_RETRY):
+    """Synchronous generate_lesson_plan_pdf_async()."""
+    return run_async(generate_lesson_plan_pdf_async(topic, standard, grade, strategy, use_cache, retry))
+
+@traced("slide_deck")
+async def generate_slide_deck_async(topic, grade, strategy="None / Standard", source_text="", use_cache=True, retry=SLIDES_RETRY):
+    """Generates a 7-slide PowerPoint presentation using Gemini and python-pptx (rendered on a worker thread)."""
+    # Strategy Context
+    strategy_instruction = ""
+    if strategy and strategy != "None / Standard":
+        strategy_instruction = f"""
+        CRITICAL: Include a specific slide titled "{strategy} Activity Instructions".
+        On this slide, provide student-facing directions that align exactly with the {strategy} method.
+        (e.g., if "Station Rotation", list what happens at each station; if "Fishbowl", list the rules for the inner/outer circle).
+        In the Speaker Notes for this slide, provide teacher-facing tips on how to facilitate the activity (e.g., "Set a timer for 10 minutes").
+        """
+    else:
+        strategy_instruction = """
+        Include a slide titled "Practice Activity" with clear student instructions for a standard class activity.
+        """
+
+    # Prompt Logic: Chain vs Scratch
+    if source_text:
+        prompt = f"""
+        ### 1. ROLE
+        Act as an Educational Content Creator specializing in visual presentation design.
+        
+        ### 2. TASK
+        Convert the following Lesson Plan into a 7-slide PowerPoint presentation for Grade {grade}.
+        
+        ### 3. SOURCE MATERIAL (LESSON PLAN)
+        \"\"\"{source_text}\"\"\"
+        
+        ### 4. CRITICAL: NO TEXT OVERLAP RULE
+        The Lesson Plan above contains DETAILED procedural descriptions and activity explanations.
+        Your slides must be COMPLEMENTARY, not duplicative:
+        
+        - Lesson Plan = WHAT students DO (detailed activities, procedures, timing)
+        - Slides = VISUAL ANCHORS (key terms, diagrams to reference, keywords ONLY)
+        - Speaker Notes = VERBAL DELIVERY (what the teacher says, questions to ask, transitions)
+        
+        DO NOT copy or paraphrase text from the lesson plan into the slides.
+        Instead, extract only the KEY VOCABULARY and CONCEPT NAMES as bullet points.
+        
+        ### 5. REQUIREMENTS
+        - Create 7 slides based on the lesson plan content.
+        - {strategy_instruction}
+        - Constraint: Use MAXIMUM 5 bullet points per slide.
+        - Constraint: Use MAXIMUM 8 words per bullet point. Be extremely concise.
+        - Constraint: Move ALL explanations and details into the speaker_notes. The slide text must be keywords only.
+        - Constraint: Bullet points should be KEYWORDS/PHRASES, not sentences from the lesson plan.
+        
+        ### 6. OUTPUT FORMAT
+        Return a JSON object with:
+        - 'slides': list of objects, where each slide has:
+            - 'title': string (Clear and Action-Oriented)
+            - 'bullet_points': list of strings (Max 5 points, Max 8 words each. Keywords only.)
+            - 'speaker_notes': string (Detailed, scripted notes. e.g., "Ask the class: Have you ever seen...?")
+            - 'image_ai_prompt': string (detailed Nano Banana prompt)
+        """
+    else:
+        prompt = f"""
+        Create a 7-slide presentation outline for Grade {grade} on "{topic}".
+        {strategy_instruction}
+        
+        Constraint: Use MAXIMUM 5 bullet points per slide.
+        Constraint: Use MAXIMUM 8 words per bullet point. Be extremely concise.
+        Constraint: Move ALL explanations and details into the speaker_notes. The slide text must be keywords only.
+        
+        Return a JSON object with:
+        - 'slides': list of objects, where each slide has:
+            - 'title': string (Clear and Action-Oriented)
+            - 'bullet_points': list of strings (Max 5 points, Max 8 words each. Keywords only.)
+            - 'speaker_notes': string (Detailed, scripted notes. e.g., "Ask the class: Have you ever seen...?")
+            - 'image_ai_prompt': string (detailed Nano Banana prompt)
+        """
+    
+    try:
+        slides_data = (await generate_json_async(prompt, SlideDeck, use_cache=use_cache, retry=retry)).slides
+        
+        return await asyncio.to_thread(render_slide_deck, slides_data, topic)
+        
+    except Exception as e:
+        report_error(f"Error generating slides: {e}")
+        return None
+
+def generate_slide_deck(topic, grade, strategy="None / Standard", source_text="", use_cache=True, retry=SLIDES_RETRY):
+    """Synchronous generate_slide_deck_async()."""
+    return run_async(generate_slide_deck_async(topic, grade, strategy, source_text, use_cache, retry))
+
+def prompt_preamble(grade_level, source_text=""):
+    """The opening shared by the generation prompts: the role and, if given, the source material.
+
+    Prompts in one job that use the same source passages open identically, so the preamble is
+    noted with the job's ContextCache and sent to Gemini once rather than with every call.
+    """
+    preamble = f"""
+1. ROLE
+Act as an expert Curriculum Designer for Grade {grade_level}.
+"""
+    if source_text:
+        preamble += f"""
+SOURCE MATERIAL
+Use the following text as the primary source for content generation: \"\"\" {source_text} \"\"\"
+"""
+        note_prompt_prefix(preamble)
+    return preamble
+
+def construct_quiz_prompt(topic, subtopic, count, due_date, due_time, points_per_question, question_types, grade_level, is_sped, is_gifted, is_ml, language, source_text="", context_topics=None, batch_focus=None, source_max_chars=None):
+    # Build Context Strings
+    sped_context = "Include specific accommodations for Special Education (SPED) students." if is_sped else ""
+    gifted_context = "Include extension questions and advanced critical thinking challenges for Gifted/Advanced learners." if is_gifted else ""
+    ml_context = f"Include language supports for Multilingual Learners (primary language: {language})." if is_ml else ""
+
+    # Contextual Awareness for Unit Mode
+    context_instruction = ""
+    if context_topics:
+        topics_str = ", ".join(context_topics)
+        context_instruction = f"CRITICAL: Create a distinct Quiz assessing the following topics covered recently: {topics_str}. Do not re-test older topics."
+
+    # Question Banks: each batch targets a different cognitive level so batches do not repeat each other
+    if batch_focus:
+        context_instruction += f" For this set, write every question at the \"{batch_focus}\" level of Bloom's Taxonomy."
+
+    # Build Task Constraints
+    task_constraints = ""
+    if is_sped:
+        task_constraints += "Modify reading level to be accessible. Chunk text into smaller sections.\n"
+    if is_gifted:
+        task_constraints += "Include bonus/challenge questions that require higher-order thinking.\n"
+    if is_ml:
+        task_constraints += f"Provide key vocabulary definitions translated into {language}.\n"
+    # Role and Source Material (Protected): only the passages about this quiz's topics
+    preamble = prompt_preamble(grade_level, source_context(source_text, " ".join([topic, subtopic, *(context_topics or [])]), source_max_chars))
+
+    prompt = preamble + f"""
+2. CONTEXT
+I am teaching a unit on "{topic}" (Subtopic: {subtopic}). Student Profile: Mixed ability. {sped_context} {gifted_context} {ml_context}
+
+3. TASK
+Create a Quiz that aligns perfectly with the standard above. {context_instruction} {task_constraints} Generate {count} questions.
+
+XML CONFIGURATION: Set the point value for EVERY question to {points_per_question}. QUESTION TYPES: Generate a mix of ONLY the following types: {question_types}. 
+For "Matching" questions, please format them as Multiple Choice questions (e.g., "Which of the following correctly matches [Term] with [Definition]?").
+METADATA: Include the Due Date ({due_date} {due_time}) in the Quiz Description text.
+
+4. FORMAT
+Return the output as a JSON object matching the following schema: 
+{{ 
+    "questions": [ 
+        {{ 
+            "type": "Multiple Choice" | "Short Answer" | "Essay" | "Multiple Select",
+            "question_text": "string", 
+            "options": ["string", "string"] (Use for Multiple Choice/Select), 
+            "correct_answer_index": int (for Multiple Choice) OR [int, int] (for Multiple Select) OR null (for Essay/Short Answer),
+            "correct_answer_text": "string" (for Short Answer/Fill in Blank only)
+        }} 
+    ] 
+}}
+"""
+    return prompt
+
+def construct_assignment_prompt(topic, subtopic, tool, due_date, due_time, points, grade_level, is_sped, is_gifted, is_ml, language, subject, strategy, source_text=""):
+    tools_str = tool if tool and tool != "None" else "None"
+
+    # Build Context Strings
+    sped_context = "Include specific accommodations for Special Education (SPED) students." if is_sped else ""
+    gifted_context = "Include extension activities and advanced challenges for Gifted/Advanced learners." if is_gifted else ""
+    ml_context = f"Include language supports for Multilingual Learners (primary language: {language})." if is_ml else ""
+    # Subject Specific Logic
+    subject_context = ""
+    iframe_height = "450"
+    if "Business" in subject or "Economics" in subject:
+        subject_context = "Focus on market dynamics, finance, and management scenarios."
+        if "Desmos" in tool or "EconGraphs" in tool:
+            subject_context += ' Create scenarios that require students to shift the curves. Ask them to predict the new Equilibrium Price.'
+            iframe_height = "700"
+    elif "Humanities" in subject or "Arts" in subject:
+        subject_context = "Focus on history, literature, visual arts, and cultural analysis."
+    elif "Technology" in subject or "CS" in subject:
+        subject_context = "Focus on coding, digital literacy, and systems thinking."
+    # Pedagogy
+    pedagogy_section = ""
+    if strategy and strategy != "None / Standard":
+        pedagogy_section = f"""
+5. PEDAGOGY & STRATEGY
+Method: {strategy}
+"""
+
+    # Role and Source Material: only the passages about this subtopic
+    preamble = prompt_preamble(grade_level, source_context(source_text, f"{topic} {subtopic}"))
+
+    prompt = preamble + f"""
+2. CONTEXT
+I am teaching a unit on "{topic}" (Subtopic: {subtopic}). Subject: {subject} Student Profile: Mixed ability. {sped_context} {gifted_context} {ml_context}
+
+3. TASK
+Create an Assignment that aligns perfectly with the standard above. {subject_context} Tools to embed: {tools_str}
+
+In the HTML output, create a highly visible "Metadata Box" at the top using a styled div that displays: Due Date: {due_date} at {due_time} | Points: {points}.
+
+4. FORMAT
+Return the output as raw HTML code ready for Canvas LMS.
+
+Structure: Title, Introduction, Content, Rubric/Answer Key.
+
+Styling: Use inline CSS for a clean, modern look.
+
+Embeds: Include this tool:
+
+{pedagogy_section}
+"""
+    return prompt
+
+def construct_unit_prompt(topic, num_assignments, num_quizzes, grade_level, is_sped, is_gifted, is_ml, language, subject, strategy, source_text=""):
+    # Build Context Strings
+    sped_context = "Include specific accommodations for Special Education (SPED) students." if is_sped else ""
+    gifted_context = "Include extension activities and advanced challenges for Gifted/Advanced learners." if is_gifted else ""
+    ml_context = f"Include language supports for Multilingual Learners (primary language: {language})." if is_ml else ""
+    
+    # Role and Source Material: the passages about the unit's topic
+    preamble = prompt_preamble(grade_level, source_context(source_text, topic))
+
+    # The Prompt (Note the f""" wrapper!)
+    prompt = preamble + f"""
+2. CONTEXT
+I am planning a comprehensive unit on "{topic}". Subject: {subject} Student Profile: Mixed ability. {sped_context} {gifted_context} {ml_context}
+
+3. TASK
+Create a logical unit sequence mixing {num_assignments} Assignments and {num_quizzes} Quizzes. Instructional Strategy: {strategy} Instruction: Place quizzes after relevant assignments to assess learning. Instruction: Create a mixed sequence (e.g., A, A, Q, A, A, Q). Do NOT group all assignments first.
+
+4. OUTPUT FORMAT
+Return the output as a JSON list of objects. Each object must have:
+
+"type": "Assignment" or "Quiz"
+
+"title": string (Creative title)
+
+"focus_topic": string (Specific subtopic covered)
+
+Example: [ {{ "type": "Assignment", "title": "Intro to Cells", "focus_topic": "Cell Theory" }}, {{ "type": "Quiz", "title": "Cell Theory Check", "focus_topic": "Cell Theory" }} ]
+"""
+    return prompt
+
+
+
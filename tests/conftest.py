@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import content_engine
+from fake_gemini import FakeGeminiServer, CannedResponses
+
+# Keep the on-disk caches of a test run out of the working tree and away from earlier runs
+_cache_dir = tempfile.mkdtemp(prefix="content-engine-tests-")
+content_engine.RESPONSE_CACHE_PATH = os.path.join(_cache_dir, "responses.sqlite3")
+content_engine.QUIZ_YIELD_PATH = os.path.join(_cache_dir, "quiz_yield.sqlite3")
+
+@pytest.fixture
+def server():
+    """A FakeGeminiServer with canned answers, with the engine pointed at it and quota limits lifted."""
+    with FakeGeminiServer(respond=CannedResponses()) as server:
+        content_engine.configure_gemini(api_key="test-key", base_url=server.base_url)
+        content_engine.configure_context_cache(enabled=True)
+        content_engine.configure_rate_limits(requests_per_minute=1_000_000, tokens_per_minute=1_000_000_000)
+        yield server
+    content_engine.configure_gemini()
+    content_engine.configure_context_cache()
+    content_engine.configure_rate_limits()
@@ -0,0 +1,57 @@
+import datetime
+import random
+
+import content_engine
+
+QUESTION_TYPES = ["Multiple Choice", "True/False", "Short Answer"]
+
+def long_source():
+    """About 20,000 characters of text, so the retrieved passages push the preamble past CONTEXT_CACHE_MIN_TOKENS."""
+    rng = random.Random(0)
+    words = ["chlorophyll", "photon", "electron", "thylakoid", "stroma", "glucose", "carbon", "oxygen",
+             "membrane", "enzyme", "energy", "light", "water", "reaction", "plant", "cell"]
+    paragraphs = [" ".join(rng.choice(words) for _ in range(120)) + "." for _ in range(25)]
+    return content_engine.SourceIndex("\n\n".join(paragraphs))
+
+def make_quiz(count, source_text):
+    """Generates a quiz in a context cache scope of its own. Returns (quiz, cache stats)."""
+    async def run():
+        async with content_engine.context_cache_scope() as cache:
+            quiz = await content_engine.generate_quiz_data_batched_async(
+                "Photosynthesis", "Light-dependent reactions", count, datetime.date(2030, 1, 1), datetime.time(23, 59),
+                1, QUESTION_TYPES, "10", False, False, False, "Spanish", source_text, show_progress=False, use_cache=False)
+            return quiz, cache.stats()
+    return content_engine.run_async(run())
+
+def test_long_source_is_sent_once_as_a_cached_prefix(server):
+    quiz, stats = make_quiz(25, long_source())
+    assert len(quiz.questions) == 25
+    assert stats["created"] == 1
+    assert stats["hits"] >= 2
+    assert stats["fallbacks"] == 0
+    assert stats["prefix_tokens_saved"] > 0
+    # Batches cancelled once the quiz filled up may have used the prefix before answering
+    assert server.counters()["cached_prompt_tokens"] >= stats["prefix_tokens_saved"]
+
+class ExpiringCaches(dict):
+    """Server-side cache store whose entries expire as soon as they are created."""
+
+    def __setitem__(self, name, entry):
+        pass
+
+def test_expired_cache_falls_back_to_the_full_prompt(server):
+    server._caches = ExpiringCaches()
+    quiz, stats = make_quiz(25, long_source())
+    assert len(quiz.questions) == 25
+    assert stats["created"] == 1
+    assert stats["hits"] == 0
+    assert stats["fallbacks"] >= 1
+    assert server.counters()["cached_prompt_tokens"] == 0
+
+def test_backend_without_context_caching_gets_the_full_prompt(server):
+    server.context_caching = False
+    quiz, stats = make_quiz(25, long_source())
+    assert len(quiz.questions) == 25
+    assert stats == {"created": 0, "hits": 0, "fallbacks": 0, "prefix_tokens_saved": 0}
+    assert server.counters()["caches_created"] == 0
+    assert server.counters()["cached_prompt_tokens"] == 0
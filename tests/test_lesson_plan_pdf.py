@@ -0,0 +1,61 @@
+import io
+
+import pypdf
+import pytest
+from fpdf import FPDF
+
+import content_engine
+from content_engine import LessonPlanTemplate
+
+TEXTS = [
+    "",
+    "Short line",
+    "- Beakers\n- Spinach leaves\n- Light source\n",
+    "Students measure oxygen bubbles from leaf disks under three light intensities. " * 6,
+    "Supercalifragilisticexpialidocious" * 6,
+    "Chlorophyll a absorbs red and blue light\n\nthen passes energy on",
+    "Tabs\tand  double  spaces  between   words",
+    "Ends with a newline\n",
+]
+
+def draw(style, width, text, fast):
+    pdf = FPDF(orientation='P', unit='mm', format='Letter')
+    pdf.add_page()
+    pdf.set_font("Helvetica", style, 8)
+    pdf.set_xy(5, 45)
+    if fast:
+        LessonPlanTemplate().text_block(pdf, width, 4, text)
+    else:
+        pdf.multi_cell(width, 4, text)
+    return bytes(pdf.pages[1].contents), pdf.get_x(), pdf.get_y()
+
+@pytest.mark.parametrize("text", TEXTS)
+@pytest.mark.parametrize("style", ['', 'B', 'I', 'BI'])
+@pytest.mark.parametrize("width", [0, 55, 130])
+def test_text_block_lays_out_lines_like_multi_cell(text, style, width):
+    assert LessonPlanTemplate().direct_lines
+    assert draw(style, width, text, fast=True) == draw(style, width, text, fast=False)
+
+def test_text_block_falls_back_to_multi_cell_when_fpdf_changes(monkeypatch):
+    # A release whose TextLine no longer takes these keywords
+    def changed_text_line(fragments, text_width, number_of_spaces, align, height, max_width):
+        raise AssertionError("not reached")
+    monkeypatch.setattr(content_engine, "TextLine", changed_text_line)
+    template = LessonPlanTemplate()
+    pdf = FPDF(orientation='P', unit='mm', format='Letter')
+    pdf.add_page()
+    pdf.set_font("Helvetica", '', 8)
+    pdf.set_xy(5, 45)
+    template.text_block(pdf, 55, 4, TEXTS[3])
+    assert not template.direct_lines
+    assert (bytes(pdf.pages[1].contents), pdf.get_x(), pdf.get_y()) == draw('', 55, TEXTS[3], fast=False)
+
+def test_rendered_plan_is_one_page_pdf():
+    plan = content_engine.LessonPlan.model_validate({
+        "metadata": {"duration": "60 minutes", "materials": ["Spinach", "Syringes"], "vocabulary": ["Chlorophyll"],
+                     "differentiation": {"sped": ["Sentence starters"], "ml": ["Bilingual glossary"]}},
+        "sections": [{"phase": phase, "time": "10 mins", "activity": "Students investigate. " * 10}
+                     for phase in ("Engage", "Explore", "Explain", "Elaborate", "Evaluate")],
+    })
+    pdf_bytes = content_engine.render_lesson_plan_pdf(plan, "Photosynthesis", "NGSS HS-LS1-5", "10")
+    assert len(pypdf.PdfReader(io.BytesIO(pdf_bytes)).pages) == 1
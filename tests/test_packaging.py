@@ -0,0 +1,48 @@
+import io
+import zipfile
+
+import pytest
+
+import content_engine
+from content_engine import ZipPackageWriter, read_package
+
+def inner_zip():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("quiz.xml", "<questestinterop/>" * 200)
+    return buffer.getvalue()
+
+MEMBERS = [
+    ("01_Assignment_Célula.html", ("<p>Photosynthesis turns light into chemical energy.</p>\n" * 2000).encode("utf-8")),
+    ("01_LessonPlan.pdf", b"%PDF-1.3\n" + b"BT /F1 8 Tf (Engage) Tj ET\n" * 3000),
+    ("01_Slides.pptx", b"PK\x03\x04" + bytes(range(256)) * 40),
+    ("02_Quiz.zip", inner_zip()),
+    ("empty.html", b""),
+    ("tiny.txt", b"x"),
+]
+
+def build(members):
+    writer = ZipPackageWriter(spool_limit=64 * 1024)
+    for name, data in members:
+        writer.writestr(name, data)
+    with writer.open("streamed.xml") as member:
+        for _ in range(500):
+            member.write(b"<item>streamed</item>\n")
+    return zipfile.ZipFile(io.BytesIO(read_package(writer.close())))
+
+@pytest.mark.parametrize("raw_writes", [True, False])
+def test_mixed_members_round_trip(monkeypatch, raw_writes):
+    monkeypatch.setattr(content_engine, "_ZIP_RAW_WRITES", raw_writes)
+    archive = build(MEMBERS)
+    assert archive.testzip() is None
+    assert archive.namelist() == [name for name, _ in MEMBERS] + ["streamed.xml"]
+    for name, data in MEMBERS:
+        assert archive.read(name) == data
+    assert archive.read("streamed.xml") == b"<item>streamed</item>\n" * 500
+
+    types = {info.filename: info.compress_type for info in archive.infolist()}
+    assert types["01_Slides.pptx"] == zipfile.ZIP_STORED
+    assert types["02_Quiz.zip"] == zipfile.ZIP_STORED
+    assert types["01_Assignment_Célula.html"] == zipfile.ZIP_DEFLATED
+    assert types["01_LessonPlan.pdf"] == zipfile.ZIP_DEFLATED
+    assert zipfile.ZipFile(io.BytesIO(archive.read("02_Quiz.zip"))).testzip() is None
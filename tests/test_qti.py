@@ -0,0 +1,52 @@
+import html
+import io
+import xml.etree.ElementTree as ET
+import zipfile
+
+import pytest
+
+from content_engine import Question, Quiz, cdata, create_quiz_xml, generate_qti_zip, read_package
+
+NS = {"qti": "http://www.imsglobal.org/xsd/ims_qtiasiv1p2"}
+
+TRICKY = [
+    "Is a[b[0]]>c valid? ]]>",
+    "]]>]]>",
+    "Ends with ]]",
+    "<![CDATA[ inside ]]> & <b>tags</b>",
+    "x]]]>y",
+]
+
+def mattexts(xml_bytes):
+    root = ET.fromstring(xml_bytes)
+    return [html.unescape(element.text or "") for element in root.iter("{%s}mattext" % NS["qti"])]
+
+@pytest.mark.parametrize("text", TRICKY)
+def test_cdata_section_round_trips(text):
+    element = ET.fromstring(f"<t>{cdata(text)}</t>")
+    assert element.text == text
+
+def test_quiz_xml_with_cdata_terminators_is_valid():
+    questions = [
+        Question(type="Multiple Choice", question_text=text, options=[text, "]]>", "plain"], correct_answer_index=0)
+        for text in TRICKY
+    ]
+    texts = mattexts(create_quiz_xml(questions))
+    expected = []
+    for q in questions:
+        expected += [q.question_text, *q.options]
+    assert texts == expected
+
+def test_short_answer_with_cdata_terminator_round_trips():
+    question = Question(type="Short Answer", question_text="Close the section: ]]>", correct_answer_text="]]> & <done>")
+    xml_bytes = create_quiz_xml([question])
+    root = ET.fromstring(xml_bytes)
+    assert mattexts(xml_bytes) == [question.question_text]
+    assert [e.text for e in root.iter("{%s}varequal" % NS["qti"])] == [question.correct_answer_text]
+
+def test_package_quiz_xml_parses():
+    quiz = Quiz(questions=[Question(type="Essay", question_text=text) for text in TRICKY])
+    archive = zipfile.ZipFile(io.BytesIO(read_package(generate_qti_zip(quiz, title="CDATA ]]> check"))))
+    assert archive.testzip() is None
+    assert mattexts(archive.read("quiz.xml")) == TRICKY
+    ET.fromstring(archive.read("imsmanifest.xml"))
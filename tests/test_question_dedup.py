@@ -0,0 +1,48 @@
+from content_engine import Question, QuestionDedupIndex
+
+def mc(text, options=("Chlorophyll a", "Carotene", "Xanthophyll", "Anthocyanin")):
+    return Question(type="Multiple Choice", question_text=text, options=list(options), correct_answer_index=0)
+
+ORIGINAL = mc("Which pigment in the thylakoid membrane absorbs most of the red and blue light used to drive the light-dependent reactions of photosynthesis?")
+
+NEAR_DUPLICATES = [
+    # Case, punctuation and spacing
+    mc("which pigment in the thylakoid membrane absorbs most of the red & blue light used to drive the light dependent reactions of photosynthesis"),
+    # Options in another order
+    mc(ORIGINAL.question_text, ("Anthocyanin", "Xanthophyll", "Chlorophyll a", "Carotene")),
+    # One word added
+    mc("Which pigment in the thylakoid membrane absorbs most of the red and blue light used to drive the light-dependent reactions of photosynthesis in plants?"),
+]
+
+DISTINCT = [
+    mc("Which molecule is split during the light-dependent reactions to replace electrons lost by photosystem II?",
+       ("Water", "Carbon dioxide", "Glucose", "ATP")),
+    mc("In which part of the chloroplast does the Calvin cycle fix carbon dioxide into sugar?",
+       ("Stroma", "Thylakoid lumen", "Outer membrane", "Grana")),
+    Question(type="True/False", question_text="Oxygen released by plants comes from water, not from carbon dioxide.",
+             options=["True", "False"], correct_answer_index=0),
+    Question(type="Short Answer", question_text="Name the enzyme that fixes carbon dioxide in the Calvin cycle.",
+             correct_answer_text="Rubisco"),
+    # Shares the topic words of ORIGINAL but asks something else
+    mc("Which of these is a product of the light-dependent reactions?", ("ATP", "Glucose", "Carbon dioxide", "Starch")),
+]
+
+def test_near_duplicates_are_dropped():
+    index = QuestionDedupIndex()
+    assert index.add(ORIGINAL)
+    for question in NEAR_DUPLICATES:
+        assert not index.add(question), question.question_text
+    assert index.duplicates == len(NEAR_DUPLICATES)
+
+def test_distinct_questions_survive():
+    index = QuestionDedupIndex()
+    assert index.add(ORIGINAL)
+    for question in DISTINCT:
+        assert index.add(question), question.question_text
+    assert index.duplicates == 0
+
+def test_exact_repeat_of_a_later_question_is_dropped():
+    index = QuestionDedupIndex()
+    kept = [q for q in [ORIGINAL, *DISTINCT, *NEAR_DUPLICATES, *DISTINCT] if index.add(q)]
+    assert kept == [ORIGINAL, *DISTINCT]
+    assert index.duplicates == len(NEAR_DUPLICATES) + len(DISTINCT)
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from content_engine import Question, Quiz, QuestionStreamParser
+
+QUESTIONS = [
+    {"type": "Multiple Choice", "question_text": "Which pigment absorbs red light?",
+     "options": ["Chlorophyll a", "Carotene", "Xanthophyll", "Anthocyanin"], "correct_answer_index": 0},
+    {"type": "Short Answer", "question_text": 'What does the "light" in light reactions refer to? Use {braces} or [brackets] if you like.',
+     "correct_answer_text": "Photons \\ sunlight"},
+    {"type": "True/False", "question_text": "ATP is made in the stroma. } ] {\"questions\": [",
+     "options": ["True", "False"], "correct_answer_index": 1},
+    {"type": "Multiple Select", "question_text": "Pick the products: été — 🌿",
+     "options": ["O₂", "Glucose", "CO₂"], "correct_answer_index": [0, 1]},
+]
+
+def parse(text, size):
+    parser = QuestionStreamParser()
+    questions = []
+    for i in range(0, len(text), size):
+        questions.extend(parser.feed(text[i:i + size]))
+    return questions, parser
+
+def expected(items=QUESTIONS):
+    return [Question.model_validate(item) for item in items]
+
+@pytest.mark.parametrize("size", [1, 2, 7, 64, 100_000])
+def test_chunking_does_not_change_the_result(size):
+    text = json.dumps({"questions": QUESTIONS}, indent=2)
+    questions, parser = parse(text, size)
+    assert questions == expected()
+    assert questions == Quiz.model_validate_json(text).questions
+    assert parser.invalid == 0
+
+def test_one_byte_chunks_of_compact_json_with_escapes():
+    text = json.dumps({"questions": QUESTIONS}, separators=(",", ":"), ensure_ascii=True)
+    assert '\\"' in text and "\\\\" in text and "\\u" in text
+    questions, _ = parse(text, 1)
+    assert questions == expected()
+
+def test_questions_key_nested_elsewhere_is_ignored():
+    text = json.dumps({
+        "meta": {"questions": [{"type": "Essay", "question_text": "Nested, not a quiz question"}]},
+        "title": "questions",
+        "notes": [{"questions": [QUESTIONS[0]]}],
+        "questions": QUESTIONS[:2],
+    })
+    questions, _ = parse(text, 5)
+    assert questions == expected(QUESTIONS[:2])
+
+def test_questions_are_returned_as_soon_as_they_close():
+    text = json.dumps({"questions": QUESTIONS})
+    parser = QuestionStreamParser()
+    first_end = text.index(json.dumps(QUESTIONS[0])) + len(json.dumps(QUESTIONS[0]))
+    assert parser.feed(text[:first_end - 1]) == []
+    assert parser.feed(text[first_end - 1:first_end]) == expected(QUESTIONS[:1])
+
+@pytest.mark.parametrize("cut", [0.3, 0.6, 0.9])
+def test_truncated_stream_keeps_completed_questions(cut):
+    text = json.dumps({"questions": QUESTIONS})
+    truncated = text[:int(len(text) * cut)]
+    complete = [item for item in QUESTIONS if text.index(json.dumps(item)) + len(json.dumps(item)) <= len(truncated)]
+    questions, parser = parse(truncated, 3)
+    assert questions == expected(complete)
+    assert len(complete) < len(QUESTIONS)
+    assert parser.invalid == 0
+
+def test_invalid_elements_are_counted_and_skipped():
+    text = json.dumps({"questions": [QUESTIONS[0], {"question_text": "No type"}, QUESTIONS[1]]})
+    questions, parser = parse(text, 4)
+    assert questions == expected(QUESTIONS[:2])
+    assert parser.invalid == 1
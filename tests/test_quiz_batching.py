@@ -0,0 +1,30 @@
+import pytest
+
+from content_engine import QUIZ_YIELD_MIN_CALLS, plan_quiz_batches, quiz_batch_size
+
+QUESTION_TYPES = ["Multiple Choice", "True/False", "Short Answer"]
+
+def stats(mean, stdev, calls=QUIZ_YIELD_MIN_CALLS):
+    return {"calls": calls, "mean": mean, "stdev": stdev}
+
+@pytest.mark.parametrize("target", [1, 5, 10, 25, 50, 200])
+def test_batch_size_never_exceeds_the_quiz(target):
+    assert 1 <= quiz_batch_size(target, QUESTION_TYPES) <= target
+
+@pytest.mark.parametrize("target", [1, 5, 10])
+def test_small_quiz_is_one_call(target):
+    assert plan_quiz_batches(target, quiz_batch_size(target, QUESTION_TYPES)) == 1
+
+def test_one_batch_when_its_expected_yield_covers_the_target():
+    assert plan_quiz_batches(8, 10, stats(0.9, 0.2)) == 1
+    assert plan_quiz_batches(10, 10, stats(0.9, 0.2)) > 1
+
+def test_fixed_rule_until_enough_calls_are_recorded():
+    assert plan_quiz_batches(25, 10) == 4
+    assert plan_quiz_batches(25, 10, stats(0.5, 0.1, calls=QUIZ_YIELD_MIN_CALLS - 1)) == 4
+
+def test_recorded_yield_sets_the_number_of_batches():
+    reliable = plan_quiz_batches(50, 13, stats(1.0, 0.0))
+    flaky = plan_quiz_batches(50, 13, stats(0.6, 0.2))
+    assert reliable == 4
+    assert flaky > reliable
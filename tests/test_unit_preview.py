@@ -0,0 +1,45 @@
+import datetime
+import io
+import zipfile
+
+import pytest
+
+import content_engine
+
+class RecordingPreview(content_engine.PreviewDisplay):
+    def __init__(self):
+        self.shown = []
+
+    def show(self, title, text):
+        self.shown.append((title, text))
+
+class RecordingReporter(content_engine.Reporter):
+    def __init__(self):
+        self.previews = []
+
+    def preview(self):
+        self.previews.append(RecordingPreview())
+        return self.previews[-1]
+
+@pytest.fixture
+def reporter():
+    reporter = RecordingReporter()
+    content_engine.set_reporter(reporter)
+    yield reporter
+    content_engine.set_reporter(content_engine.Reporter())
+
+def test_preview_ends_with_every_finished_assignment(server, reporter, monkeypatch):
+    # Far longer than the run, so any update the throttle drops stays dropped
+    monkeypatch.setattr(content_engine, "ASSIGNMENT_PREVIEW_INTERVAL", 3600)
+    server.tokens_per_second = 20_000
+    sequence = [{"type": "Assignment", "title": f"Part {k}", "focus_topic": f"Stage {k}"} for k in range(1, 4)]
+    package = content_engine.generate_unit_package(
+        sequence, "Photosynthesis", "10", False, False, False, "Spanish", "Science", "Inquiry", "",
+        datetime.date(2030, 1, 1), datetime.time(23, 59), 100, 1, ["Multiple Choice"], use_cache=False)
+    archive = zipfile.ZipFile(io.BytesIO(content_engine.read_package(package)))
+
+    [preview] = reporter.previews
+    for k, item in enumerate(sequence, start=1):
+        html_content = archive.read(f"{k:02d}_Assignment_Part_{k}.html").decode("utf-8")
+        last_shown = [text for title, text in preview.shown if title == item["title"]][-1]
+        assert last_shown == html_content[-content_engine.ASSIGNMENT_PREVIEW_CHARS:]